@@ -0,0 +1,290 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import modules.shared.myfile as myfile
+import modules.shared.myfiletype as myfiletype
+import modules.shared.mycopy as mycopy
+import modules.shared.mydups as mydups
+import modules.geoloc.geoloc_rg as geoloc_rg
+from modules.geoloc.geoloc_cache import GeolocationCache
+import cli.photos_organizer1 as organizer
+from benchmarks.make_corpus import make_corpus, image_size_arg, DEFAULT_FILES, DEFAULT_SEED, DEFAULT_IMAGE_SIZE
+
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), 'pyutils_bench')
+DEFAULT_RESULTS_DIR = 'data/benchmarks'
+DEFAULT_REPEAT = 3
+BENCHMARK_NAME = 'photos_organizer1'
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+# Times the stages of photos_organizer1 one at a time on a corpus from make_corpus,
+# then the whole program, and writes the results as json so runs on different commits can be compared.
+# Every stage runs repeat times and keeps all its times; best is the one to compare,
+# the others show how noisy the machine was. Stages start from scratch on every repeat:
+# the copy goes to an empty folder, the geocoding to an empty cache, the program to an empty destination.
+
+# the corpus is kept in the work folder and made again only when its parameters change
+def prepare_corpus(workdir, num_files, seed, image_size):
+    corpus = os.path.join(workdir, 'corpus')
+    summary_file = os.path.join(workdir, 'corpus.json')
+    params = {'num_files': num_files, 'seed': seed, 'image_size': list(image_size)}
+    if os.path.exists(summary_file):
+        with open(summary_file, 'r', encoding='utf-8') as f:
+            summary = json.load(f)
+        if {key: summary.get(key) for key in params} == params and os.path.isdir(corpus):
+            logger.info(f"Reusing the corpus at {corpus}")
+            return corpus, summary
+    shutil.rmtree(corpus, ignore_errors=True)
+    summary = make_corpus(corpus, num_files, seed, image_size)
+    with open(summary_file, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    return corpus, summary
+
+# runs stage repeat times, stage returns (files, bytes) and may take a setup result
+def time_stage(name, stage, repeat, setup=None):
+    seconds = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        files, size = stage(arg) if setup else stage()
+        seconds.append(time.perf_counter() - start)
+    best = min(seconds)
+    result = {
+        'files': files,
+        'bytes': size,
+        'seconds': seconds,
+        'best': best,
+        'median': statistics.median(seconds),
+        'files_per_s': files / best if best else 0,
+        'mb_per_s': size / best / 2**20 if best and size else 0,
+    }
+    logger.info(f"{name:<10}: {files} files in {best:.3f} seconds at best of {repeat} ({result['files_per_s']:.1f} files/s)")
+    return result
+
+def fresh_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+def run_stages(corpus, workdir, repeat, walk_threads):
+    results = {}
+    records = []
+
+    def walk():
+        files = list(myfile.iter_files(corpus, threads=walk_threads))
+        return len(files), sum(record.size for record in files)
+    results['walk'] = time_stage('walk', walk, repeat)
+    files = [record.path for record in myfile.iter_files(corpus, threads=walk_threads)]
+    size = sum(os.path.getsize(path) for path in files)
+
+    def classify():
+        for path in files:
+            myfiletype.classify(path)
+        return len(files), 0
+    results['classify'] = time_stage('classify', classify, repeat)
+
+    def metadata():
+        records[:] = [organizer.extract_src_record(path) for path in files]
+        return len(files), 0
+    results['metadata'] = time_stage('metadata', metadata, repeat)
+
+    # every run of the program loads the reverse geocoder on its first cache miss, so does every repeat
+    points = list({(record.lat, record.lon) for record in records if record.lat and record.lon})
+    def geocode(geocache):
+        geocache.get_location_names(points)
+        return len(points), 0
+    def empty_geocache():
+        cache_file = os.path.join(workdir, 'geocache.json')
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        geoloc_rg._geocoders.clear()
+        return GeolocationCache(cache_file)
+    results['geocode'] = time_stage('geocode', geocode, repeat, empty_geocache)
+
+    def dedup():
+        mydups.find_duplicates(files)
+        return len(files), size
+    results['dedup'] = time_stage('dedup', dedup, repeat)
+
+    def copy(dst_dir):
+        copier = mycopy.CopyPipeline()
+        try:
+            for num, path in enumerate(files):
+                copier.submit(path, os.path.join(dst_dir, f"{num}_{os.path.basename(path)}"))
+            copier.finish()
+        finally:
+            copier.close()
+        return len(files), size
+    results['copy'] = time_stage('copy', copy, repeat, lambda: fresh_dir(os.path.join(workdir, 'copy')))
+    shutil.rmtree(os.path.join(workdir, 'copy'), ignore_errors=True)
+    return results
+
+# the program runs from the package root like any utility, with its index, geocache, journal
+# and destination in the work folder; the second run finds everything at destination already
+def run_cli(corpus, workdir, repeat, cli_args):
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(os.path.join(package_root, 'logs'), exist_ok=True)
+    state = os.path.join(workdir, 'cli')
+    dst = os.path.join(state, 'dst')
+    command = [sys.executable, '-m', 'cli.photos_organizer1', '-s', corpus, '-d', dst,
+               '--index', os.path.join(state, 'index.db'),
+               '--geocache', os.path.join(state, 'geocache.json'),
+               '--journal', os.path.join(state, 'journal.jsonl'),
+               *cli_args]
+
+    def run(_=None):
+        subprocess.run(command, cwd=package_root, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return num_files, 0
+
+    num_files = sum(1 for _ in myfile.iter_files(corpus))
+    results = {'command': command[1:]}
+    results['first_run'] = time_stage('cli', run, repeat, lambda: fresh_dir(state))
+    results['rerun'] = time_stage('cli rerun', run, repeat)
+    shutil.rmtree(state, ignore_errors=True)
+    return results
+
+def git_commit(package_root):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=package_root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=package_root,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+# best times of the stages in both results, with new / old ratios
+def compare_results(old, new):
+    lines = []
+    for section in ('stages', 'cli'):
+        for stage, result in new.get(section, {}).items():
+            old_result = old.get(section, {}).get(stage)
+            if not isinstance(result, dict) or not isinstance(old_result, dict):
+                continue
+            ratio = result['best'] / old_result['best'] if old_result['best'] else 0
+            lines.append(f"\n\t{stage:<10}: {old_result['best']:.3f} -> {result['best']:.3f} seconds ({ratio:.2f}x)")
+    return ''.join(lines)
+
+########################################################################
+
+# python -m benchmarks.bench_organizer [--files N] [--repeat R] [--compare RESULTS]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "bench_organizer",
+        description = "Time the stages of photos_organizer1 and the whole program on a synthetic photo library")
+    parser.add_argument(
+        '--files',
+        type = int,
+        metavar = 'N',
+        default = DEFAULT_FILES,
+        help = f"Approximate number of files in the corpus (default: {DEFAULT_FILES})")
+    parser.add_argument(
+        '--seed',
+        type = int,
+        default = DEFAULT_SEED,
+        help = f"Seed of the corpus (default: {DEFAULT_SEED})")
+    parser.add_argument(
+        '--image-size',
+        type = image_size_arg,
+        metavar = 'WxH',
+        default = DEFAULT_IMAGE_SIZE,
+        help = f"Size of the generated images (default: {DEFAULT_IMAGE_SIZE[0]}x{DEFAULT_IMAGE_SIZE[1]})")
+    parser.add_argument(
+        '--corpus',
+        type = str,
+        metavar = 'DIR',
+        help = "Benchmark an existing folder instead of a generated corpus")
+    parser.add_argument(
+        '--workdir',
+        type = str,
+        metavar = 'DIR',
+        default = DEFAULT_WORKDIR,
+        help = f"Folder for the corpus and the copies (default: {DEFAULT_WORKDIR})")
+    parser.add_argument(
+        '--repeat',
+        type = int,
+        metavar = 'N',
+        default = DEFAULT_REPEAT,
+        help = f"Times every stage runs (default: {DEFAULT_REPEAT})")
+    parser.add_argument(
+        '--walk-threads',
+        type = int,
+        metavar = 'N',
+        default = myfile.DEFAULT_WALK_THREADS,
+        help = f"Threads listing folders in the walk stage (default: {myfile.DEFAULT_WALK_THREADS})")
+    parser.add_argument(
+        '--no-cli',
+        action = 'store_true',
+        help = "Time the stages only, not the whole program")
+    parser.add_argument(
+        '--cli-args',
+        type = str,
+        metavar = 'ARGS',
+        default = '',
+        help = "More arguments for photos_organizer1, e.g. '--jobs 4 --stream-archives'")
+    parser.add_argument(
+        '--output',
+        type = str,
+        metavar = 'FILE',
+        help = f"Results file (default: a file named after the commit and time in {DEFAULT_RESULTS_DIR})")
+    parser.add_argument(
+        '--compare',
+        type = str,
+        metavar = 'FILE',
+        help = "Results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    setup_logging("bench_organizer.log", log_level=logging.INFO, queued=True)
+    # the stages log every file, only the benchmark's own lines are wanted
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    if args.corpus:
+        corpus = os.path.abspath(args.corpus)
+        corpus_summary = {'path': corpus}
+    else:
+        corpus, corpus_summary = prepare_corpus(workdir, args.files, args.seed, args.image_size)
+    repeat = max(args.repeat, 1)
+    commit, dirty = git_commit(package_root)
+
+    results = {
+        'benchmark': BENCHMARK_NAME,
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': repeat,
+        'corpus': corpus_summary,
+        'stages': run_stages(corpus, workdir, repeat, max(args.walk_threads, 1)),
+    }
+    if not args.no_cli:
+        results['cli'] = run_cli(corpus, workdir, repeat, args.cli_args.split())
+
+    output = args.output
+    if not output:
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output = os.path.join(package_root, DEFAULT_RESULTS_DIR, f"{(commit or 'nocommit')[:10]}_{stamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        logger.info(f"Compared with {args.compare} of commit {old.get('commit')}:{compare_results(old, results)}")
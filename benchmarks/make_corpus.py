@@ -0,0 +1,285 @@
+import argparse
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import tarfile
+import zipfile
+from datetime import datetime, timedelta
+
+from PIL import Image
+
+DEFAULT_FILES = 1000
+DEFAULT_SEED = 0
+DEFAULT_IMAGE_SIZE = (320, 240)
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+# Generates a synthetic photo library for benchmarks. The same files, seed and image size
+# always give the same bytes, so results of different commits are comparable.
+# Share of the files of each kind:
+MIX = {
+    'jpeg_gps': 0.25,    # camera JPEG with EXIF date and GPS position
+    'jpeg_exif': 0.15,   # camera JPEG with EXIF date only
+    'jpeg_plain': 0.05,  # JPEG without EXIF and without a date in its name, dated from the file
+    'named': 0.10,       # JPEG without EXIF, dated from its phone or messenger name
+    'png': 0.10,         # PNG, half of them screenshots with a date in their name
+    'burst': 0.10,       # JPEGs taken in the same second, so they want the same destination name
+    'duplicate': 0.10,   # exact copies of other files, in other folders and sometimes under other names
+    'archived': 0.10,    # JPEGs inside zip and tar.gz archives, some in a zip inside the archive
+    'other': 0.05,       # notes and documents, not images
+}
+# GPS positions are scattered around these places, a few hundred meters apart
+PLACES = [(32.28, 34.86), (48.857, 2.352), (40.713, -74.006), (35.676, 139.650), (-33.869, 151.209), (51.507, -0.128)]
+CAMERAS = [('Canon', 'Canon EOS 80D'), ('NIKON CORPORATION', 'NIKON D750'), ('Apple', 'iPhone 12'), ('samsung', 'SM-G991B')]
+NAME_FORMATS = ['IMG_%Y%m%d_%H%M%S', 'PXL_%Y%m%d_%H%M%S{ms:03d}', 'IMG-%Y%m%d-WA{n:04d}', 'Screenshot_%Y-%m-%d-%H-%M-%S', 'photo_%d%m%Y']
+FIRST_DATE = datetime(2005, 1, 1)
+DATE_RANGE_DAYS = 20 * 365
+ARCHIVE_MEMBERS = 20
+BURST_SIZES = (3, 6)
+
+class CorpusWriter:
+    def __init__(self, root, seed=DEFAULT_SEED, image_size=DEFAULT_IMAGE_SIZE):
+        self.root = root
+        self.rng = random.Random(seed)
+        self.image_size = image_size
+        self.counter = 0
+        # (relative path, bytes) of the written files, for duplicates
+        self.written = []
+        self.kinds = {}
+        self.files = 0
+        self.members = 0
+        self.bytes = 0
+
+    def next_num(self):
+        self.counter += 1
+        return self.counter
+
+    def random_date(self):
+        return FIRST_DATE + timedelta(seconds=self.rng.randrange(DATE_RANGE_DAYS * 86400))
+
+    def random_position(self):
+        lat, lon = self.rng.choice(PLACES)
+        return lat + self.rng.uniform(-0.02, 0.02), lon + self.rng.uniform(-0.02, 0.02)
+
+    # a smooth random picture: random pixels of a small image scaled up, compresses like a photo
+    def image(self, mode='RGB'):
+        width, height = self.image_size
+        small = (max(width // 16, 1), max(height // 16, 1))
+        pixels = self.rng.randbytes(small[0] * small[1] * len(mode))
+        return Image.frombytes(mode, small, pixels).resize(self.image_size, Image.BILINEAR)
+
+    def jpeg(self, date=None, position=None, subsec=None):
+        exif = Image.Exif()
+        if date:
+            make, model = self.rng.choice(CAMERAS)
+            exif[0x010F] = make
+            exif[0x0110] = model
+            exif[0x0132] = date.strftime('%Y:%m:%d %H:%M:%S')
+            exif_ifd = exif.get_ifd(0x8769)
+            exif_ifd[0x9003] = date.strftime('%Y:%m:%d %H:%M:%S')
+            if subsec is not None:
+                exif_ifd[0x9291] = f"{subsec:03d}"
+        if position:
+            gps = exif.get_ifd(0x8825)
+            lat, lon = position
+            gps[1], gps[2] = 'N' if lat >= 0 else 'S', _dms(abs(lat))
+            gps[3], gps[4] = 'E' if lon >= 0 else 'W', _dms(abs(lon))
+        data = io.BytesIO()
+        self.image().save(data, 'JPEG', quality=85, exif=exif)
+        return data.getvalue()
+
+    def png(self):
+        data = io.BytesIO()
+        self.image().save(data, 'PNG')
+        return data.getvalue()
+
+    def write(self, kind, relpath, data, date=None):
+        path = os.path.join(self.root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        date = date or self.random_date()
+        os.utime(path, (date.timestamp(), date.timestamp()))
+        self.written.append((relpath, data))
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+        self.files += 1
+        self.bytes += len(data)
+
+    def camera_name(self, folder):
+        return f"{folder}/IMG_{self.next_num():04d}.JPG"
+
+    def add_jpeg_gps(self):
+        date = self.random_date()
+        data = self.jpeg(date, self.random_position(), self.rng.randrange(1000))
+        self.write('jpeg_gps', self.camera_name(self.rng.choice(['DCIM/100CANON', 'DCIM/101CANON', 'Phone/Camera'])), data, date)
+
+    def add_jpeg_exif(self):
+        date = self.random_date()
+        data = self.jpeg(date, subsec=self.rng.randrange(1000))
+        self.write('jpeg_exif', self.camera_name(self.rng.choice(['DCIM/100CANON', 'Old/Trip'])), data, date)
+
+    def add_jpeg_plain(self):
+        self.write('jpeg_plain', f"Downloads/image{self.next_num()}.jpg", self.jpeg())
+
+    def add_named(self):
+        date = self.random_date()
+        name_format = self.rng.choice(NAME_FORMATS)
+        name = date.strftime(name_format).format(ms=self.rng.randrange(1000), n=self.next_num())
+        self.write('named', f"WhatsApp/Media/{name}.jpg", self.jpeg())
+
+    def add_png(self):
+        if self.rng.random() < 0.5:
+            name = self.random_date().strftime('Screenshots/Screenshot_%Y-%m-%d-%H-%M-%S.png')
+        else:
+            name = f"Downloads/picture{self.next_num()}.png"
+        self.write('png', name, self.png())
+
+    # returns the number of files written
+    def add_burst(self, size):
+        date = self.random_date()
+        position = self.random_position() if self.rng.random() < 0.5 else None
+        for _ in range(size):
+            self.write('burst', self.camera_name('DCIM/102BURST'), self.jpeg(date, position), date)
+        return size
+
+    def add_duplicate(self):
+        relpath, data = self.rng.choice(self.written)
+        name = os.path.basename(relpath)
+        if self.rng.random() < 0.5:
+            name = f"Copy of {name}"
+        self.write('duplicate', f"Backup/{self.next_num()}/{name}", data)
+
+    # JPEGs in a zip, or a tar.gz with half of them in a zip inside it
+    def add_archive(self, size):
+        members = []
+        for _ in range(size):
+            date = self.random_date()
+            position = self.random_position() if self.rng.random() < 0.5 else None
+            members.append((f"Photos/IMG_{self.next_num():04d}.jpg", self.jpeg(date, position), date))
+        num = self.next_num()
+        if num % 2:
+            data = _zip(members)
+            relpath = f"Archives/takeout-{num}.zip"
+        else:
+            half = len(members) // 2
+            nested = _zip(members[:half])
+            data = _targz(members[half:] + [("Photos/nested.zip", nested, FIRST_DATE)])
+            relpath = f"Archives/old-{num}.tar.gz"
+        self.write('archive', relpath, data)
+        self.members += size
+
+    def add_other(self):
+        if self.rng.random() < 0.5:
+            data = b'%PDF-1.4\n' + self.rng.randbytes(self.rng.randrange(1000, 20000))
+            name = f"Documents/scan{self.next_num()}.pdf"
+        else:
+            data = ' '.join(self.rng.choice(['photo', 'trip', 'beach', 'family', 'note']) for _ in range(200)).encode()
+            name = f"Documents/note{self.next_num()}.txt"
+        self.write('other', name, data)
+
+def _dms(value):
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round((value - degrees - minutes / 60) * 3600, 2)
+    return (float(degrees), float(minutes), seconds)
+
+def _zip(members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_STORED) as zip_ref:
+        for name, contents, date in members:
+            zip_ref.writestr(zipfile.ZipInfo(name, date.timetuple()[:6]), contents)
+    return data.getvalue()
+
+# gzip gets a fixed time so that the bytes do not depend on when the corpus is made
+def _targz(members):
+    data = io.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode='wb', mtime=0) as gz, tarfile.open(fileobj=gz, mode='w') as tar_ref:
+        for name, contents, date in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            info.mtime = int(date.timestamp())
+            tar_ref.addfile(info, io.BytesIO(contents))
+    return data.getvalue()
+
+# writes about num_files files into root, which should not exist or be empty, and returns what was written
+def make_corpus(root, num_files=DEFAULT_FILES, seed=DEFAULT_SEED, image_size=DEFAULT_IMAGE_SIZE):
+    writer = CorpusWriter(root, seed, image_size)
+    counts = {kind: round(num_files * share) for kind, share in MIX.items()}
+    for _ in range(counts['jpeg_gps']):
+        writer.add_jpeg_gps()
+    for _ in range(counts['jpeg_exif']):
+        writer.add_jpeg_exif()
+    for _ in range(counts['jpeg_plain']):
+        writer.add_jpeg_plain()
+    for _ in range(counts['named']):
+        writer.add_named()
+    for _ in range(counts['png']):
+        writer.add_png()
+    left = counts['burst']
+    while left > 0:
+        left -= writer.add_burst(min(left, writer.rng.randint(*BURST_SIZES)))
+    for _ in range(counts['other']):
+        writer.add_other()
+    left = counts['archived']
+    while left > 0:
+        writer.add_archive(min(left, ARCHIVE_MEMBERS))
+        left -= ARCHIVE_MEMBERS
+    # last, so that any of the files above may be duplicated
+    for _ in range(counts['duplicate']):
+        writer.add_duplicate()
+
+    summary = {
+        'files': writer.files,
+        'archive_members': writer.members,
+        'bytes': writer.bytes,
+        'kinds': writer.kinds,
+        'num_files': num_files,
+        'seed': seed,
+        'image_size': list(image_size),
+    }
+    logger.info(f"Corpus of {writer.files} files and {writer.members} archive members, {writer.bytes / 2**20:.1f} MB, written to {root}")
+    return summary
+
+def image_size_arg(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+########################################################################
+
+# python -m benchmarks.make_corpus DIR [--files N] [--seed S] [--image-size WxH]
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.INFO)
+    logger = logging.getLogger("make_corpus")
+
+    parser = argparse.ArgumentParser(
+        prog = "make_corpus",
+        description = "Generate a synthetic photo library for benchmarks")
+    parser.add_argument(
+        'root',
+        type = str,
+        help = "Folder to write the corpus to")
+    parser.add_argument(
+        '--files',
+        type = int,
+        metavar = 'N',
+        default = DEFAULT_FILES,
+        help = f"Approximate number of files, archive members included (default: {DEFAULT_FILES})")
+    parser.add_argument(
+        '--seed',
+        type = int,
+        default = DEFAULT_SEED,
+        help = f"Seed of the random generator (default: {DEFAULT_SEED})")
+    parser.add_argument(
+        '--image-size',
+        type = image_size_arg,
+        metavar = 'WxH',
+        default = DEFAULT_IMAGE_SIZE,
+        help = f"Size of the generated images (default: {DEFAULT_IMAGE_SIZE[0]}x{DEFAULT_IMAGE_SIZE[1]})")
+    args = parser.parse_args()
+
+    summary = make_corpus(args.root, args.files, args.seed, args.image_size)
+    logger.info(json.dumps(summary))
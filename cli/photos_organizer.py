@@ -10,7 +10,10 @@ import shutil
 #sys.path.append(parent_dir)
 
 from modules.shared.mylog import setup_logging
-from modules.shared.myfile import extract_totemp, isimage, isarchive, get_hash_from_contents, count_files_in_folder
+import modules.shared.myprof as myprof
+from modules.shared.myfile import extract_totemp, isarchive, get_hash_from_contents, count_files_in_folder, iter_files, DEFAULT_WALK_THREADS
+from modules.shared.myfiletype import classify, KIND_IMAGE
+from modules.shared.mycopy import copy_file
 from modules.img.img_exif import get_image_metadata
 from modules.geoloc.geoloc_cache import GeolocationCache
 
@@ -28,6 +31,7 @@ program_description = '''\
         '''
 moto = "Smile and love, always!!! Kathy :-)"
 logger = logging.getLogger(program_abbr)
+DEFAULT_PROFILE_FILE = 'logs/photos_organizer_profile.json'
 
 geocache = None
 dest_folder = None
@@ -43,15 +47,13 @@ def process_folder(folder_path):
     global total_files
     logger.debug(f"start processing folder {folder_path}")
     folder_files = 0
-    for root, _, files in os.walk(folder_path):
-        folder_files = len(files)
-        logger.debug(f"there are {folder_files} files in the folder")
-        for file in files:
-            path = os.path.join(root, file)
-            process_file(path)
-        total_files += folder_files
+    for record in iter_files(folder_path, threads=DEFAULT_WALK_THREADS):
+        process_file(record.path)
+        folder_files += 1
+    total_files += folder_files
     logger.debug(f"done processing {folder_files} entries in folder {folder_path}")
 
+@myprof.timed('file', path_arg=0)
 def process_file(file_path):
     global image_files
     global non_image_files
@@ -60,13 +62,14 @@ def process_file(file_path):
     dest_path = None
 
     logger.debug(f"start processing file {file_path}")
-    if isimage(file_path) :
+    filetype = classify(file_path)
+    if filetype.kind == KIND_IMAGE :
         logger.debug(f"will process as image")
         dest_path = process_image(file_path)
         image_files += 1
-    elif isarchive(file_path):
+    elif isarchive(file_path, filetype):
         logger.debug(f"will process as archive")
-        temp_dir = extract_totemp(file_path)
+        temp_dir = extract_totemp(file_path, filetype)
         keep_temp = keep_temp_folders
         logger.debug(f"extracted to {temp_dir}, will process as folder")
         try:
@@ -86,12 +89,13 @@ def process_file(file_path):
     if os.path.isfile(dest_path):
         dest_path = handle_duplicate(file_path, dest_path)
     if dest_path:
-        shutil.copy2(file_path, dest_path)
+        copy_file(file_path, dest_path)
         copied_files += 1
         logger.info(f"copied {file_path} to {dest_path}")
     else:
         duplicate_files += 1
 
+@myprof.timed('duplicate', path_arg=0)
 def handle_duplicate(file_path, dest_path):
     result = None
 
@@ -107,6 +111,7 @@ def handle_duplicate(file_path, dest_path):
 
     return result
 
+@myprof.timed('metadata', path_arg=0)
 def process_image(image_path):
     NO_YEAR = "NoYear"
     NO_DATE = "NoDate"
@@ -180,6 +185,14 @@ if __name__ == "__main__":
         action='store_true', 
         help="Keep the temporary directory after processing")
     
+    parser.add_argument(
+        '--profile',
+        type = str,
+        metavar = 'FILE',
+        nargs = '?',
+        const = DEFAULT_PROFILE_FILE,
+        help = f"Time stages, functions and files, and write a json report to FILE and collapsed stacks for flame graphs next to it (default when given: {DEFAULT_PROFILE_FILE})")
+    
     args = parser.parse_args()
 
     dest_folder = args.dest
@@ -189,6 +202,8 @@ if __name__ == "__main__":
     keep_temp_folders = args.keep_temp
     geocache = GeolocationCache()
 
+    if args.profile:
+        myprof.start()
     files_at_dest_before = count_files_in_folder(dest_folder)
     main(args.src)
     files_at_dest_after = count_files_in_folder(dest_folder)
@@ -198,4 +213,7 @@ if __name__ == "__main__":
                 \n\tother files in source: {non_image_files}, \
                 \n\tcopied files: {copied_files}, skipped duplicate files {duplicate_files}, \
                 \n\tfiles at destination folder before: {files_at_dest_before} \
-                \n\tfiles at destination after: {files_at_dest_after}")
\ No newline at end of file
+                \n\tfiles at destination after: {files_at_dest_after}")
+    if args.profile:
+        report = myprof.stop(args.profile)
+        logger.info(f"Profile written to {args.profile}:{myprof.report_summary(report)}")
\ No newline at end of file
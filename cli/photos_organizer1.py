@@ -1,9 +1,11 @@
 import argparse
 import logging
 import os
-import shutil
-import glob
+import sys
+import json
 import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 #parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 #print(parent_dir)
@@ -11,9 +13,24 @@ import time
 #sys.path.append(parent_dir)
 
 import modules.shared.myfile as myfile
+import modules.shared.mydate as mydate
+import modules.shared.mycopy as mycopy
+import modules.shared.mydups as mydups
+import modules.shared.mysimilar as mysimilar
+import modules.shared.myprof as myprof
+from modules.shared.myprogress import Progress, hit_ratio, DEFAULT_METRICS_INTERVAL
+from modules.shared.mydest import DestinationIndex
 import modules.img.img as img
-from modules.geoloc.geoloc_cache import GeolocationCache
-from modules.shared.mylog import setup_logging
+import modules.shared.myfiletype as myfiletype
+import modules.shared.myarchive as myarchive
+import modules.img.img_fastexif as img_fastexif
+import modules.img.img_phash as img_phash
+from modules.geoloc.geoloc_cache import GeolocationCache, DEFAULT_GEO_CACHE, DEFAULT_RADIUS_KM
+from modules.geoloc.geoloc_rg import DEFAULT_RG_TREE
+from modules.shared.myindex import MetadataIndex, DEFAULT_INDEX_FILE
+from modules.shared.myjournal import Journal, DEFAULT_JOURNAL_DIR
+from modules.shared.mymanifest import DestinationManifest, DEFAULT_MANIFEST_NAME
+from modules.shared.mylog import setup_logging, sampled, unqueue_logging
 
 # Globals
 program_name = "photos_organizer"
@@ -34,8 +51,8 @@ shutup_modules= [
     ("PIL",logging.ERROR),
     ("exif",logging.ERROR),
     ("exifread",logging.ERROR),
-    #("modules.img.img",logging.WARNING),
-    ("modules.img.img",logging.DEBUG),
+    ("modules.img.img",logging.WARNING),
+    #("modules.img.img",logging.DEBUG),
     ("modules.img.img_exif",logging.WARNING),
     ("modules.img.img_exifread",logging.WARNING),
     ("modules.shared.mydate",logging.WARNING),
@@ -45,86 +62,529 @@ NO_YEAR = "NoYear"
 NO_DATE = "NoDate"
 NO_LOC = "NoLoc"
 SUBDIR_OTHER = "Other"
+geocache = None
+mdindex = None
+hash_algorithm = myfile.DEFAULT_HASH_ALGORITHM
+link_mode = mycopy.DEFAULT_LINK_MODE
+copier = None
+# perceptual hashes of the images at destination, None unless --skip-similar
+similar = None
+skipped_similar = 0
+journal = None
+manifest = None
+# destination files found on disk since the run started
+dst_checked = set()
+# destinations of archive members decided and not yet written
+archive_pending = set()
+# FileType of the walked source files waiting for their metadata
+src_filetypes = {}
+# counted while the source is walked, together with the copy, so that they are right when the run stops early
+walk_threads = myfile.DEFAULT_WALK_THREADS
+num_files_at_src = 0
+resumed = 0
+copied = 0
+skipped = 0
+copy_threads = mycopy.DEFAULT_COPY_THREADS
+copy_inflight_mb = mycopy.DEFAULT_INFLIGHT_MB
+copy_inflight_files = mycopy.DEFAULT_INFLIGHT_FILES
+# files copied with each mycopy method
+copy_methods = {}
+# per-file progress is logged for about one source file in log_every
+log_every = 1
+# files sent to a worker process at once, and chunks queued per worker
+JOBS_CHUNK_SIZE = 32
+JOBS_CHUNKS_PER_WORKER = 4
+# records whose GPS points are resolved to place names at once
+GEO_BATCH_SIZE = 512
+DEFAULT_PROFILE_FILE = 'logs/photos_organizer1_profile.json'
+# status line and metrics file of the run, None with --no-progress and no --metrics
+progress = None
 
-def decide_for_duplicates(src_path, dst_path, ext):
-    src_hash = myfile.get_hash_from_contents(src_path)
-    dst_hash = myfile.get_hash_from_contents(dst_path)
-    
-    if src_hash == dst_hash: 
-        logger.debug(f"file with same name and contents exists in destination, no need to copy")
-        return None
+# compact result of metadata extraction, cheap to send back from worker processes
+SrcRecord = namedtuple('SrcRecord', ['src_path', 'subdir', 'name', 'extension', 'isimage', 'lat', 'lon', 'elapsed'])
+# hash, size and datetime mtime of an archive member, read before anything is written
+MemberContents = namedtuple('MemberContents', ['hash', 'size', 'mtime'])
+
+# per-stage counters reported at the end of the run: files, seconds, bytes;
+# the copy seconds are the time with copies in flight, so its MB/s is the sustained rate
+stage_stats = {
+    'metadata': [0, 0.0, 0],
+    'wait': [0, 0.0, 0],
+    'geocode': [0, 0.0, 0],
+    'copy': [0, 0.0, 0],
+}
+
+def add_stage_stats(stage, files, seconds, size=0):
+    stats = stage_stats[stage]
+    stats[0] += files
+    stats[1] += seconds
+    stats[2] += size
+
+def stage_stats_summary(wall_time, jobs):
+    lines = []
+    for stage, (files, seconds, size) in stage_stats.items():
+        files_per_sec = files / seconds if seconds else 0
+        line = f"\n\t{stage:<10}: {files} files in {seconds:.2f} seconds ({files_per_sec:.1f} files/s"
+        if size:
+            line += f", {size / seconds / 2**20 if seconds else 0:.1f} MB/s"
+        lines.append(line + ")")
+    files = stage_stats['metadata'][0]
+    lines.append(f"\n\tpipeline  : {files} files in {wall_time:.2f} seconds with {jobs} job(s) ({files / wall_time if wall_time else 0:.1f} files/s)")
+    return ''.join(lines)
+
+def get_hash(path):
+    # a file still being copied to destination has the contents of its source
+    if copier:
+        path = copier.source_of(path)
+    if mdindex:
+        return mdindex.get_hash(path)
+    return myfile.get_hash_from_contents(path, hash_algorithm)
+
+# hashes of destination files are kept in the manifest, so they are read at most once
+def get_dst_hash(path):
+    hash = manifest.get_hash(path) if manifest else None
+    if hash and myfile.hash_algorithm_of(hash) == hash_algorithm:
+        return hash
+    hash = get_hash(path)
+    if manifest and hash and not (copier and path in copier):
+        manifest.set_hash(path, hash)
+    return hash
+
+# a file at destination missing from the manifest, e.g. copied by a run that crashed before committing
+# the manifest, is added to it and to files_at_dst; returns True in that case
+def sync_with_disk(files_at_dst, dst_path):
+    if dst_path in files_at_dst or not os.path.exists(dst_path):
+        return False
+    logger.warning(f"{dst_path} is not in the destination manifest, adding it")
+    files_at_dst.add(dst_path)
+    if manifest:
+        manifest.add(dst_path)
+    return True
 
-    # get all potential duplicates at destination
-    glob_pattern = f"{dst_path[0:len(dst_path)-len(ext)]}*"
-    logger.debug(f"glob_pattern={glob_pattern}")
-    glob_files = glob.glob(glob_pattern)
-    logger.debug(f"before hash comparison: considering {len(glob_files)} files")
-    for file in glob_files:
-        if not file.lower().endswith(ext.lower()):
-            logger.debug(f"removing file from glob_files: {file}")
-            glob_files.remove(file)
+# files in the manifest that were removed from destination by other means are dropped when their name comes up,
+# before their stored hashes can make a source file look like it is already there;
+# files being copied, or archive members waiting for the second read of their archive, are not on disk yet,
+# and every file is checked once
+def drop_missing_at_dst(files_at_dst, dst_path):
+    for path in files_at_dst.group_paths(dst_path):
+        if path in dst_checked or (copier and path in copier) or path in archive_pending:
             continue
-        hash = myfile.get_hash_from_contents(file)
-        if hash == src_hash:
-            logger.debug(f"file with same contents in destination, no need to copy: {file}")
-            return None
-    
-    logger.debug(f"compute alt name considering {len(glob_files)} files")    
-    current_max = 0
-    for file in glob_files:
-        name = file[0:len(file)-len(ext)]
-        logger.debug(f"file={file}, name={name}") 
-        try:
-            num  = int(name.split('-')[-1])
-            if num > current_max:
-                current_max = num
-            logger.debug(f"num={num}, current_max={current_max}") 
-        except :
+        dst_checked.add(path)
+        if not os.path.exists(path):
+            logger.warning(f"{path} is in the destination manifest but not at destination, dropping it")
+            files_at_dst.remove(path)
+            if manifest:
+                manifest.remove(path)
+
+# returns None when the contents of src_path are already at destination under the name of dst_path,
+# otherwise the number for an alternative name
+def decide_for_duplicates(src_path, dst_path, ext, files_at_dst):
+    src_hash = get_hash(src_path)
+    same_file = files_at_dst.find_same_contents(dst_path, src_hash)
+    if same_file:
+        logger.debug("file with same contents in destination, no need to copy: %s", same_file)
+        return None, src_hash
+
+    alt_file_num = files_at_dst.next_suffix(dst_path)
+    logger.debug("alt_file_num=%s", alt_file_num)
+    return alt_file_num, src_hash
+
+def init_worker(loglevel, shutup_modules, use_dateparser=False):
+    mydate.use_dateparser = use_dateparser
+    # a forked worker inherits the profiler of the main process, its timings would never be reported
+    myprof.profiler = None
+    unqueue_logging()
+    # worker processes only log warnings, per-file progress is logged by the main process;
+    # the level is set first, a forked worker would otherwise log the setup lines at the inherited level
+    logging.getLogger().setLevel(max(loglevel, logging.WARNING))
+    setup_logging(None, log_level=max(loglevel, logging.WARNING), shutup_modules=shutup_modules)
+
+# src_files are (path, myfiletype.FileType) from the walk
+def extract_src_records(src_files):
+    return [extract_src_record(src_path, filetype) for src_path, filetype in src_files]
+
+# only images are stored in the index, other files are always sent to metadata extraction
+def lookup_src_record(src_path):
+    if not mdindex:
+        return None
+    md = mdindex.get_metadata(src_path)
+    if not md:
+        return None
+    year_taken, date_taken, lat, lon = md
+    _, src_extension = os.path.splitext(src_path)
+    return SrcRecord(src_path, year_taken, date_taken, src_extension.lower(), True, lat, lon, 0.0)
+
+def store_src_record(record):
+    if mdindex and record.isimage:
+        mdindex.put_metadata(record.src_path, record.subdir, record.name, record.lat, record.lon)
+
+# the source is walked while its files are processed; files finished by a resumed run are left out.
+# The walk classifies every file, its FileType waits in src_filetypes until the file's metadata is extracted
+def iter_src_files(src_dir, tempdirs_for_src, archives_at_src=None, include=None, exclude=None, resume=False):
+    global num_files_at_src, resumed
+    for src_path, filetype in myfile.iter_typed_files_at_path(src_dir, tempdirs_for_src, archives_at_src, include, exclude, walk_threads):
+        num_files_at_src += 1
+        if resume and journal.finished(src_path):
+            resumed += 1
             continue
-    logger.debug(f"current_max={current_max}")
-    return (current_max + 1)
+        src_filetypes[src_path] = filetype
+        yield src_path
+    # files inside streamed archives are counted only when they are read, the total is final after them
+    if progress and not archives_at_src:
+        progress.set_total(progress.total, final=True)
+
+def iter_src_records(files_at_scr, jobs):
+    if jobs <= 1:
+        for src_path in files_at_scr:
+            filetype = src_filetypes.pop(src_path, None)
+            record = lookup_src_record(src_path)
+            if not record:
+                record = extract_src_record(src_path, filetype)
+                store_src_record(record)
+            yield record
+        return
+
+    # chunks are consumed in submission order, so the copy step sees the same order as with one job;
+    # a chunk holds records found in the metadata index and (path, FileType) that still have to be sent to a worker
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(loglevel, shutup_modules, mydate.use_dateparser)) as executor:
+        pending = deque()
+        chunk = []
+        for src_path in files_at_scr:
+            filetype = src_filetypes.pop(src_path, None)
+            chunk.append(lookup_src_record(src_path) or (src_path, filetype))
+            if len(chunk) < JOBS_CHUNK_SIZE:
+                continue
+            pending.append(submit_chunk(executor, chunk))
+            chunk = []
+            while len(pending) >= jobs * JOBS_CHUNKS_PER_WORKER:
+                yield from wait_for_records(*pending.popleft())
+        if chunk:
+            pending.append(submit_chunk(executor, chunk))
+        while pending:
+            yield from wait_for_records(*pending.popleft())
+
+def submit_chunk(executor, chunk):
+    misses = [entry for entry in chunk if not isinstance(entry, SrcRecord)]
+    future = executor.submit(extract_src_records, misses) if misses else None
+    return chunk, future
+
+def wait_for_records(chunk, future):
+    if not future:
+        return chunk
+    start = time.perf_counter()
+    with myprof.timer('wait'):
+        extracted = iter(future.result())
+    add_stage_stats('wait', len(chunk), time.perf_counter() - start)
+    records = []
+    for entry in chunk:
+        if not isinstance(entry, SrcRecord):
+            entry = next(extracted)
+            myprof.add('metadata', entry.elapsed, entry.src_path)
+            store_src_record(entry)
+        records.append(entry)
+    return records
+
+def iter_record_batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-def copy_from_src_to_dst(files_at_scr, files_at_dst, dst_dir):
-    copied = skipped = 0
+@myprof.timed('geocode')
+def resolve_locations(records):
+    start = time.perf_counter()
+    gps_points = list({(record.lat, record.lon) for record in records if record.lat and record.lon})
+    names = geocache.get_location_names(gps_points) if gps_points else []
+    add_stage_stats('geocode', len(gps_points), time.perf_counter() - start)
+    return dict(zip(gps_points, names))
 
-    for src_path in files_at_scr:
+# perceptual hashes of the images of a batch that PIL decodes, decoded together
+@myprof.timed('similar')
+def hash_src_images(records):
+    return similar.hash_paths([record.src_path for record in records if record.isimage and img_phash.hashable(record.src_path)])
+
+# an image at destination, or planned to be copied there, that looks the same and has at least as many pixels;
+# a larger image is copied even when a smaller one is there already
+def find_similar_at_dst(hashes):
+    for distance, path in similar.find(hashes):
+        if similar.hashes[path].pixels >= hashes.pixels:
+            return path, distance
+    return None, None
+
+# destinations and duplicates are decided here in order, the copies run in the threads of copier
+def copy_from_src_to_dst(files_at_scr, files_at_dst, dst_dir, jobs=1):
+    global copier, skipped
+
+    copier = mycopy.CopyPipeline(copy_threads, copy_inflight_mb * 2**20, copy_inflight_files, link_mode, on_done=copy_done)
+    try:
+        for batch in iter_record_batches(iter_src_records(files_at_scr, jobs), GEO_BATCH_SIZE):
+            locations = resolve_locations(batch)
+            image_hashes = hash_src_images(batch) if similar else None
+            for record in batch:
+                with myprof.timer('decide', record.src_path):
+                    _, skip_record = copy_src_record(record, locations, files_at_dst, dst_dir, image_hashes)
+                skipped += skip_record
+                if progress:
+                    progress.file_done()
+                    progress.count('duplicates', skip_record)
+        copier.finish()
+    finally:
+        copier.close()
+        add_stage_stats('copy', 0, copier.elapsed)
+
+def copy_done(src_path, dst_path, size, method):
+    global copied
+    copied += 1
+    if manifest:
+        manifest.add(dst_path)
+    if journal:
+        journal.complete(src_path, dst_path)
+    copy_methods[method] = copy_methods.get(method, 0) + 1
+    add_stage_stats('copy', 1, 0, size)
+    if progress:
+        progress.count('copied')
+        progress.add_bytes(size)
+    if sampled(src_path, log_every):
+        logger.info(f"copied from {src_path} to {dst_path} with {method}")
+
+# returns the numbers of scheduled and skipped files, 1 and 0 or 0 and 1;
+# a scheduled copy is counted by copy_done when it completes
+def copy_src_record(record, locations, files_at_dst, dst_dir, image_hashes=None):
+    global skipped_similar
+    src_path = record.src_path
+    add_stage_stats('metadata', 1, record.elapsed)
+    log_file = sampled(src_path, log_every)
+    if log_file:
         logger.info(f"start processing: {src_path}")
-        subdir, file, extension = compute_dst_name(src_path)
-        dst_subdir = os.path.join(dst_dir, subdir)
-        os.makedirs(dst_subdir, exist_ok=True)
-        dst_path = f"{os.path.join(dst_subdir, file)}{extension}"
+    subdir, file, extension = dst_name_from_record(record, locations)
+    dst_subdir = os.path.join(dst_dir, subdir)
+    os.makedirs(dst_subdir, exist_ok=True)
+    dst_path = f"{os.path.join(dst_subdir, file)}{extension}"
+    if log_file:
         logger.info(f"destination path: {dst_path}")
-    
-        if dst_path in files_at_dst:
-            alt_file_num = decide_for_duplicates(src_path, dst_path, extension)
-            if alt_file_num:
-                alt_file = f"{file}-{alt_file_num}"
-                dst_path = f"{os.path.join(dst_subdir, alt_file)}{extension}"
-                logger.info(f"alt destination: {dst_path}")                
-
-        if dst_path not in files_at_dst:
-            shutil.copy2(src_path, dst_path)
-            copied += 1
-            files_at_dst.append(dst_path)
-            logger.info(f"copied from {src_path} to {dst_path}")
-        else:
-            skipped += 1
+
+    src_hash = None
+    sync_with_disk(files_at_dst, dst_path)
+    drop_missing_at_dst(files_at_dst, dst_path)
+    if dst_path in files_at_dst:
+        alt_file_num, src_hash = decide_for_duplicates(src_path, dst_path, extension, files_at_dst)
+        while alt_file_num and sync_with_disk(files_at_dst, alt_dst_path(dst_subdir, file, alt_file_num, extension)):
+            alt_file_num, src_hash = decide_for_duplicates(src_path, dst_path, extension, files_at_dst)
+        if alt_file_num:
+            dst_path = alt_dst_path(dst_subdir, file, alt_file_num, extension)
+            if log_file:
+                logger.info(f"alt destination: {dst_path}")
+
+    hashes = image_hashes.get(src_path) if image_hashes else None
+    if hashes and dst_path not in files_at_dst:
+        same_image, distance = find_similar_at_dst(hashes)
+        if same_image:
+            if log_file:
+                logger.info(f"skipped as similar to {same_image}, {distance} bits apart")
+            if journal:
+                journal.skip(src_path)
+            skipped_similar += 1
+            return 0, 1
+
+    if dst_path not in files_at_dst:
+        if journal:
+            journal.plan(src_path, dst_path)
+        copier.submit(src_path, dst_path)
+        files_at_dst.add(dst_path, src_hash)
+        if hashes:
+            similar.add(dst_path, hashes)
+        return 1, 0
+    else:
+        if log_file:
             logger.info(f"skipped as duplicate")
+        if journal:
+            journal.skip(src_path)
+        return 0, 1
+
+def alt_dst_path(dst_subdir, file, alt_file_num, extension):
+    return f"{os.path.join(dst_subdir, f'{file}-{alt_file_num}')}{extension}"
+
+# An archive is read twice: its members are hashed and decided in batches, like the files on disk,
+# then only the ones to copy are read again and written to destination; duplicates are never written
+def copy_from_archives(archives, files_at_dst, dst_dir):
+    global skipped
+    for archive_num, archive in enumerate(archives, 1):
+        logger.info(f"start streaming archive: {archive}")
+        to_copy = {}
+        for batch in iter_record_batches(iter_archive_records(archive), GEO_BATCH_SIZE):
+            locations = resolve_locations([record for record, _ in batch])
+            for record, contents in batch:
+                with myprof.timer('decide', record.src_path):
+                    dst_path = decide_archive_member(record, contents, locations, files_at_dst, dst_dir)
+                if dst_path:
+                    to_copy[record.src_path] = (dst_path, contents)
+                else:
+                    skipped += 1
+                if progress:
+                    progress.file_done()
+                    progress.count('duplicates', 0 if dst_path else 1)
+        # files inside streamed archives are counted while they are read, the last archive makes the total final
+        if progress and archive_num == len(archives):
+            progress.set_total(progress.total, final=True)
+        if to_copy:
+            logger.info(f"writing {len(to_copy)} files of {archive} to destination")
+            for member in myarchive.iter_archive_members(archive, wanted=set(to_copy)):
+                dst_path, contents = to_copy.pop(member.path)
+                with myprof.timer('archive_member', member.path):
+                    copy_archive_member(member, dst_path, contents, files_at_dst)
+        for src_path, (dst_path, _) in to_copy.items():
+            logger.error(f"{src_path} is gone from {archive}, not copied to {dst_path}")
+            archive_pending.discard(dst_path)
+            files_at_dst.remove(dst_path)
+
+# the record of every member and its contents, read once without writing them; members finished by a resumed run are left out
+def iter_archive_records(archive):
+    global num_files_at_src, resumed
+    for member in myarchive.iter_archive_members(archive):
+        num_files_at_src += 1
+        if journal and journal.finished(member.path):
+            resumed += 1
             continue
-        
-    return copied, skipped
+        with myprof.timer('archive_member', member.path):
+            yield extract_archive_record(member)
+
+def extract_archive_record(member):
+    start = time.perf_counter()
+    header = member.fileobj.read(img_fastexif.HEADER_SIZE)
+    filetype = myfiletype.classify_bytes(header, member.name)
+    name, extension = os.path.splitext(member.name)
+    record = SrcRecord(member.path, SUBDIR_OTHER, name, extension.lower(), False, None, None, 0.0)
+    if filetype.kind == myfiletype.KIND_IMAGE:
+        year_taken, date_taken, lat, lon = img.get_image_raw_metadata_from_bytes(member.name, header, filetype, member.mtime)
+        record = record._replace(subdir=str(year_taken), name=date_taken, isimage=True, lat=lat, lon=lon)
+    src_hash, size = myfile.hash_stream(member.fileobj, header, hash_algorithm)
+    add_stage_stats('metadata', 1, time.perf_counter() - start)
+    return record, MemberContents(src_hash, size, member.mtime)
+
+# returns the destination of the member, or None when its contents are already at destination;
+# the destination is taken in files_at_dst until the member is written there
+def decide_archive_member(record, contents, locations, files_at_dst, dst_dir):
+    log_file = sampled(record.src_path, log_every)
+    if log_file:
+        logger.info(f"start processing: {record.src_path}")
+    subdir, file, extension = dst_name_from_record(record, locations)
+    dst_subdir = os.path.join(dst_dir, subdir)
+    dst_path = f"{os.path.join(dst_subdir, file)}{extension}"
+    if log_file:
+        logger.info(f"destination path: {dst_path}")
+
+    sync_with_disk(files_at_dst, dst_path)
+    drop_missing_at_dst(files_at_dst, dst_path)
+    if dst_path in files_at_dst:
+        same_file = files_at_dst.find_same_contents(dst_path, contents.hash)
+        while not same_file and sync_with_disk(files_at_dst, alt_dst_path(dst_subdir, file, files_at_dst.next_suffix(dst_path), extension)):
+            same_file = files_at_dst.find_same_contents(dst_path, contents.hash)
+        if same_file:
+            if log_file:
+                logger.info(f"skipped as duplicate of {same_file}")
+            if journal:
+                journal.skip(record.src_path)
+            return None
+        dst_path = alt_dst_path(dst_subdir, file, files_at_dst.next_suffix(dst_path), extension)
+        if log_file:
+            logger.info(f"alt destination: {dst_path}")
+
+    files_at_dst.add(dst_path, contents.hash)
+    archive_pending.add(dst_path)
+    return dst_path
+
+# the member is written next to its destination, then renamed to its final name
+def copy_archive_member(member, dst_path, contents, files_at_dst):
+    global copied
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    part_path = f"{dst_path}.part"
+    if journal:
+        journal.plan(member.path, part_path)
+    src_hash, size = myfile.copy_stream_hashed(member.fileobj, part_path, algorithm=hash_algorithm)
+    if src_hash != contents.hash:
+        logger.warning(f"{member.path} changed since it was hashed, keeping it under {dst_path} with its new contents")
+        files_at_dst.remove(dst_path)
+        files_at_dst.add(dst_path, src_hash)
+    if contents.mtime:
+        mtime = contents.mtime.timestamp()
+        os.utime(part_path, (mtime, mtime))
+    os.replace(part_path, dst_path)
+    archive_pending.discard(dst_path)
+    copied += 1
+    add_stage_stats('copy', 1, time.perf_counter() - start, size)
+    if progress:
+        progress.count('copied')
+        progress.add_bytes(size)
+    if manifest:
+        manifest.add(dst_path, src_hash)
+    if journal:
+        journal.complete(member.path, dst_path)
+    if sampled(member.path, log_every):
+        logger.info(f"copied from {member.path} to {dst_path}")
+
+# a copy planned by an interrupted run may be missing, complete, or partly written;
+# complete ones are journaled as done, partly written ones are removed and copied again.
+# Planned destinations did not exist when planned, so only files of the interrupted run are removed.
+def verify_unfinished(journal):
+    verified = removed = 0
+    for src_path, dst_path in journal.unfinished().items():
+        if not os.path.exists(dst_path):
+            continue
+        if (not dst_path.endswith('.part') and os.path.exists(src_path)
+                and os.path.getsize(src_path) == os.path.getsize(dst_path)
+                and myfile.get_hash_from_contents(src_path, hash_algorithm) == myfile.get_hash_from_contents(dst_path, hash_algorithm)):
+            logger.info(f"verified complete copy from {src_path} to {dst_path}")
+            journal.complete(src_path, dst_path)
+            verified += 1
+        else:
+            logger.info(f"removing partly written {dst_path}")
+            os.remove(dst_path)
+            if manifest:
+                manifest.remove(dst_path)
+            removed += 1
+    return verified, removed
 
 def compute_dst_name(src_path):
+    return dst_name_from_record(extract_src_record(src_path))
+
+# runs in worker processes with --jobs, so it must not use the geolocation cache;
+# timed in the main process only, init_worker turns the profiler off in workers, whose records bring back their elapsed time
+@myprof.timed('metadata', path_arg=0)
+def extract_src_record(src_path, filetype=None):
+    start = time.perf_counter()
     scr_basename = os.path.basename(src_path)
     src_filename, src_extension = os.path.splitext(scr_basename)
 
-    dst_filename = src_filename
-    dst_extension = src_extension.lower()
-    dst_subdir = SUBDIR_OTHER
-    if img.isimage(src_path) :
-        year_taken, date_taken, loc_taken = img.get_image_metadata(src_path, geocache)
-        dst_subdir = str(year_taken)
-        dst_filename = f"{date_taken}_{loc_taken}"
+    name = src_filename
+    subdir = SUBDIR_OTHER
+    if filetype is None:
+        filetype = myfiletype.classify(src_path)
+    isimage = filetype.kind == myfiletype.KIND_IMAGE
+    lat = lon = None
+    if isimage :
+        year_taken, date_taken, lat, lon = img.get_image_raw_metadata(src_path, filetype)
+        subdir = str(year_taken)
+        name = date_taken
+
+    return SrcRecord(src_path, subdir, name, src_extension.lower(), isimage, lat, lon, time.perf_counter() - start)
+
+def dst_name_from_record(record, locations=None):
+    dst_filename = record.name
+    dst_extension = record.extension
+    dst_subdir = record.subdir
+    if record.isimage :
+        loc_taken = NO_LOC
+        if record.lat and record.lon:
+            if locations is not None:
+                loc_taken = locations[(record.lat, record.lon)]
+            else:
+                loc_taken = geocache.get_location_name((record.lat, record.lon))
+        dst_filename = f"{record.name}_{loc_taken}"
 
     logger.debug(f"\ndst_subdir={dst_subdir} of type {type(dst_subdir)} \
                 \ndst_filename={dst_filename} of type {type(dst_filename)}\
@@ -160,6 +620,211 @@ if __name__ == "__main__":
         action='store_true', 
         help="Keep the temporary directory after processing")
     
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type = int,
+        metavar = 'N',
+        default = 1,
+        help = "Number of processes extracting image metadata, 0 for one per CPU (default: 1)")
+    
+    parser.add_argument(
+        '--index',
+        type = str,
+        metavar = 'FILE',
+        default = DEFAULT_INDEX_FILE,
+        help = f"Metadata index of already processed files (default: {DEFAULT_INDEX_FILE})")
+    
+    parser.add_argument(
+        '--no-index',
+        action = 'store_true',
+        help = "Do not use the metadata index, extract metadata and hashes from every file")
+    
+    parser.add_argument(
+        '--rebuild-index',
+        action = 'store_true',
+        help = "Drop all the entries of the metadata index before processing")
+    
+    parser.add_argument(
+        '--hash',
+        type = str,
+        choices = myfile.HASH_ALGORITHMS,
+        default = myfile.DEFAULT_HASH_ALGORITHM,
+        help = f"Algorithm used to compare file contents (default: {myfile.DEFAULT_HASH_ALGORITHM})")
+    
+    parser.add_argument(
+        '--rg-tree',
+        type = str,
+        metavar = 'FILE',
+        default = DEFAULT_RG_TREE,
+        help = f"Prebuilt reverse geocoder, created on first use, empty to not save it (default: {DEFAULT_RG_TREE})")
+    
+    parser.add_argument(
+        '--dups-report',
+        type = str,
+        metavar = 'FILE',
+        help = "Write groups of identical files found at source to a json file")
+    
+    parser.add_argument(
+        '--similar-report',
+        type = str,
+        metavar = 'FILE',
+        help = "Write groups of images at source that look the same, e.g. resized or re-encoded copies, to a json file")
+    
+    parser.add_argument(
+        '--skip-similar',
+        type = int,
+        metavar = 'DISTANCE',
+        nargs = '?',
+        const = mysimilar.DEFAULT_MAX_DISTANCE,
+        help = f"Skip images that look the same as an image at destination with at least as many pixels, e.g. resized re-sends or re-encoded exports; DISTANCE is the number of bits of 64 their perceptual hashes may differ in (default when given: {mysimilar.DEFAULT_MAX_DISTANCE})")
+    
+    parser.add_argument(
+        '--geocache',
+        type = str,
+        metavar = 'FILE',
+        default = DEFAULT_GEO_CACHE,
+        help = f"Geolocation cache, json or SQLite when ending with .db (default: {DEFAULT_GEO_CACHE})")
+    
+    parser.add_argument(
+        '--geocache-radius',
+        type = float,
+        metavar = 'KM',
+        nargs = '?',
+        const = DEFAULT_RADIUS_KM,
+        help = f"Reuse the nearest cached place within KM kilometers (default when given: {DEFAULT_RADIUS_KM})")
+    
+    parser.add_argument(
+        '--stream-archives',
+        action = 'store_true',
+        help = "Read files straight from zip and tar archives at source instead of extracting them to temporary folders")
+    
+    parser.add_argument(
+        '--link-mode',
+        type = str,
+        choices = mycopy.LINK_MODES,
+        default = mycopy.DEFAULT_LINK_MODE,
+        help = f"How files are copied: auto clones blocks where the file system allows, copy always writes the bytes, "
+               f"hardlink links files on the same volume instead of copying them (default: {mycopy.DEFAULT_LINK_MODE})")
+    
+    parser.add_argument(
+        '--copy-threads',
+        type = int,
+        metavar = 'N',
+        default = mycopy.DEFAULT_COPY_THREADS,
+        help = f"Number of threads copying files (default: {mycopy.DEFAULT_COPY_THREADS})")
+    
+    parser.add_argument(
+        '--copy-inflight-mb',
+        type = int,
+        metavar = 'MB',
+        default = mycopy.DEFAULT_INFLIGHT_MB,
+        help = f"Megabytes of files being copied at once (default: {mycopy.DEFAULT_INFLIGHT_MB})")
+    
+    parser.add_argument(
+        '--copy-inflight-files',
+        type = int,
+        metavar = 'N',
+        default = mycopy.DEFAULT_INFLIGHT_FILES,
+        help = f"Number of files being copied at once (default: {mycopy.DEFAULT_INFLIGHT_FILES})")
+    
+    parser.add_argument(
+        '--journal',
+        type = str,
+        metavar = 'FILE',
+        help = f"Journal of planned and completed copies, started anew unless resuming (default: a file in {DEFAULT_JOURNAL_DIR}/ named after SRC and DST)")
+    
+    parser.add_argument(
+        '--resume',
+        action = 'store_true',
+        help = "Continue an interrupted run: skip the files its journal lists as done, verify the ones it was copying")
+    
+    parser.add_argument(
+        '--manifest',
+        type = str,
+        metavar = 'FILE',
+        help = f"Manifest of the files at destination (default: {DEFAULT_MANIFEST_NAME} in DST)")
+    
+    parser.add_argument(
+        '--verify-dst',
+        action = 'store_true',
+        help = "Walk the destination before and after the run and bring the manifest up to date")
+    
+    parser.add_argument(
+        '--walk-threads',
+        type = int,
+        metavar = 'N',
+        default = myfile.DEFAULT_WALK_THREADS,
+        help = f"Number of threads listing folders at source and destination, 1 to list one at a time (default: {myfile.DEFAULT_WALK_THREADS})")
+    
+    parser.add_argument(
+        '--include',
+        type = str,
+        metavar = 'GLOB',
+        action = 'append',
+        help = "Process only source files with names matching GLOB, e.g. '*.jpg'; can be repeated")
+    
+    parser.add_argument(
+        '--exclude',
+        type = str,
+        metavar = 'GLOB',
+        action = 'append',
+        help = "Skip source files and folders with names matching GLOB, e.g. '.thumbnails'; can be repeated")
+    
+    parser.add_argument(
+        '--dateparser',
+        action = 'store_true',
+        help = "Try the dateparser package on file names with no recognizable date, slow")
+    
+    parser.add_argument(
+        '--log-every',
+        type = int,
+        metavar = 'N',
+        default = 1,
+        help = "Log the progress of about one source file in N, warnings and errors are always logged (default: 1)")
+    
+    parser.add_argument(
+        '--log-queue',
+        action = 'store_true',
+        help = "Write log lines from a background thread instead of the threads processing files")
+    
+    parser.add_argument(
+        '--no-progress',
+        action = 'store_true',
+        help = "Do not show the status line with files/s, MB/s, duplicates, errors, hit rates and ETA, shown only on a terminal")
+    
+    parser.add_argument(
+        '--metrics',
+        type = str,
+        metavar = 'FILE',
+        help = "Rewrite FILE with the progress counters in the Prometheus text format, e.g. for the textfile collector of node_exporter")
+    
+    parser.add_argument(
+        '--metrics-interval',
+        type = float,
+        metavar = 'SECONDS',
+        default = DEFAULT_METRICS_INTERVAL,
+        help = f"Seconds between rewrites of the --metrics file (default: {DEFAULT_METRICS_INTERVAL:g})")
+    
+    parser.add_argument(
+        '--profile',
+        type = str,
+        metavar = 'FILE',
+        nargs = '?',
+        const = DEFAULT_PROFILE_FILE,
+        help = f"Time stages, functions and files, and write a json report to FILE and collapsed stacks for flame graphs next to it (default when given: {DEFAULT_PROFILE_FILE})")
+    
+    parser.add_argument(
+        '--profile-stage',
+        type = str,
+        metavar = 'NAME',
+        help = "Run cProfile while the timer NAME runs in the main process, e.g. metadata, exif or decide; implies --profile")
+    
+    parser.add_argument(
+        '--profile-memory',
+        action = 'store_true',
+        help = "Trace memory allocations with tracemalloc, only in the --profile-stage timer when given; implies --profile")
+    
     parser.add_argument(
         '--debug', 
         action='store_true', 
@@ -169,65 +834,151 @@ if __name__ == "__main__":
 
     if args.debug:
         loglevel = logging.DEBUG
-    setup_logging(f"{program_name}.log", log_level=loglevel, shutup_modules=shutup_modules)
+    setup_logging(f"{program_name}.log", log_level=loglevel, shutup_modules=shutup_modules, queued=args.log_queue)
 
     src = os.path.abspath(args.src)
     dst = os.path.abspath(args.dst)
     keep_temp = args.keep_temp
-    logger.info(f"Called to sort through files in {src}: dst = {dst}; keep_temp = {keep_temp}")
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    hash_algorithm = args.hash
+    link_mode = args.link_mode
+    copy_threads = max(args.copy_threads, 1)
+    copy_inflight_mb = args.copy_inflight_mb
+    copy_inflight_files = max(args.copy_inflight_files, 1)
+    walk_threads = max(args.walk_threads, 1)
+    log_every = args.log_every
+    mydate.use_dateparser = args.dateparser
+    logger.info(f"Called to sort through files in {src}: dst = {dst}; keep_temp = {keep_temp}; jobs = {jobs}")
+    profile_file = args.profile or (DEFAULT_PROFILE_FILE if args.profile_stage or args.profile_memory else None)
+    if profile_file:
+        myprof.start(args.profile_stage, cprofile=bool(args.profile_stage), memory=args.profile_memory)
     os.makedirs(dst, exist_ok=True)
     #non_img_subfolder = f"{dst}{os.sep}Other"
     #os.makedirs(non_img_subfolder, exist_ok=True)
     
-    files_at_src = []
-    tempdirs_for_src = []
-    start = time.time()
-    myfile.all_files_at_path(src, files_at_src, tempdirs_for_src)
-    num_files_at_src = len(files_at_src)
-    num_temp_dirs = len(tempdirs_for_src)
-    end = time.time()
-    logger.info(f"Collected {num_files_at_src} files at source while opening {num_temp_dirs} archives in {(end-start):.2f} seconds")
-    #logger.debug(f"files_at_scr={files_at_src}, tempdirs_for_src={tempdirs_for_src}")
+    manifest = DestinationManifest(dst, args.manifest)
+    # partly written files of an interrupted run are removed before the destination is collected
+    try:
+        journal = Journal(args.journal, src, dst, resume=args.resume)
+    except ValueError as e:
+        logger.error(f"Can not resume: {e}")
+        sys.exit(1)
+    if args.resume:
+        verified, removed = verify_unfinished(journal)
+        logger.info(f"Resuming with {verified} verified and {removed} partly written files removed")
 
-    files_at_dst = []
-    tempdirs_for_dst = []
+    # the destination is walked only for a new manifest or with --verify-dst
     start = time.time()
-    myfile.all_files_at_path(dst, files_at_dst, tempdirs_for_dst)
+    # archives at destination are files like any other, the files inside them are not compared with source files
+    with myprof.timer('collect_dst'):
+        if manifest.is_new or args.verify_dst:
+            manifest.sync(myfile.iter_files(dst, threads=walk_threads))
+        files_at_dst = DestinationIndex(hash_func=get_dst_hash)
+        for dst_path, dst_hash in manifest.items():
+            if dst_hash and myfile.hash_algorithm_of(dst_hash) != hash_algorithm:
+                dst_hash = None
+            files_at_dst.add(dst_path, dst_hash)
     dst_files_before = len(files_at_dst)
-    num_dst_archives = len(tempdirs_for_dst)
     end = time.time()
-    logger.info(f"Collected {dst_files_before} files at destination while opening {num_dst_archives} archives in {(end-start):.2f} seconds")
-    #logger.debug(f"files_at_dst={files_at_dst}, tempdirs_for_dst={tempdirs_for_dst}")
-    if num_dst_archives :
-        logger.warning(f"Archived files at destination may result in duplicates")
+    logger.info(f"Collected {dst_files_before} files at destination in {(end-start):.2f} seconds")
          
-    geocache = GeolocationCache()
+    geocache = GeolocationCache(args.geocache, radius_km=args.geocache_radius, rg_tree_file=args.rg_tree)
     locations = geocache.get_size()
     logger.info(f"Initialized geolocation cache with {locations} entries")
+    if not args.no_index:
+        mdindex = MetadataIndex(args.index, rebuild=args.rebuild_index, hash_algorithm=hash_algorithm)
+
+    # every image at destination is decoded once, its hashes are kept in the metadata index
+    if args.skip_similar is not None:
+        start = time.time()
+        similar = mysimilar.SimilarImages(args.skip_similar, mdindex)
+        with myprof.timer('similar_dst'):
+            similar.add_paths([path for path in files_at_dst if img_phash.hashable(path)])
+        logger.info(f"Hashed {len(similar)} images at destination in {(time.time()-start):.2f} seconds, "
+                    f"{similar.decoded} decoded and {similar.from_index} found in the index")
+
+    tempdirs_for_src = []
+    archives_at_src = [] if args.stream_archives else None
+    files_at_src = iter_src_files(src, tempdirs_for_src, archives_at_src, args.include, args.exclude, args.resume)
+    if args.dups_report:
+        # the report needs all the files at once
+        files_at_src = list(files_at_src)
+        with myprof.timer('dups_report'):
+            duplicates, stats = mydups.find_duplicates(files_at_src, hash_algorithm, hash_func=get_hash)
+        with open(args.dups_report, 'w', encoding='utf-8') as f:
+            json.dump(duplicates, f, ensure_ascii=False, indent=4)
+        logger.info(f"Saved {len(duplicates)} groups of identical files at source to {args.dups_report}")
+    if args.similar_report:
+        files_at_src = list(files_at_src)
+        with myprof.timer('similar_report'):
+            similar_groups, _ = mysimilar.find_similar(files_at_src, args.skip_similar or mysimilar.DEFAULT_MAX_DISTANCE, mdindex)
+        with open(args.similar_report, 'w', encoding='utf-8') as f:
+            json.dump(similar_groups, f, ensure_ascii=False, indent=4)
+        logger.info(f"Saved {len(similar_groups)} groups of similar images at source to {args.similar_report}")
+
+    if not args.no_progress or args.metrics:
+        progress = Progress(program_name, status=not args.no_progress, metrics_file=args.metrics, metrics_interval=args.metrics_interval)
+        progress.counter('copied', "Files copied to destination")
+        progress.counter('duplicates', "Files skipped as duplicates of files at destination")
+        progress.set_total(lambda: num_files_at_src - resumed)
+        progress.gauge('geocache_hit_ratio', lambda: hit_ratio(geocache, ('hits', 'near_hits')),
+                       "Share of GPS points found in the geolocation cache", 'geo')
+        progress.gauge('index_hit_ratio', lambda: hit_ratio(mdindex),
+                       "Share of source files whose metadata was found in the metadata index", 'index')
+        progress.gauge('index_hash_hit_ratio', lambda: hit_ratio(mdindex, ('hash_hits',), ('hash_misses',)),
+                       "Share of content hashes found in the metadata index")
+        progress.gauge('index_image_hash_hit_ratio', lambda: hit_ratio(mdindex, ('image_hash_hits',), ('image_hash_misses',)),
+                       "Share of perceptual hashes found in the metadata index")
+        progress.gauge('copy_pending_files', lambda: len(copier.pending) if copier else None,
+                       "Copies submitted and not finished", 'queue', '{}')
+        progress.gauge('copy_pending_bytes', lambda: copier.inflight_bytes if copier else None,
+                       "Bytes of the copies submitted and not finished")
+        progress.start()
 
     start = time.time()
-    logger.info(f"STARTED with {num_files_at_src} files at source and {dst_files_before} files at destination")
+    logger.info(f"STARTED with {dst_files_before} files at destination, walking {src} while processing")
     try:
-        copied, skipped = copy_from_src_to_dst(files_at_src, files_at_dst, dst)
+        copy_from_src_to_dst(files_at_src, files_at_dst, dst, jobs=jobs)
+        if archives_at_src:
+            logger.info(f"Collected {len(archives_at_src)} archives at source to stream")
+            copy_from_archives(archives_at_src, files_at_dst, dst)
     except Exception as e:
         logger.error(f"SOMETHING WENT WRONG: {e}", exc_info=1)
+        logger.error(f"Run again with --resume to continue from {journal.journal_file}")
+    finally:
+        if progress:
+            progress.close()
+        geocache.flush()
+        if mdindex:
+            mdindex.close()
+        journal.close()
+        manifest.close()
     end = time.time()
     dst_files_after1 = len(files_at_dst)
     logger.info(f"COMPLETED in {(end-start):.2f} seconds with {dst_files_after1} files at destination")
-    files_at_dst = []
-    myfile.all_files_at_path(dst, files_at_dst, [])
-    dst_files_after2 = len(files_at_dst)
+    if args.verify_dst:
+        manifest_name = os.path.basename(manifest.manifest_file)
+        dst_files_after2 = sum(1 for record in myfile.iter_files(dst, threads=walk_threads) if not os.path.basename(record.path).startswith(manifest_name))
+    else:
+        dst_files_after2 = "not checked, use --verify-dst"
     logger.info(f"\nSUMMARY: \
                 \nSRC-check: \
                 \n\tTotal files                 : {num_files_at_src} \
                 \n\tCopied files                : {copied} \
                 \n\tSkipped files               : {skipped} \
-                \n\tCopied + Skipped files      : {copied + skipped} \
+                \n\tSkipped as similar          : {skipped_similar} \
+                \n\tResumed files               : {resumed} \
+                \n\tCopied + Skipped + Resumed  : {copied + skipped + resumed} \
                 \nDST-check: \
                 \n\tBefore                      : {dst_files_before} \
                 \n\tAfter (internal counter)    : {dst_files_after1} \
                 \n\tAfter (before plus copied)  : {dst_files_before+copied} \
                 \n\tAfter (real)                : {dst_files_after2} \
-                \nAdded {geocache.get_size()-locations} places to the geolocations cache.")
+                \nAdded {geocache.get_size()-locations} places to the geolocations cache. \
+                \nCopy methods: {copy_methods} \
+                \nSTAGES: {stage_stats_summary(end-start, jobs)}")
+    if profile_file:
+        report = myprof.stop(profile_file)
+        logger.info(f"PROFILE written to {profile_file}:{myprof.report_summary(report)}")
     if keep_temp:
         logger.info(f"List of preserved temporary folders:\n{tempdirs_for_src}")
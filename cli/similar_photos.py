@@ -0,0 +1,99 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import modules.shared.myfile as myfile
+import modules.shared.mysimilar as mysimilar
+import modules.img.img_phash as img_phash
+from modules.shared.myindex import MetadataIndex, DEFAULT_INDEX_FILE
+from modules.shared.mylog import setup_logging
+
+# Globals
+program_name = "similar_photos"
+program_abbr = "similar"
+program_description = '''\
+        Find photos that look the same
+        -----------------------------------------------------
+        similar_photos compares the perceptual hashes of the images in <folders>
+        and reports groups of images that look the same although their files differ:
+        resized re-sends, re-encoded exports, lightly edited copies.
+        The largest image of each group comes first.
+        -----------------------------------------------------
+        '''
+logger = logging.getLogger(program_abbr)
+DEFAULT_REPORT_FILE = 'logs/similar_photos.json'
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        prog = program_name,
+        formatter_class = argparse.RawDescriptionHelpFormatter,
+        description = program_description)
+
+    parser.add_argument(
+        'folders',
+        type = str,
+        nargs = '+',
+        metavar = 'FOLDER',
+        help = "Folders to look for images in")
+
+    parser.add_argument(
+        '-o',
+        '--report',
+        type = str,
+        metavar = 'FILE',
+        default = DEFAULT_REPORT_FILE,
+        help = f"Json file to write the groups of similar images to (default: {DEFAULT_REPORT_FILE})")
+
+    parser.add_argument(
+        '--distance',
+        type = int,
+        metavar = 'BITS',
+        default = mysimilar.DEFAULT_MAX_DISTANCE,
+        help = f"Number of bits of 64 the perceptual hashes of similar images may differ in (default: {mysimilar.DEFAULT_MAX_DISTANCE})")
+
+    parser.add_argument(
+        '--index',
+        type = str,
+        metavar = 'FILE',
+        default = DEFAULT_INDEX_FILE,
+        help = f"Metadata index keeping the hashes, shared with photos_organizer1 (default: {DEFAULT_INDEX_FILE})")
+
+    parser.add_argument(
+        '--no-index',
+        action = 'store_true',
+        help = "Do not use the metadata index, decode every image")
+
+    parser.add_argument(
+        '--threads',
+        type = int,
+        metavar = 'N',
+        default = img_phash.DEFAULT_HASH_THREADS,
+        help = f"Threads decoding images (default: {img_phash.DEFAULT_HASH_THREADS})")
+
+    parser.add_argument(
+        '--debug',
+        action = 'store_true',
+        help = "Run with debug logging")
+
+    args = parser.parse_args()
+
+    setup_logging(f"{program_name}.log", log_level=logging.DEBUG if args.debug else logging.INFO)
+
+    start = time.time()
+    mdindex = None if args.no_index else MetadataIndex(args.index)
+    files = [record.path for folder in args.folders for record in myfile.iter_files(os.path.abspath(folder))]
+    try:
+        groups, stats = mysimilar.find_similar(files, args.distance, mdindex, max(args.threads, 1))
+    finally:
+        if mdindex:
+            mdindex.close()
+
+    report_dir = os.path.dirname(args.report)
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(groups, f, ensure_ascii=False, indent=4)
+    logger.info(f"Saved {len(groups)} groups of similar images to {args.report} in {(time.time()-start):.2f} seconds: {stats}")
@@ -1,99 +1,163 @@
-import json
-import os
+import atexit
 import logging
-import requests
-import reverse_geocoder as rg
-import pycountry
 
 DEFAULT_GEO_CACHE = 'data/geoloc_cache.json'
 DEFAULT_PRECISION = 2
+DEFAULT_RADIUS_KM = 1.0
+# new entries are written to the cache file when there are this many of them, or after this many seconds, or at exit
+DEFAULT_FLUSH_EVERY = 100
+DEFAULT_FLUSH_INTERVAL = 30
 logger = logging.getLogger(__name__)
 
 from modules.shared.mylog import setup_logging
+from modules.geoloc.geoloc_store import open_store
+import modules.geoloc.geoloc_rg as geoloc_rg
+import modules.shared.myprof as myprof
+
+# reverse_geocoder and requests are imported on the first cache miss,
+# a run where every location is cached never loads them
 
 def get_place(coordinates):
-    rg_res = rg.search(coordinates)
-    logger.debug(f"get_place for {coordinates}: rg returned {rg_res} [{type(rg_res)}] ")
+    rg_res = geoloc_rg.search([coordinates])
+    logger.debug("get_place for %s: rg returned %s [%s] ", coordinates, rg_res, type(rg_res))
     location_info = rg_res[0]
-    logger.debug(f"get_place: location_info={location_info}")
+    logger.debug("get_place: location_info=%s", location_info)
     country_code = location_info['cc']
     name = location_info['name']
-    logger.debug(f"get_place: name={name}, country_code={country_code}")
+    logger.debug("get_place: name=%s, country_code=%s", name, country_code)
     #country = pycountry.countries.get(alpha_2=country_code)
     #logger.debug(f"get_place: country={country}, type={type(country)}")
     result = f"{country_code}_{name}".replace(" ", "")
     return result
 
 class GeolocationCache:
-    def __init__(self, cache_file=DEFAULT_GEO_CACHE, precision = DEFAULT_PRECISION):
+    # cache_file ending with .db or .sqlite is kept in SQLite, anything else in json;
+    # with radius_km, a miss is answered by the nearest cached place within that radius
+    def __init__(self, cache_file=DEFAULT_GEO_CACHE, precision = DEFAULT_PRECISION,
+                 flush_every = DEFAULT_FLUSH_EVERY, flush_interval = DEFAULT_FLUSH_INTERVAL, radius_km = None,
+                 rg_tree_file = geoloc_rg.DEFAULT_RG_TREE):
         self.cache_file = cache_file
+        self.rg_tree_file = rg_tree_file
         self.precision = precision
-        self.cache = self._load_cache()
-        logger.info(f"Geocache loaded from {self.cache_file} with {len(self.cache)} entries")
-    
-    def _load_cache(self):
-        if os.path.exists(self.cache_file):
-            with open(self.cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
-    
-    def _save_cache(self):
-        with open(self.cache_file, 'w', encoding='utf-8') as f:
-            json.dump(self.cache, f, ensure_ascii=False, indent=4)
+        self.radius_km = radius_km
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.store = open_store(cache_file, flush_every, flush_interval)
+        atexit.register(self.flush)
+        logger.info(f"Geocache loaded from {self.cache_file} with {len(self.store)} entries")
+
+    def flush(self):
+        self.store.flush()
 
     def get_size(self):
-        return len(self.cache)
+        return len(self.store)
+
+    def _rounded(self, location):
+        return round(location[0],self.precision), round(location[1],self.precision)
+
+    def _lookup(self, point):
+        location_name = self.store.get(point)
+        if location_name:
+            self.hits += 1
+            return location_name
+        if self.radius_km:
+            location_name = self.store.nearest(point, self.radius_km)
+            if location_name:
+                self.near_hits += 1
+                logger.debug("Location found near %s: %s", point, location_name)
+                return location_name
+        self.misses += 1
+        return None
+
+    # resolves all the locations with one reverse_geocoder query for all the cache misses,
+    # returns the names in the order of locations
+    def get_location_names(self, locations):
+        points = [self._rounded(location) for location in locations]
+        found = {}
+        misses = {}
+        for point, location in zip(points, locations):
+            if point in found or point in misses:
+                continue
+            location_name = self._lookup(point)
+            if location_name:
+                found[point] = location_name
+            else:
+                misses[point] = location
+        logger.info(f"Retrieving {len(locations)} locations with {len(misses)} cache misses")
+
+        if misses:
+            names = [None] * len(misses)
+            try:
+                names = self._fetch_locations_from_rg(list(misses.values()))
+            except Exception as e:
+                logger.error(f"Offline name resolution failed: {e}")
+            for (point, location), location_name in zip(misses.items(), names):
+                if not location_name:
+                    try:
+                        location_name = self._fetch_location_from_api(location)
+                        logger.debug("Location received from API: %s", location_name)
+                    except Exception as e:
+                        logging.error(f"Fetching location name from API failed: {e}")
+                if location_name:
+                    self.store.put(point, location_name)
+                    found[point] = location_name
+
+        return [found.get(point) for point in points]
 
     def get_location_name(self, location):
-        location_name = None
-        cache_key = f"{round(location[0],self.precision)},{round(location[1],self.precision)}"
-        logger.info(f"Retrieving location for {cache_key}")
+        point = self._rounded(location)
+        logger.info(f"Retrieving location for {point}")
 
-        if cache_key in self.cache:
-            location_name = self.cache[cache_key]
-            logger.debug(f"Location found in cache: {location_name}")
+        location_name = self._lookup(point)
+        if location_name:
+            logger.debug("Location found in cache: %s", location_name)
         else:
             try:
                 location_name = self._fetch_location_from_rg(location)
-                logger.debug(f"Location found by rg: {location_name}")
+                logger.debug("Location found by rg: %s", location_name)
             except Exception as e:
                 logger.error(f"Offline name resolution failed: {e}")           
                 try:
                     location_name = self._fetch_location_from_api(location)
-                    logger.debug(f"Location received from API: {location_name}")
+                    logger.debug("Location received from API: %s", location_name)
                 except Exception as e:
                     logging.error(f"Fetching location name from API failed: {e}")
             if location_name:
-                self.cache[cache_key] = location_name
-                self._save_cache()
+                self.store.put(point, location_name)
         
         return location_name
     
     def _fetch_location_from_rg(self, location):
-        location_info = None
         result = None
         
-        rg_res = rg.search(location)
+        rg_res = geoloc_rg.search([location], self.rg_tree_file)
         if rg_res:
             results = len(rg_res)
-            logger.debug(f"rg returned {results} results: {rg_res}")
-            if results:
-                location_info = rg_res[0]
-                logger.debug(f"location_info={location_info}")
-            country_code = location_info['cc']
-            place_name = location_info['name']
-            logger.debug(f"name={place_name}, country_code={country_code}")
-            country = pycountry.countries.get(alpha_2=country_code)
-            country_name = country.name
-            logger.debug(f"pycountry: country={country}, country_name={country_name}")
-            result = f"{country_code}_{place_name}".replace(" ", "")
+            logger.debug("rg returned %s results: %s", results, rg_res)
+            result = self._location_name_from_rg(rg_res[0])
 
         if not result:
             raise Exception("Location not found by rg")
         
         return result
 
+    # one KD-tree query for all the locations
+    def _fetch_locations_from_rg(self, locations):
+        rg_res = geoloc_rg.search(locations, self.rg_tree_file)
+        logger.debug("rg returned %s results for %s locations", len(rg_res), len(locations))
+        return [self._location_name_from_rg(location_info) for location_info in rg_res]
+
+    def _location_name_from_rg(self, location_info):
+        logger.debug("location_info=%s", location_info)
+        country_code = location_info['cc']
+        place_name = location_info['name']
+        logger.debug("name=%s, country_code=%s", place_name, country_code)
+        return f"{country_code}_{place_name}".replace(" ", "")
+
+    @myprof.timed('geocode_api')
     def _fetch_location_from_api(self, location):
+        import requests
         try:
             url = 'https://nominatim.openstreetmap.org/reverse'
             params = {
@@ -152,3 +216,7 @@ if __name__ == "__main__":
     for dec_gps in test_dec_gps:
         name = test_dec_gps_to_name(geocache, dec_gps)
         logger.info(f"dec_gps={dec_gps},name={name}")
+
+    names = geocache.get_location_names(test_dec_gps)
+    logger.info(f"batch: {list(zip(test_dec_gps, names))}")
+    geocache.flush()
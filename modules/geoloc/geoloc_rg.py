@@ -0,0 +1,86 @@
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+DEFAULT_RG_TREE = 'data/rg_tree.pickle'
+# bump when the pickled contents change, older files are rebuilt
+RG_TREE_VERSION = 2
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+import modules.shared.myprof as myprof
+
+# reverse_geocoder parses its bundled csv and builds a KD-tree on the first search, which takes seconds.
+# The geocoder is created only when a location is really looked up, and the prebuilt one is
+# pickled to tree_file, so later runs load it instead of parsing the csv again.
+# The pickle is a local cache written by this module only; delete it to rebuild.
+_geocoders = {}
+
+# the KD-tree and the places of a reverse_geocoder.RGeocoder in mode 1; RGeocoder itself can not be
+# pickled, the name in its module is the function returning its single instance
+class Geocoder:
+    def __init__(self, tree, locations):
+        self.tree = tree
+        self.locations = locations
+
+    def query(self, coordinates):
+        _, indices = self.tree.query(coordinates, k=1)
+        return [self.locations[index] for index in indices]
+
+def get_geocoder(tree_file=DEFAULT_RG_TREE):
+    geocoder = _geocoders.get(tree_file)
+    if not geocoder:
+        geocoder = _load_geocoder(tree_file)
+        _geocoders[tree_file] = geocoder
+    return geocoder
+
+@myprof.timed('reverse_geocoder')
+def search(locations, tree_file=DEFAULT_RG_TREE):
+    return get_geocoder(tree_file).query([tuple(location) for location in locations])
+
+@myprof.timed('reverse_geocoder_load')
+def _load_geocoder(tree_file):
+    start = time.time()
+    if tree_file and os.path.exists(tree_file):
+        try:
+            with open(tree_file, 'rb') as f:
+                version, geocoder = pickle.load(f)
+            if version == RG_TREE_VERSION:
+                logger.info(f"Loaded reverse geocoder from {tree_file} in {(time.time()-start):.2f} seconds")
+                return geocoder
+            logger.info(f"Reverse geocoder in {tree_file} has version {version}, rebuilding")
+        except Exception as e:
+            logger.warning(f"Failed to load reverse geocoder from {tree_file}, rebuilding: {e}")
+
+    import reverse_geocoder as rg
+    # mode=1 queries in this process, the default mode starts a process pool for every query
+    rgeocoder = rg.RGeocoder(mode=1, verbose=False)
+    geocoder = Geocoder(rgeocoder.tree, rgeocoder.locations)
+    logger.info(f"Built reverse geocoder in {(time.time()-start):.2f} seconds")
+    if tree_file:
+        _save_geocoder(geocoder, tree_file)
+    return geocoder
+
+def _save_geocoder(geocoder, tree_file):
+    tree_dir = os.path.dirname(os.path.abspath(tree_file))
+    os.makedirs(tree_dir, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(prefix='.rg_tree_', suffix='.tmp', dir=tree_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((RG_TREE_VERSION, geocoder), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, tree_file)
+        logger.info(f"Saved reverse geocoder to {tree_file}")
+    except Exception as e:
+        os.remove(temp_file)
+        logger.warning(f"Failed to save reverse geocoder to {tree_file}: {e}")
+
+########################################################################
+
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("geoloc_rg")
+
+    locations = [(32.27772778469444,34.86281227866667), (55.75222, 37.61556)]
+    logger.info(f"search {locations}: {search(locations)}")
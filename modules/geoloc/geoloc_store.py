@@ -0,0 +1,184 @@
+import json
+import logging
+import math
+import os
+import sqlite3
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Storage of place names by GPS point. All stores take points already rounded by the cache
+# and answer both exact lookups and "nearest stored point within a radius".
+# JsonStore keeps the original json format in memory; SqliteStore keeps points as integer
+# micro-degrees in a compact table, so memory stays flat however large the cache grows.
+
+KM_PER_DEGREE = 111.2
+# cell size of the in-memory grid of JsonStore
+GRID_CELL_DEGREES = 0.1
+
+def distance_km(point1, point2):
+    # equirectangular approximation, good enough for distances of a few kilometers
+    dlat = point2[0] - point1[0]
+    dlon = (point2[1] - point1[1]) * math.cos(math.radians((point1[0] + point2[0]) / 2))
+    return KM_PER_DEGREE * math.hypot(dlat, dlon)
+
+def bounding_box(point, radius_km):
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(point[0])), 0.01))
+    return point[0] - dlat, point[0] + dlat, point[1] - dlon, point[1] + dlon
+
+def nearest_of(point, candidates, radius_km):
+    result = None
+    best = radius_km
+    for candidate_point, name in candidates:
+        distance = distance_km(point, candidate_point)
+        if distance <= best:
+            best = distance
+            result = name
+    return result
+
+def open_store(cache_file, flush_every, flush_interval):
+    if cache_file.lower().endswith(('.db', '.sqlite')):
+        return SqliteStore(cache_file, flush_every, flush_interval)
+    return JsonStore(cache_file, flush_every, flush_interval)
+
+# new entries are written when there are flush_every of them, after flush_interval seconds, or on flush()
+class WriteBehind:
+    def __init__(self, flush_every, flush_interval):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.dirty = 0
+        self.last_flush = time.monotonic()
+
+    def _mark_dirty(self, entries=1):
+        self.dirty += entries
+        if self.dirty >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.dirty:
+            self._save()
+            logger.debug(f"saved {self.dirty} new entries")
+        self.dirty = 0
+        self.last_flush = time.monotonic()
+
+class JsonStore(WriteBehind):
+    def __init__(self, cache_file, flush_every, flush_interval):
+        super().__init__(flush_every, flush_interval)
+        self.cache_file = cache_file
+        self.cache = self._load()
+        self.grid = None
+
+    def _load(self):
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {}
+
+    # writes a temporary file next to the cache and renames it, so a killed process never leaves a partial cache
+    def _save(self):
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+        fd, temp_file = tempfile.mkstemp(prefix='.geoloc_', suffix='.tmp', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.cache, f, ensure_ascii=False, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.cache_file)
+        except Exception:
+            os.remove(temp_file)
+            raise
+
+    def __len__(self):
+        return len(self.cache)
+
+    def items(self):
+        for key, name in self.cache.items():
+            lat, lon = key.split(',')
+            yield (float(lat), float(lon)), name
+
+    def get(self, point):
+        return self.cache.get(f"{point[0]},{point[1]}")
+
+    def put(self, point, name):
+        self.cache[f"{point[0]},{point[1]}"] = name
+        if self.grid is not None:
+            self._add_to_grid(point, name)
+        self._mark_dirty()
+
+    def _cell(self, point):
+        return int(math.floor(point[0] / GRID_CELL_DEGREES)), int(math.floor(point[1] / GRID_CELL_DEGREES))
+
+    def _add_to_grid(self, point, name):
+        self.grid.setdefault(self._cell(point), []).append((point, name))
+
+    # the grid of the json keys is built on the first spatial lookup
+    def nearest(self, point, radius_km):
+        if self.grid is None:
+            self.grid = {}
+            for stored_point, name in self.items():
+                self._add_to_grid(stored_point, name)
+        min_lat, max_lat, min_lon, max_lon = bounding_box(point, radius_km)
+        min_cell_lat, min_cell_lon = self._cell((min_lat, min_lon))
+        max_cell_lat, max_cell_lon = self._cell((max_lat, max_lon))
+        candidates = []
+        for cell_lat in range(min_cell_lat, max_cell_lat + 1):
+            for cell_lon in range(min_cell_lon, max_cell_lon + 1):
+                candidates.extend(self.grid.get((cell_lat, cell_lon), []))
+        return nearest_of(point, candidates, radius_km)
+
+class SqliteStore(WriteBehind):
+    def __init__(self, cache_file, flush_every, flush_interval):
+        super().__init__(flush_every, flush_interval)
+        self.cache_file = cache_file
+        self.conn = sqlite3.connect(cache_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS places (
+                             lat_e6 INTEGER NOT NULL,
+                             lon_e6 INTEGER NOT NULL,
+                             name TEXT NOT NULL,
+                             PRIMARY KEY (lat_e6, lon_e6)) WITHOUT ROWID''')
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+        # a new database starts with the contents of the json cache of the same name, if there is one
+        json_file = f"{os.path.splitext(cache_file)[0]}.json"
+        if not self.size and os.path.exists(json_file):
+            self.import_json(json_file)
+
+    def import_json(self, json_file):
+        json_store = JsonStore(json_file, 0, 0)
+        for point, name in json_store.items():
+            self.put(point, name)
+        self.flush()
+        logger.info(f"imported {len(json_store)} places from {json_file}")
+
+    def _save(self):
+        self.conn.commit()
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        for lat_e6, lon_e6, name in self.conn.execute("SELECT lat_e6, lon_e6, name FROM places"):
+            yield (lat_e6 / 1e6, lon_e6 / 1e6), name
+
+    def get(self, point):
+        row = self.conn.execute("SELECT name FROM places WHERE lat_e6 = ? AND lon_e6 = ?",
+                                (round(point[0] * 1e6), round(point[1] * 1e6))).fetchone()
+        return row[0] if row else None
+
+    def put(self, point, name):
+        if self.get(point) is None:
+            self.size += 1
+        self.conn.execute("INSERT OR REPLACE INTO places (lat_e6, lon_e6, name) VALUES (?, ?, ?)",
+                          (round(point[0] * 1e6), round(point[1] * 1e6), name))
+        self._mark_dirty()
+
+    def nearest(self, point, radius_km):
+        min_lat, max_lat, min_lon, max_lon = bounding_box(point, radius_km)
+        rows = self.conn.execute('''SELECT lat_e6, lon_e6, name FROM places
+                                    WHERE lat_e6 BETWEEN ? AND ? AND lon_e6 BETWEEN ? AND ?''',
+                                 (math.floor(min_lat * 1e6), math.ceil(max_lat * 1e6),
+                                  math.floor(min_lon * 1e6), math.ceil(max_lon * 1e6)))
+        return nearest_of(point, (((lat_e6 / 1e6, lon_e6 / 1e6), name) for lat_e6, lon_e6, name in rows), radius_km)
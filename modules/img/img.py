@@ -10,7 +10,9 @@ from PIL import Image
 
 import modules.shared.mylog as mylog
 import modules.shared.mydate as mydate
+import modules.shared.myfiletype as myfiletype
 import modules.img.img_exif as img_exif
+import modules.img.img_fastexif as img_fastexif
 import modules.img.img_exifread as img_exifread
 import modules.img.img_png as img_png
 from modules.geoloc.geoloc_cache import GeolocationCache
@@ -23,9 +25,12 @@ NO_LOC = "NoLoc"
 IMG_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp'}
 IMG_TYPE_PNG = 'PNG'
 IMG_TYPE_JPEG = 'JPEG'
-IMG_TYPE_TIF = 'TIF'
+IMG_TYPE_TIF = 'TIFF'
 IMG_TYPE_RAW = 'RAW'
 IMG_TYPE_MPO = 'MPO'
+IMG_TYPE_WEBP = 'WEBP'
+# formats whose EXIF block img_fastexif can read
+FASTEXIF_TYPES = {IMG_TYPE_JPEG, IMG_TYPE_TIF, IMG_TYPE_RAW, IMG_TYPE_WEBP}
 IMG_TYPES = [
     IMG_TYPE_PNG,
     IMG_TYPE_JPEG,
@@ -52,53 +57,94 @@ def isimage_by_pil(file) :
     except Exception as e:
         return False
     
-def isimage(filename):
+def isimage_by_ext(filename):
     return any(filename.lower().endswith(ext) for ext in IMG_EXTENSIONS)
+
+def isimage(filename, filetype=None):
+    if not filetype:
+        filetype = myfiletype.classify(filename)
+    return filetype.kind == myfiletype.KIND_IMAGE
  
 def get_img_type(file):
-    try:
-        with Image.open(file) as pil:
-            return pil.format
-    except Exception as e:
-        logger.debug(f"failed to open file as image: {e}")
+    filetype = myfiletype.classify(file)
+    if filetype.kind != myfiletype.KIND_IMAGE:
+        logger.debug("not an image: %s", filetype)
         return None
+    return filetype.format
     
 earliest_filedate = datetime.strptime("2000-01-01", '%Y-%m-%d')
-def get_image_metadata(image_path, geocache):
+def get_image_metadata(image_path, geocache, filetype=None):
+    year_taken, date_taken, lat, lon = get_image_raw_metadata(image_path, filetype)
+
+    loc_taken = NO_LOC
+    if lat and lon:
+        loc_taken = geocache.get_location_name((lat, lon))
+
+    logger.debug("year_taken=%s, date_taken=%s, loc_taken=%s", year_taken, date_taken, loc_taken)
+    return year_taken, date_taken, loc_taken
+
+# does not touch the geolocation cache, so it is safe to call from worker processes
+def get_image_raw_metadata(image_path, filetype=None):
+    date = None
+    if not filetype:
+        filetype = myfiletype.classify(image_path)
+    img_type = filetype.format
+    logger.debug("get_image_metadata: type=%s", img_type)
+
+    # the fast reader handles files with their EXIF block in the first 64 KiB,
+    # the libraries are used for everything else
+    md = None
+    if img_type in FASTEXIF_TYPES:
+        md = img_fastexif.get_image_metadata(image_path)
+        logger.debug("fast exif metadata :%s", md)
+    if md is None:
+        if img_type == IMG_TYPE_PNG:
+            md = img_png.get_png_metadata(image_path)
+            logger.debug("png metadata :%s", md)
+        else:
+            md = img_exif.get_image_metadata(image_path)
+            logger.debug("exif metadata :%s", md)
+            if not len(md):
+                md = img_exifread.get_image_metadata(image_path)  
+                logger.debug("exifread metadata :%s", md)      
+    if not date_from_md(md):
+        date = mydate.datetime_from_file(image_path, min_date=earliest_filedate, max_date=datetime.now())
+        logger.debug("date from file: %s, type=%s", date, type(date))
+    return raw_metadata(md, date)
+
+# same as get_image_raw_metadata for an image that is not on disk, e.g. a member of an archive:
+# only the fast reader is used on the header bytes, and mtime stands for the file system dates
+def get_image_raw_metadata_from_bytes(name, header, filetype, mtime=None):
+    md = None
+    if filetype.format in FASTEXIF_TYPES:
+        md = img_fastexif.get_metadata_from_bytes(header)
+        logger.debug("fast exif metadata :%s", md)
+    date = None
+    if not date_from_md(md):
+        date = mydate.datetime_from_name(name, mtime, min_date=earliest_filedate, max_date=datetime.now())
+        logger.debug("date from name: %s, type=%s", date, type(date))
+    return raw_metadata(md, date)
+
+# img_png returns xml or None rather than a dictionary
+def date_from_md(md):
+    return md.get('datetime') if isinstance(md, dict) else None
+
+def raw_metadata(md, date=None):
     year_taken = NO_YEAR
     date_taken = NO_DATE
     date_fmt = '%Y%m%d_%H%M%S'
-    loc_taken = NO_LOC
+    if not isinstance(md, dict):
+        md = {}
 
-    filetype = get_img_type(image_path)
-    logger.debug(f"get_image_metadata: type={filetype}")
-
-    date = lat = lon = None
-    if filetype == IMG_TYPE_PNG:
-        md = img_png.get_png_metadata(image_path)
-        logger.debug(f"png metadata :{md}")
-    else:
-        md = img_exif.get_image_metadata(image_path)
-        logger.debug(f"exif metadata :{md}")
-        if not len(md):
-            md = img_exifread.get_image_metadata(image_path)  
-            logger.debug(f"exifread metadata :{md}")      
-    if len(md):
-        date = md.get('datetime')
-        lat = md.get('lat')
-        lon = md.get('lon') 
-    if not date:
-        date = mydate.datetime_from_file(image_path, min_date=earliest_filedate, max_date=datetime.now())
-        logger.debug(f"date from file: {date}, type={type(date)}")
-        
+    date = md.get('datetime') or date
+    lat = md.get('lat')
+    lon = md.get('lon') 
     if date:
         date_taken = date.strftime(date_fmt)+md.get('subsec','')
         year_taken = date.year
-    if lat and lon:
-            loc_taken = geocache.get_location_name((lat, lon))
             
-    logger.debug(f"year_taken={year_taken}, date_taken={date_taken}, loc_taken={loc_taken}")
-    return year_taken, date_taken, loc_taken
+    logger.debug("year_taken=%s, date_taken=%s, lat=%s, lon=%s", year_taken, date_taken, lat, lon)
+    return year_taken, date_taken, lat, lon
 
 #############################################################
 
@@ -5,16 +5,14 @@ import warnings
 
 import modules.shared.mylog as mylog
 import modules.shared.mydate as mydate
+import modules.shared.myprof as myprof
 
 logger = logging.getLogger(__name__)
-exif_datetime_fmts = [
-    '%Y:%m:%d %H:%M:%S',
-    # '%Y:%m:%d',
-]
 
 def degrees_to_decimal(degrees, minutes, seconds):
     return degrees + (minutes / 60.0) + (seconds / 3600.0)
                                
+@myprof.timed('exif', path_arg=0)
 def get_image_metadata(img_path):
     exif_tags = None
     lat = lon = None
@@ -33,10 +31,10 @@ def get_image_metadata(img_path):
             return result
         
     if not exif_tags:
-        logger.debug(f"could not retrieve exif tags")
+        logger.debug("could not retrieve exif tags")
         return result
             
-    logger.debug(f"retrieved {len(exif_tags)} exif tags as {type(exif_tags)}")
+    logger.debug("retrieved %s exif tags as %s", len(exif_tags), type(exif_tags))
     tag_num = 0
     dates = []
     for tag in exif_tags:
@@ -45,34 +43,34 @@ def get_image_metadata(img_path):
             value = exif_img.get(tag)
             tag_num += 1
             if 'JPEGThumbnail' not in tag:
-                logger.debug(f"{tag_num}: tag={tag}, value={str(value)}, type={type(value)}")
+                logger.debug("%s: tag=%s, value=%s, type=%s", tag_num, tag, value, type(value))
             if 'description' in tag:   
                 if len(value):
                     result['descr'] = value
-                    logger.debug(f"Collected description: {value}")
+                    logger.debug("Collected description: %s", value)
             elif 'datetime' in tag:
-                dt = mydate.datetime_from_string(value, exif_datetime_fmts)
+                dt = mydate.datetime_from_exif(value)
                 if dt:
                     dates.append(dt)
-                    logger.debug(f"Collected datetime: {dt} type: {type(dt)}")
+                    logger.debug("Collected datetime: %s type: %s", dt, type(dt))
             elif "sub_sec_time_original" in tag:
                 if value:
                     result['subsec'] = value
-                    logger.debug(f"Collected subsec")
+                    logger.debug("Collected subsec")
             elif 'gps_latitude' in tag:
                 if 'gps_latitude_ref' in tag:
                     lat_ref = value
-                    logger.debug(f"Collected lat_ref")
+                    logger.debug("Collected lat_ref")
                 else:
                     lat = degrees_to_decimal(value[0], value[1], value[2])
-                    logger.debug(f"Collected lat")
+                    logger.debug("Collected lat")
             elif 'gps_longitude' in tag:
                 if 'gps_longitude_ref' in tag:
                     lon_ref = value
-                    logger.debug(f"Collected lon_ref")
+                    logger.debug("Collected lon_ref")
                 else:
                     lon = degrees_to_decimal(value[0], value[1], value[2])
-                    logger.debug(f"Collected lon")         
+                    logger.debug("Collected lon")         
 
     if lat and lat_ref:
         if 'N' in lat_ref:
@@ -89,7 +87,7 @@ def get_image_metadata(img_path):
     if date:
         result['datetime'] = date
         
-    logger.debug(f"returning extracted exif metada: = {result}")
+    logger.debug("returning extracted exif metada: = %s", result)
     return result
 
 ########################################################################
@@ -3,6 +3,8 @@ from datetime import datetime
 import logging
 import sys
 
+import modules.shared.myprof as myprof
+
 logger = logging.getLogger(__name__)
 exif_datetime_fmt = '%Y:%m:%d %H:%M:%S'
 
@@ -15,6 +17,7 @@ def convert_to_degrees(value):
     s = float(value.values[2].num) / float(value.values[2].den)
     return d + (m / 60.0) + (s / 3600.0)
 
+@myprof.timed('exifread', path_arg=0)
 def get_image_metadata(image_path):
     tags = None
     lat = lon = None
@@ -25,13 +28,13 @@ def get_image_metadata(image_path):
         tags = exifread.process_file(f)
     
     if not tags:
-        logger.debug(f"could not retrieve metadata with exifread")
+        logger.debug("could not retrieve metadata with exifread")
         return result
     
-    logger.debug(f"get_image_metadata: retrieved {len(tags)} exif tags as {type(tags)}")
+    logger.debug("get_image_metadata: retrieved %s exif tags as %s", len(tags), type(tags))
     for tag, tag_value in tags.items():
         value = str(tag_value)
-        logger.debug(f"get_image_metadata: {tag}: {value[:50]}...")
+        logger.debug("get_image_metadata: %s: %s...", tag, value[:50])
 
         if 'ImageDescription' in tag:   
             result['descr'] = value
@@ -64,5 +67,5 @@ def get_image_metadata(image_path):
         else:
             result['lon'] = -lon
 
-    logger.debug(f"get_image_metadata: result = {result}")
+    logger.debug("get_image_metadata: result = %s", result)
     return result
\ No newline at end of file
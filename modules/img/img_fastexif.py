@@ -0,0 +1,227 @@
+# Reads only the EXIF entries the organizer uses straight from the first bytes of the file:
+# IFD0 (ImageDescription, DateTime), Exif IFD (DateTimeOriginal, DateTimeDigitized, SubSecTimeOriginal)
+# and GPS IFD (latitude, longitude and their refs).
+# https://www.media.mit.edu/pia/Research/deepview/exif.html
+import logging
+import struct
+import time
+
+import modules.shared.mylog as mylog
+import modules.shared.mydate as mydate
+import modules.shared.myprof as myprof
+
+logger = logging.getLogger(__name__)
+HEADER_SIZE = 64 * 1024
+
+TAG_IMAGE_DESCRIPTION = 0x010E
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_DATETIME_DIGITIZED = 0x9004
+TAG_SUBSEC_TIME_ORIGINAL = 0x9291
+TAG_GPS_LATITUDE_REF = 1
+TAG_GPS_LATITUDE = 2
+TAG_GPS_LONGITUDE_REF = 3
+TAG_GPS_LONGITUDE = 4
+
+# type: (size in bytes, struct format)
+TIFF_TYPES = {
+    1: (1, 'B'),
+    2: (1, 's'),
+    3: (2, 'H'),
+    4: (4, 'L'),
+    5: (8, 'LL'),
+    7: (1, 's'),
+    9: (4, 'l'),
+    10: (8, 'll'),
+}
+
+class ExifFormatError(Exception):
+    pass
+
+def degrees_to_decimal(degrees, minutes, seconds):
+    return degrees + (minutes / 60.0) + (seconds / 3600.0)
+
+# Returns the same dictionary as img_exif.get_image_metadata, or None when the file
+# has no EXIF block this reader understands and the slower libraries should be used.
+@myprof.timed('fastexif', path_arg=0)
+def get_image_metadata(img_path):
+    with open(img_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    return get_metadata_from_bytes(header)
+
+def get_metadata_from_bytes(header):
+    tiff = find_tiff(header)
+    if tiff is None:
+        logger.debug("no EXIF block in the first %s bytes", len(header))
+        return None
+    try:
+        return parse_tiff(tiff)
+    except (ExifFormatError, struct.error, UnicodeDecodeError) as e:
+        logger.debug("failed to parse EXIF block: %s", e)
+        return None
+
+def find_tiff(header):
+    if header[:2] == b'\xff\xd8':
+        return find_tiff_in_jpeg(header)
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return memoryview(header)
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return find_tiff_in_webp(header)
+    return None
+
+def find_tiff_in_jpeg(header):
+    pos = 2
+    while pos + 4 <= len(header):
+        if header[pos] != 0xFF:
+            return None
+        marker = header[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        # start of scan or end of image, no more metadata segments
+        if marker in (0xDA, 0xD9):
+            return None
+        length = struct.unpack_from('>H', header, pos + 2)[0]
+        if marker == 0xE1 and header[pos + 4:pos + 10] == b'Exif\x00\x00':
+            return memoryview(header)[pos + 10:pos + 2 + length]
+        pos += 2 + length
+    return None
+
+def find_tiff_in_webp(header):
+    pos = 12
+    while pos + 8 <= len(header):
+        chunk, size = header[pos:pos + 4], struct.unpack_from('<L', header, pos + 4)[0]
+        if chunk == b'EXIF':
+            data = memoryview(header)[pos + 8:pos + 8 + size]
+            if data[:6] == b'Exif\x00\x00':
+                data = data[6:]
+            return data
+        pos += 8 + size + (size & 1)
+    return None
+
+def read_ifd(tiff, order, offset, wanted):
+    if offset + 2 > len(tiff):
+        raise ExifFormatError(f"IFD offset {offset} is beyond the header")
+    entries = struct.unpack_from(order + 'H', tiff, offset)[0]
+    values = {}
+    for i in range(entries):
+        entry = offset + 2 + 12 * i
+        tag, value_type, count = struct.unpack_from(order + 'HHL', tiff, entry)
+        if tag not in wanted or value_type not in TIFF_TYPES:
+            continue
+        size, fmt = TIFF_TYPES[value_type]
+        total = size * count
+        value_offset = entry + 8
+        if total > 4:
+            value_offset = struct.unpack_from(order + 'L', tiff, entry + 8)[0]
+        if value_offset + total > len(tiff):
+            raise ExifFormatError(f"value of tag {tag:#x} is beyond the header")
+        if fmt == 's':
+            raw = bytes(tiff[value_offset:value_offset + total])
+            values[tag] = raw.split(b'\x00', 1)[0].decode('utf-8', errors='replace').strip()
+        else:
+            values[tag] = struct.unpack_from(order + fmt * count, tiff, value_offset)
+    return values
+
+def rationals_to_degrees(values):
+    if len(values) < 6:
+        return None
+    parts = []
+    for num, den in zip(values[0::2], values[1::2]):
+        parts.append(num / den if den else 0.0)
+    return degrees_to_decimal(parts[0], parts[1], parts[2])
+
+def parse_tiff(tiff):
+    if len(tiff) < 8:
+        raise ExifFormatError("TIFF header is too short")
+    order = {b'II': '<', b'MM': '>'}.get(bytes(tiff[:2]))
+    if not order:
+        raise ExifFormatError("unknown byte order")
+    ifd0_offset = struct.unpack_from(order + 'L', tiff, 4)[0]
+    ifd0 = read_ifd(tiff, order, ifd0_offset,
+                    {TAG_IMAGE_DESCRIPTION, TAG_DATETIME, TAG_EXIF_IFD, TAG_GPS_IFD})
+    exif_ifd = {}
+    if TAG_EXIF_IFD in ifd0:
+        exif_ifd = read_ifd(tiff, order, ifd0[TAG_EXIF_IFD][0],
+                            {TAG_DATETIME_ORIGINAL, TAG_DATETIME_DIGITIZED, TAG_SUBSEC_TIME_ORIGINAL})
+    gps_ifd = {}
+    if TAG_GPS_IFD in ifd0:
+        gps_ifd = read_ifd(tiff, order, ifd0[TAG_GPS_IFD][0],
+                           {TAG_GPS_LATITUDE_REF, TAG_GPS_LATITUDE, TAG_GPS_LONGITUDE_REF, TAG_GPS_LONGITUDE})
+
+    result = {}
+    if ifd0.get(TAG_IMAGE_DESCRIPTION):
+        result['descr'] = ifd0[TAG_IMAGE_DESCRIPTION]
+
+    dates = []
+    for value in (ifd0.get(TAG_DATETIME), exif_ifd.get(TAG_DATETIME_ORIGINAL), exif_ifd.get(TAG_DATETIME_DIGITIZED)):
+        if value:
+            dt = mydate.datetime_from_exif(value)
+            if dt:
+                dates.append(dt)
+    date = mydate.pick_earliest_date(dates)
+    if date:
+        result['datetime'] = date
+    if exif_ifd.get(TAG_SUBSEC_TIME_ORIGINAL):
+        result['subsec'] = exif_ifd[TAG_SUBSEC_TIME_ORIGINAL]
+
+    lat = rationals_to_degrees(gps_ifd.get(TAG_GPS_LATITUDE, ()))
+    lat_ref = gps_ifd.get(TAG_GPS_LATITUDE_REF)
+    lon = rationals_to_degrees(gps_ifd.get(TAG_GPS_LONGITUDE, ()))
+    lon_ref = gps_ifd.get(TAG_GPS_LONGITUDE_REF)
+    if lat and lat_ref:
+        result['lat'] = lat if 'N' in lat_ref else -lat
+    if lon and lon_ref:
+        result['lon'] = lon if 'E' in lon_ref else -lon
+
+    logger.debug("returning extracted exif metada: = %s", result)
+    return result
+
+########################################################################
+
+def benchmark(files):
+    import modules.img.img_exif as img_exif
+    import modules.img.img_exifread as img_exifread
+
+    start = time.perf_counter()
+    fast_found = 0
+    for file in files:
+        if get_image_metadata(file) is not None:
+            fast_found += 1
+    fast = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for file in files:
+        md = img_exif.get_image_metadata(file)
+        if not len(md):
+            img_exifread.get_image_metadata(file)
+    chain = time.perf_counter() - start
+
+    per_1000 = 1000 / len(files)
+    logger.info(f"{len(files)} files, {fast_found} parsed by the fast reader: \
+                \n\tfast reader       : {fast * per_1000:.2f} seconds per 1000 files \
+                \n\texif -> exifread  : {chain * per_1000:.2f} seconds per 1000 files")
+
+testdir = "D:\\tmp\\test\\"
+shutup_modules= [
+    ("exif",logging.ERROR),
+    ("exifread",logging.ERROR),
+    ("modules.img.img_exif",logging.ERROR),
+    ("modules.img.img_exifread",logging.ERROR),
+    ("modules.shared.mydate",logging.WARNING),
+]
+
+import os
+import sys
+# python -m modules.img.img_fastexif [folder] compares the fast reader with the exif -> exifread chain
+if __name__ == "__main__":
+    mylog.setup_logging(None, log_level=logging.INFO, shutup_modules=shutup_modules)
+    logger = logging.getLogger("img_fastexif")
+
+    folder = sys.argv[1] if len(sys.argv) > 1 else testdir
+    files = [os.path.join(folder, name) for name in os.listdir(folder)
+             if name.lower().endswith(('.jpg', '.jpeg'))]
+    if files:
+        benchmark(files)
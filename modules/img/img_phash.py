@@ -0,0 +1,118 @@
+import logging
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from modules.shared.mylog import setup_logging
+import modules.shared.myprof as myprof
+
+logger = logging.getLogger(__name__)
+
+# Perceptual hashes of images: 64 bits that change little when an image is resized, re-encoded
+# or slightly edited, so the number of different bits tells how alike two images look.
+# - dHash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour,
+# - pHash: whether each of the 8x8 lowest frequencies of the DCT of a 32x32 thumbnail is above their median.
+# JPEGs are decoded in draft mode at 1/2 to 1/8 of their size, which the thumbnails do not need anyway,
+# and the hashes of a batch of images are computed at once with NumPy.
+HASH_BITS = 64
+DHASH_SIZE = (9, 8)
+PHASH_SIZE = 32
+PHASH_FREQUENCIES = 8
+# JPEGs are decoded to the smallest scale at least this large
+DRAFT_SIZE = (4 * PHASH_SIZE, 4 * PHASH_SIZE)
+DEFAULT_HASH_THREADS = 4
+# extensions of the files worth trying to decode, e.g. at destination where files are not classified
+HASH_EXTENSIONS = {'.jpg', '.jpeg', '.jpe', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff'}
+
+# pixels is width times height of the original image, 0 with no hashes for files that could not be decoded
+ImageHashes = namedtuple('ImageHashes', ['dhash', 'phash', 'pixels'])
+NOT_HASHABLE = ImageHashes(None, None, 0)
+
+def _dct_matrix(size, frequencies):
+    n = np.arange(size)
+    k = np.arange(frequencies)[:, None]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+# rows of the orthonormal DCT-II for the lowest frequencies only
+DCT = _dct_matrix(PHASH_SIZE, PHASH_FREQUENCIES)
+
+def hashable(path):
+    return os.path.splitext(path)[1].lower() in HASH_EXTENSIONS
+
+def hamming(hash1, hash2):
+    return (hash1 ^ hash2).bit_count()
+
+# the two grayscale thumbnails of the image turned as it is shown, and its number of pixels
+@myprof.timed('phash_decode', path_arg=0)
+def load_thumbnails(path):
+    with Image.open(path) as image:
+        pixels = image.size[0] * image.size[1]
+        image.draft('L', DRAFT_SIZE)
+        image = ImageOps.exif_transpose(image).convert('L')
+        large = image.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS)
+        small = image.resize(DHASH_SIZE, Image.LANCZOS)
+    return np.asarray(large, dtype=np.float32), np.asarray(small, dtype=np.int16), pixels
+
+def _try_load_thumbnails(path):
+    try:
+        return load_thumbnails(path)
+    except Exception as e:
+        logger.warning(f"Failed to decode {path} for perceptual hashes: {e}")
+        return None
+
+# 64 bools per row to one int per row, the first bool being the highest bit
+def _pack_bits(bits):
+    packed = np.packbits(bits.reshape(len(bits), HASH_BITS), axis=1)
+    return [int(value) for value in packed.view('>u8')[:, 0]]
+
+# dHashes of a (N, 8, 9) array of thumbnails
+def dhashes(small):
+    return _pack_bits(small[:, :, 1:] > small[:, :, :-1])
+
+# pHashes of a (N, 32, 32) array of thumbnails; the mean brightness, the first coefficient, is not part of the median
+def phashes(large):
+    coefficients = (DCT @ large @ DCT.T).reshape(len(large), HASH_BITS)
+    medians = np.median(coefficients[:, 1:], axis=1)
+    return _pack_bits(coefficients > medians[:, None])
+
+# ImageHashes of every path, NOT_HASHABLE for files that are not images or could not be decoded;
+# decoding takes most of the time and runs in threads, PIL does not hold the GIL while it decodes
+@myprof.timed('phash')
+def hash_images(paths, threads=DEFAULT_HASH_THREADS):
+    if threads > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='phash') as executor:
+            thumbnails = list(executor.map(_try_load_thumbnails, paths))
+    else:
+        thumbnails = [_try_load_thumbnails(path) for path in paths]
+    loaded = [entry for entry in thumbnails if entry]
+    if not loaded:
+        return [NOT_HASHABLE] * len(paths)
+    computed = iter(zip(dhashes(np.stack([small for _, small, _ in loaded])),
+                        phashes(np.stack([large for large, _, _ in loaded])),
+                        (pixels for _, _, pixels in loaded)))
+    return [ImageHashes(*next(computed)) if entry else NOT_HASHABLE for entry in thumbnails]
+
+def to_hex(hash):
+    return f"{hash:016x}"
+
+########################################################################
+
+# python -m modules.img.img_phash IMAGE [IMAGE ...] prints the hashes and the distances to the first image
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("img_phash")
+
+    paths = sys.argv[1:] or ["D:\\tmp\\test\\IMG_0001.JPG"]
+    hashes = hash_images(paths)
+    for path, entry in zip(paths, hashes):
+        if entry.dhash is None:
+            logger.info(f"{path}: not hashable")
+            continue
+        logger.info(f"{path}: dhash={to_hex(entry.dhash)} phash={to_hex(entry.phash)} pixels={entry.pixels} "
+                    f"distance to first: dhash {hamming(entry.dhash, hashes[0].dhash or 0)}, phash {hamming(entry.phash, hashes[0].phash or 0)}")
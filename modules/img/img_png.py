@@ -5,17 +5,19 @@ import logging
 import warnings
 
 from modules.shared.mylog import setup_logging
+import modules.shared.myprof as myprof
 
 logger = logging.getLogger(__name__)
 exif_datetime_fmt = '%Y:%m:%d %H:%M:%S'
 
+@myprof.timed('png', path_arg=0)
 def get_png_metadata(img_path):
     
     png_img = PngImageFile(img_path) #via https://stackoverflow.com/a/58399815
     png_info = PngInfo()
     properties = []
 
-    logger.debug(f"image={png_img}, metadata={png_info}, image.text={png_img.text}")   
+    logger.debug("image=%s, metadata=%s, image.text=%s", png_img, png_info, png_img.text)   
     # Compile array from tags dict
     for i in png_img.text:
          compile = i, str(png_img.text[i])
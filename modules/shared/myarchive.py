@@ -0,0 +1,143 @@
+import logging
+import os
+import tarfile
+import tempfile
+import zipfile
+from collections import namedtuple
+from datetime import datetime
+
+import modules.shared.myfiletype as myfiletype
+
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+# nested archives are kept in memory up to this size, larger ones spill to one temporary file at a time
+NESTED_SPOOL_SIZE = 64 * 1024 * 1024
+
+# path is the archive path followed by the member name, e.g. D:\takeout.zip/Photos/IMG_0001.jpg;
+# fileobj is readable only until the next member is yielded
+ArchiveMember = namedtuple('ArchiveMember', ['path', 'name', 'size', 'mtime', 'fileobj'])
+
+# Yields the files inside a zip or tar archive without extracting them,
+# descending into archives inside the archive. With wanted, a collection of member paths,
+# only those members are read and yielded, e.g. for a second pass over the archive.
+def iter_archive_members(archive_path, filetype=None, fileobj=None, wanted=None):
+    if wanted is not None and fileobj is None:
+        wanted = _with_containers(wanted)
+    if not filetype:
+        filetype = myfiletype.classify(archive_path)
+    if filetype.format == 'ZIP':
+        members = _iter_zip(archive_path, fileobj, wanted)
+    elif filetype.format == 'TAR':
+        members = _iter_tar(archive_path, fileobj, wanted)
+    else:
+        logger.warning(f"{archive_path} is not a zip or tar archive, skipping")
+        return
+
+    for member in members:
+        header = _peek(member.fileobj, myfiletype.CLASSIFY_SIZE)
+        member_type = myfiletype.classify_bytes(header, member.name)
+        if member_type.kind == myfiletype.KIND_ARCHIVE:
+            logger.debug("%s is a nested archive", member.path)
+            with tempfile.SpooledTemporaryFile(max_size=NESTED_SPOOL_SIZE) as spool:
+                spool.write(header)
+                while True:
+                    chunk = member.fileobj.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+                spool.seek(0)
+                yield from iter_archive_members(member.path, member_type, spool, wanted)
+        elif wanted is None or member.path in wanted:
+            yield member._replace(fileobj=_Rewound(header, member.fileobj))
+
+# the wanted paths and the paths of the nested archives holding them, e.g. a.zip/b.zip/c.jpg needs a.zip/b.zip
+def _with_containers(paths):
+    needed = set()
+    for path in paths:
+        needed.add(path)
+        container = path.rpartition('/')[0]
+        while container and container not in needed:
+            needed.add(container)
+            container = container.rpartition('/')[0]
+    return needed
+
+# zeroed or invalid DOS timestamps fall back to the mtime of the archive file, or None for a nested archive
+def _zip_mtime(info, archive_path, fileobj):
+    try:
+        return datetime(*info.date_time)
+    except ValueError:
+        logger.warning(f"{archive_path}/{info.filename}: invalid date {info.date_time}")
+        return None if fileobj else datetime.fromtimestamp(os.path.getmtime(archive_path))
+
+def _iter_zip(archive_path, fileobj, wanted=None):
+    with zipfile.ZipFile(fileobj or archive_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            path = f"{archive_path}/{info.filename}"
+            if wanted is not None and path not in wanted:
+                continue
+            with zip_ref.open(info) as member_file:
+                yield ArchiveMember(path, os.path.basename(info.filename),
+                                    info.file_size, _zip_mtime(info, archive_path, fileobj), member_file)
+
+def _iter_tar(archive_path, fileobj, wanted=None):
+    with tarfile.open(name=None if fileobj else archive_path, fileobj=fileobj, mode='r:*') as tar_ref:
+        for info in tar_ref:
+            if not info.isfile():
+                continue
+            path = f"{archive_path}/{info.name}"
+            if wanted is not None and path not in wanted:
+                continue
+            member_file = tar_ref.extractfile(info)
+            if member_file is None:
+                continue
+            with member_file:
+                yield ArchiveMember(path, os.path.basename(info.name),
+                                    info.size, datetime.fromtimestamp(info.mtime), member_file)
+
+def _peek(fileobj, size):
+    data = b''
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+# a member stream with its already peeked first bytes put back in front
+class _Rewound:
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data = self.head + self.fileobj.read()
+            self.head = b''
+            return data
+        data = self.head[:size]
+        self.head = self.head[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+########################################################################
+
+test_archive = "D:\\tmp\\imgs_arch\\test.zip"
+
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("myarchive")
+
+    for member in iter_archive_members(test_archive):
+        logger.info(f"{member.path}: {member.size} bytes, {member.mtime}")
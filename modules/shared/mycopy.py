@@ -0,0 +1,245 @@
+import errno
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# ioctl cloning is Linux only
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+import modules.shared.myprof as myprof
+
+# Copies a file with the cheapest method the source and destination volumes support:
+# - hardlink: only with LINK_HARDLINK, the destination is the same file as the source, no bytes are written;
+# - reflink: the destination shares the blocks of the source until one of them is changed (btrfs, XFS);
+# - kernel: copy_file_range or sendfile, the bytes are copied without passing through python;
+# - buffered: read and write with a reused buffer, works everywhere.
+# Except for hardlinks, the destination gets the timestamps and permissions of the source like shutil.copy2.
+LINK_AUTO = 'auto'
+LINK_COPY = 'copy'
+LINK_HARDLINK = 'hardlink'
+LINK_MODES = [LINK_AUTO, LINK_COPY, LINK_HARDLINK]
+DEFAULT_LINK_MODE = LINK_AUTO
+
+METHOD_HARDLINK = 'hardlink'
+METHOD_REFLINK = 'reflink'
+METHOD_KERNEL = 'kernel'
+METHOD_BUFFERED = 'buffered'
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024
+KERNEL_CHUNK_SIZE = 1024 * 1024 * 1024
+# errors meaning the method does not work between these volumes, not that the copy failed
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EPERM,
+                      getattr(errno, 'EOPNOTSUPP', errno.EINVAL), getattr(errno, 'ENOTSUP', errno.EINVAL)}
+
+# copies in flight in CopyPipeline
+DEFAULT_COPY_THREADS = 4
+DEFAULT_INFLIGHT_MB = 256
+DEFAULT_INFLIGHT_FILES = 64
+
+# (method, source device, destination device) known not to work, so they are not tried for every file
+_unsupported = set()
+
+@myprof.timed('copy_file', path_arg=0)
+def copy_file(src_path, dst_path, link_mode=DEFAULT_LINK_MODE):
+    devices = _devices(src_path, dst_path)
+    if link_mode == LINK_HARDLINK and _supported(METHOD_HARDLINK, devices):
+        try:
+            os.link(src_path, dst_path)
+            return METHOD_HARDLINK
+        except OSError as e:
+            _unsupported_or_raise(METHOD_HARDLINK, devices, e)
+
+    try:
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            method = _copy_contents(src, dst, devices, link_mode)
+        shutil.copystat(src_path, dst_path)
+    except BaseException:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        raise
+    return method
+
+def _copy_contents(src, dst, devices, link_mode):
+    if link_mode != LINK_COPY and fcntl and _supported(METHOD_REFLINK, devices):
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return METHOD_REFLINK
+        except OSError as e:
+            _unsupported_or_raise(METHOD_REFLINK, devices, e)
+
+    if _supported(METHOD_KERNEL, devices):
+        try:
+            if _copy_kernel(src, dst):
+                return METHOD_KERNEL
+        except OSError as e:
+            _unsupported_or_raise(METHOD_KERNEL, devices, e)
+        # a method may fail after copying a part, start over
+        src.seek(0)
+        dst.seek(0)
+        dst.truncate()
+
+    _copy_buffered(src, dst)
+    return METHOD_BUFFERED
+
+# returns False when the platform has neither copy_file_range nor sendfile to regular files
+def _copy_kernel(src, dst):
+    if hasattr(os, 'copy_file_range'):
+        copy = os.copy_file_range
+    elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        copy = os.sendfile
+    else:
+        return False
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    offset = 0
+    while True:
+        if copy is os.sendfile:
+            copied = copy(dst_fd, src_fd, offset, KERNEL_CHUNK_SIZE)
+        else:
+            copied = copy(src_fd, dst_fd, KERNEL_CHUNK_SIZE, offset, offset)
+        if not copied:
+            break
+        offset += copied
+    # some file systems report success and copy nothing, e.g. procfs or some FUSE mounts
+    if offset != os.fstat(src_fd).st_size:
+        raise OSError(errno.EINVAL, f"copied {offset} of {os.fstat(src_fd).st_size} bytes")
+    return True
+
+def _copy_buffered(src, dst):
+    buffer = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buffer)
+    while True:
+        read = src.readinto(buffer)
+        if not read:
+            break
+        dst.write(view[:read])
+
+def _devices(src_path, dst_path):
+    try:
+        return os.stat(src_path).st_dev, os.stat(os.path.dirname(os.path.abspath(dst_path))).st_dev
+    except OSError:
+        return None, None
+
+def _supported(method, devices):
+    return (method, *devices) not in _unsupported
+
+def _unsupported_or_raise(method, devices, e):
+    if e.errno not in UNSUPPORTED_ERRNOS:
+        raise e
+    logger.debug(f"{method} is not supported from device {devices[0]} to device {devices[1]}: {e}")
+    _unsupported.add((method, *devices))
+
+# Copies files in a thread pool while the caller goes on deciding where the next files go,
+# so reading from a slow source overlaps writing to a slow destination.
+# Submitting blocks while max_files copies or max_bytes bytes are in flight; a file larger
+# than max_bytes is copied alone. Completed copies are reported to on_done(src_path, dst_path,
+# size, method) in the calling thread, in submission order, so counters need no locking.
+class CopyPipeline:
+    def __init__(self, threads=DEFAULT_COPY_THREADS, max_bytes=DEFAULT_INFLIGHT_MB * 2**20,
+                 max_files=DEFAULT_INFLIGHT_FILES, link_mode=DEFAULT_LINK_MODE, on_done=None):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='copy')
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.link_mode = link_mode
+        self.on_done = on_done
+        # dst_path: (src_path, size, future), oldest first
+        self.pending = {}
+        self.inflight_bytes = 0
+        self.copied = 0
+        self.copied_bytes = 0
+        self.error = None
+        # seconds with at least one copy in flight, for the sustained throughput
+        self.elapsed = 0.0
+        self.busy_since = None
+
+    def __contains__(self, dst_path):
+        return dst_path in self.pending
+
+    # source of a file still being copied to dst_path, its contents are the same
+    def source_of(self, dst_path):
+        pending = self.pending.get(dst_path)
+        return pending[0] if pending else dst_path
+
+    def submit(self, src_path, dst_path, size=None):
+        if self.error:
+            raise self.error
+        if size is None:
+            size = os.path.getsize(src_path)
+        while self.pending and (len(self.pending) >= self.max_files or self.inflight_bytes + size > self.max_bytes):
+            with myprof.timer('copy_wait'):
+                self._reap(block=True)
+            if self.error:
+                raise self.error
+        if not self.pending:
+            self.busy_since = time.perf_counter()
+        self.pending[dst_path] = (src_path, size, self.executor.submit(copy_file, src_path, dst_path, self.link_mode))
+        self.inflight_bytes += size
+        self._reap(block=False)
+
+    # waits for all the copies, raises the first error
+    def finish(self):
+        while self.pending:
+            self._reap(block=True)
+        if self.error:
+            raise self.error
+
+    # waits for the copies in flight without raising, for cleanup after an error
+    def close(self):
+        while self.pending:
+            self._reap(block=True)
+        self.executor.shutdown(wait=True)
+
+    def _reap(self, block):
+        if block:
+            _, _, oldest = next(iter(self.pending.values()))
+            wait([oldest])
+        # report in submission order, stopping at the first copy still in flight
+        for dst_path, (src_path, size, future) in list(self.pending.items()):
+            if not future.done():
+                break
+            del self.pending[dst_path]
+            self.inflight_bytes -= size
+            try:
+                method = future.result()
+            except Exception as e:
+                logger.error(f"failed to copy {src_path} to {dst_path}: {e}")
+                self.error = self.error or e
+                continue
+            self.copied += 1
+            self.copied_bytes += size
+            if self.on_done:
+                self.on_done(src_path, dst_path, size, method)
+        if not self.pending and self.busy_since is not None:
+            self.elapsed += time.perf_counter() - self.busy_since
+            self.busy_since = None
+
+########################################################################
+
+test_file = "D:\\tmp\\test\\test.jpg"
+test_dir = "D:\\tmp\\test_copy\\"
+
+# python -m modules.shared.mycopy [file] [folder] times every link mode from file into folder
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("mycopy")
+
+    src_path = sys.argv[1] if len(sys.argv) > 1 else test_file
+    dst_dir = sys.argv[2] if len(sys.argv) > 2 else test_dir
+    os.makedirs(dst_dir, exist_ok=True)
+    for link_mode in LINK_MODES:
+        dst_path = os.path.join(dst_dir, f"{link_mode}_{os.path.basename(src_path)}")
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        start = time.perf_counter()
+        method = copy_file(src_path, dst_path, link_mode)
+        logger.info(f"{link_mode:<10}: copied with {method} in {(time.perf_counter() - start) * 1000:.2f} ms")
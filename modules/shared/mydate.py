@@ -1,13 +1,39 @@
 import logging
 import os
+import re
+import time
 from datetime import datetime
-import dateparser
+from functools import lru_cache
 from dateutil import parser
 
 import modules.shared.mylog as mylog
+import modules.shared.myprof as myprof
 
 logger = logging.getLogger(__name__)
 
+# dateparser is slow to import and to call, file names are given to it only when enabled
+# and nothing else in the name looks like a date
+use_dateparser = False
+
+# date and often time in the names given by cameras, phones and messengers, e.g.
+# IMG_20190102_030405.jpg, VID_20190102_030405.mp4, PXL_20210506_070809123.jpg, IMG-20190102-WA0001.jpg,
+# Screenshot_20190102-030405.png, Screenshot_2019-01-02-03-04-05.png, 2019-01-02 03.04.05.jpg
+NAME_DATETIME_PATTERN = re.compile(
+    r'(?<!\d)((?:19|20)\d\d)([-_.]?)(0[1-9]|1[0-2])\2(0[1-9]|[12]\d|3[01])'
+    r'(?:[-_ T.]?([01]\d|2[0-3])[-_.:]?([0-5]\d)[-_.:]?([0-5]\d)\d{0,3})?(?!\d)')
+# runs of digits long enough to hold DDMMYYYY, YYYYMMDD or MMDDYYYY once separators are removed
+NAME_DIGITS_PATTERN = re.compile(r'\d{8,}')
+NAME_SEPARATORS = str.maketrans('', '', '_- ')
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+# years a photo can plausibly be taken in, like the 19xx and 20xx of NAME_DATETIME_PATTERN;
+# 8 digits of a counter or a hash read as 0023-01-01 or 3040-12-01 are noise
+MIN_YEAR = 1900
+MAX_YEAR = 2099
+
+EXIF_DATETIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+# distinct strings remembered by the parsing caches, bursts of photos repeat the same few
+DATE_CACHE_SIZE = 4096
+
 def pick_earliest_date(dates, min_date = None, max_date = None):
     if not dates or not len(dates):
         return None
@@ -24,10 +50,17 @@ def pick_earliest_date(dates, min_date = None, max_date = None):
                 if max_date and date < max_date:
                     result = date
                 break
-    logger.debug(f"{result} is min date for dates={dates}, max_date={max_date}, min_date={min_date}")
+    logger.debug("%s is min date for dates=%s, max_date=%s, min_date=%s", result, dates, max_date, min_date)
     return result
     
 def datetime_from_string(datestring, datefmts):
+    if not isinstance(datestring, str):
+        return None
+    return _datetime_from_string(datestring, tuple(datefmts))
+
+# datetime objects are immutable, so the cached ones can be shared
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _datetime_from_string(datestring, datefmts):
     dt = None
 
     for fmt in datefmts:
@@ -35,14 +68,14 @@ def datetime_from_string(datestring, datefmts):
             dt = datetime.strptime(datestring, fmt)
             break
         except Exception as e:
-            logger.debug(f"strptime failed to extract date from {datestring}, e={e}") 
+            logger.debug("strptime failed to extract date from %s, e=%s", datestring, e) 
             continue
 
     if not dt:
         try:
             dt = parser.parse(datestring)
         except Exception as e:
-            logger.debug(f"parser failed to extract date from {datestring}, e={e}") 
+            logger.debug("parser failed to extract date from %s, e=%s", datestring, e) 
     
     # silenced as it was not usefull
     # if not dt:
@@ -52,59 +85,102 @@ def datetime_from_string(datestring, datefmts):
     #         logger.debug(f"dateparser failed to extract date from {datestring}, e={e}")     
 
     if dt:
-        logger.debug(f"extracted date {dt} from string {datestring}")    
+        logger.debug("extracted date %s from string %s", dt, datestring)    
     return dt
 
-def datetime_from_os(file):
-    result = None
-    
-    os_times = []
-    ctime = datetime.fromtimestamp(os.path.getctime(file))
-    os_times.append(ctime)
-    atime = datetime.fromtimestamp(os.path.getatime(file))
-    os_times.append(atime)
-    mtime = datetime.fromtimestamp(os.path.getmtime(file))
-    os_times.append(mtime)
-    
-    if len(os_times):
-        os_times.sort()
-        result = os_times[0]
+# EXIF dates are 'YYYY:MM:DD HH:MM:SS', read here by slicing;
+# anything else, e.g. with a time zone or blanks for unknown parts, goes through datetime_from_string
+def datetime_from_exif(datestring):
+    if not isinstance(datestring, str):
+        return None
+    return _datetime_from_exif(datestring)
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _datetime_from_exif(datestring):
+    if len(datestring) != 19 or datestring[10] != ' ' or not (
+            datestring[4] == datestring[7] == datestring[13] == datestring[16] == ':'):
+        return datetime_from_string(datestring, [EXIF_DATETIME_FORMAT])
+    digits = datestring[:4] + datestring[5:7] + datestring[8:10] + datestring[11:13] + datestring[14:16] + datestring[17:]
+    if not (digits.isascii() and digits.isdigit()):
+        return datetime_from_string(datestring, [EXIF_DATETIME_FORMAT])
+    year, month, day = int(digits[:4]), int(digits[4:6]), int(digits[6:8])
+    hour, minute, second = int(digits[8:10]), int(digits[10:12]), int(digits[12:])
+    # e.g. 0000:00:00 00:00:00 written by cameras with no clock set
+    if not valid_date(year, month, day) or hour > 23 or minute > 59 or second > 59:
+        logger.debug("invalid EXIF date %s", datestring)
+        return None
+    return datetime(year, month, day, hour, minute, second)
 
-    logger.debug(f"datetime from os: {result}") 
+def datetime_from_os(file):
+    st = os.stat(file)
+    result = datetime.fromtimestamp(min(st.st_ctime, st.st_atime, st.st_mtime))
+    logger.debug("datetime from os: %s", result) 
     return result
 
 def datetime_from_file(file, min_date = None, max_date = datetime.now()):
-    dates = [datetime_from_os(file)]
+    return datetime_from_name(file, datetime_from_os(file), min_date=min_date, max_date=max_date)
+
+# file does not have to exist, e.g. a member of an archive with the date of the member as os_date
+def datetime_from_name(file, os_date = None, min_date = None, max_date = datetime.now()):
+    dates = [os_date] if os_date else []
 
     filename, _ = os.path.splitext(os.path.basename(file))
-    date = dateparser.parse(filename)
+    date = datetime_from_name_pattern(filename)
     if date:
-        logger.debug(f"date from dateparser: {date} of type {type(date)}")
+        logger.debug("date from name pattern: %s", date)
         dates.append(date)
+    else:
+        name_dates = dates_from_name_digits(filename)
+        if not name_dates and use_dateparser:
+            name_dates = dates_from_dateparser(filename)
+        dates.extend(name_dates)
 
-    filename = ''.join(filename.split('_'))
-    filename = ''.join(filename.split('-'))
-    filename = ''.join(filename.split(' '))
-    name_len = len(filename)
-    logger.debug(f"string reduced from the file name: {filename} with {name_len} chars")
-    
-    date_len = 8
-    fmts = ['%d%m%Y', '%Y%m%d', '%m%d%Y']
-    i = 0
-    while i <= name_len-date_len:
-        test_str = filename[i:i+date_len]
-        i += 1
-
-        if not test_str.isdigit():
-            continue
-        
-        date = datetime_from_string(test_str, fmts)
-        if date:
-            dates.append(date)
-            
     date = pick_earliest_date(dates, min_date=min_date, max_date=max_date)
     return date
 
+def valid_date(year, month, day):
+    if year < MIN_YEAR or year > MAX_YEAR or month < 1 or month > 12 or day < 1:
+        return False
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return day <= 29
+    return day <= DAYS_IN_MONTH[month - 1]
+
+def datetime_from_name_pattern(filename):
+    match = NAME_DATETIME_PATTERN.search(filename)
+    if not match:
+        return None
+    year, _, month, day, hour, minute, second = match.groups()
+    year, month, day = int(year), int(month), int(day)
+    if not valid_date(year, month, day):
+        return None
+    if hour is None:
+        return datetime(year, month, day)
+    return datetime(year, month, day, int(hour), int(minute), int(second))
+
+# every 8 digits in a row of the name, separators removed, read as DDMMYYYY, YYYYMMDD or MMDDYYYY, first valid wins
+def dates_from_name_digits(filename):
+    dates = []
+    for match in NAME_DIGITS_PATTERN.finditer(filename.translate(NAME_SEPARATORS)):
+        digits = match.group()
+        for i in range(len(digits) - 7):
+            window = digits[i:i+8]
+            for year, month, day in ((window[4:], window[2:4], window[:2]),
+                                     (window[:4], window[4:6], window[6:]),
+                                     (window[4:], window[:2], window[2:4])):
+                year, month, day = int(year), int(month), int(day)
+                if valid_date(year, month, day):
+                    dates.append(datetime(year, month, day))
+                    break
+    logger.debug("dates from the digits of %s: %s", filename, dates)
+    return dates
+
+@myprof.timed('dateparser')
+def dates_from_dateparser(filename):
+    import dateparser
+    date = dateparser.parse(filename)
+    logger.debug("date from dateparser: %s of type %s", date, type(date))
+    return [date] if date else []
+
 #############################################################
 
 testdir = "D:\\tmp\\test\\"
@@ -123,4 +199,13 @@ if __name__ == "__main__":
         test = os.path.join(testdir, test)
         logger.info(f"TEST IMAGE: {test}")
         dt = datetime_from_file(test)
-        logger.info(f"RESULT: dt={dt}, type={type(dt)}")
\ No newline at end of file
+        logger.info(f"RESULT: dt={dt}, type={type(dt)}")
+
+    names = ["IMG_20190102_030405.jpg", "PXL_20210506_070809123.jpg", "IMG-20190102-WA0001.jpg",
+             "Screenshot_2019-01-02-03-04-05.png", "scan_02012019.jpg", "DSC01234.JPG"]
+    logging.getLogger().setLevel(logging.INFO)
+    start = time.perf_counter()
+    for _ in range(1000):
+        for name in names:
+            datetime_from_name(name)
+    logger.info(f"{(time.perf_counter() - start) * 1e6 / (1000 * len(names)):.1f} microseconds per file name")
\ No newline at end of file
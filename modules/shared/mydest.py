@@ -0,0 +1,148 @@
+import logging
+import os
+import re
+
+import modules.shared.myfile as myfile
+
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+SUFFIX_PATTERN = re.compile(r'^(.*)-(\d+)$')
+
+# Files at destination grouped by name, so that a name collision is resolved without
+# globbing the folder and without reading destination files more than once.
+# A file "<stem>-<N><ext>" belongs both to its own group and to the group of "<stem><ext>",
+# where it counts towards the highest alternative number used for that name.
+class DestinationIndex:
+    def __init__(self, paths=(), hash_func=myfile.get_hash_from_contents):
+        self.hash_func = hash_func
+        self.paths = set()
+        self.hashes = {}
+        self.hash_of = {}
+        self.groups = {}
+        for path in paths:
+            self.add(path)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def _group(self, name, ext):
+        key = (name, ext.lower())
+        group = self.groups.get(key)
+        if not group:
+            group = {'paths': set(), 'unhashed': [], 'hashes': set(), 'max_suffix': 0}
+            self.groups[key] = group
+        return group
+
+    def add(self, path, hash=None):
+        if path in self.paths:
+            return
+        self.paths.add(path)
+        name, ext = os.path.splitext(path)
+        group = self._group(name, ext)
+        group['paths'].add(path)
+        if hash:
+            self.hashes[hash] = path
+            self.hash_of[path] = hash
+            group['hashes'].add(hash)
+        else:
+            group['unhashed'].append(path)
+
+        match = SUFFIX_PATTERN.match(name)
+        if match:
+            base = self._group(match.group(1), ext)
+            base['max_suffix'] = max(base['max_suffix'], int(match.group(2)))
+            base['paths'].add(path)
+            if hash:
+                base['hashes'].add(hash)
+            else:
+                base['unhashed'].append(path)
+
+    # path of a file in the name group of dst_path with the given contents, or None
+    def find_same_contents(self, dst_path, hash):
+        name, ext = os.path.splitext(dst_path)
+        group = self._group(name, ext)
+        if hash in group['hashes']:
+            return self.hashes.get(hash, dst_path)
+        while group['unhashed']:
+            path = group['unhashed'].pop()
+            path_hash = self.hash_func(path)
+            if not path_hash:
+                continue
+            self._set_hash(path, path_hash)
+            if path_hash == hash:
+                logger.debug("file with same contents in destination: %s", path)
+                return path
+        return None
+
+    # a file that is gone from destination; its alternative number stays taken, so later names stay unique
+    def remove(self, path):
+        if path not in self.paths:
+            return
+        self.paths.discard(path)
+        hash = self.hash_of.pop(path, None)
+        same_hash = None
+        for key in self._keys(path):
+            group = self.groups[key]
+            group['paths'].discard(path)
+            if path in group['unhashed']:
+                group['unhashed'].remove(path)
+            if hash:
+                other = next((other for other in group['paths'] if self.hash_of.get(other) == hash), None)
+                if other:
+                    same_hash = other
+                else:
+                    group['hashes'].discard(hash)
+        if hash and self.hashes.get(hash) == path:
+            if same_hash:
+                self.hashes[hash] = same_hash
+            else:
+                del self.hashes[hash]
+
+    # the files named like dst_path, with or without an alternative number
+    def group_paths(self, dst_path):
+        name, ext = os.path.splitext(dst_path)
+        return list(self._group(name, ext)['paths'])
+
+    def _keys(self, path):
+        name, ext = os.path.splitext(path)
+        keys = [(name, ext.lower())]
+        match = SUFFIX_PATTERN.match(name)
+        if match:
+            keys.append((match.group(1), ext.lower()))
+        return keys
+
+    # a file hashed through one group is moved to the hashed set of the other group too
+    def _set_hash(self, path, hash):
+        self.hashes[hash] = path
+        self.hash_of[path] = hash
+        for key in self._keys(path):
+            group = self.groups[key]
+            group['hashes'].add(hash)
+            if path in group['unhashed']:
+                group['unhashed'].remove(path)
+
+    def next_suffix(self, dst_path):
+        name, ext = os.path.splitext(dst_path)
+        return self._group(name, ext)['max_suffix'] + 1
+
+########################################################################
+
+testdir = "D:\\tmp\\test\\"
+
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("mydest")
+
+    files = []
+    myfile.all_files_at_path(testdir, files, [])
+    dstindex = DestinationIndex(files)
+    for file in files:
+        logger.info(f"{file}: next suffix {dstindex.next_suffix(file)}")
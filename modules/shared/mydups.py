@@ -0,0 +1,78 @@
+import logging
+import os
+from collections import defaultdict
+
+import modules.shared.myfile as myfile
+
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+# Finds groups of identical files in three tiers, each reading more of fewer files:
+# - files with a unique size can not have duplicates and are not read at all,
+# - files with the same size are compared by the hash of their first and last bytes,
+# - only files that still collide get a full hash.
+# hash_func computes the full hash, e.g. MetadataIndex.get_hash to reuse hashes from earlier runs.
+# Returns {full hash: [paths]} for groups of 2 or more files and counters of the work done.
+def find_duplicates(files, algorithm=myfile.DEFAULT_HASH_ALGORITHM, hash_func=None):
+    if not hash_func:
+        hash_func = lambda path: myfile.get_hash_from_contents(path, algorithm)
+    stats = {
+        'files': 0,
+        'bytes_total': 0,
+        'bytes_read': 0,
+        'partial_hashed': 0,
+        'full_hashed': 0,
+    }
+
+    by_size = defaultdict(list)
+    for path in files:
+        size = os.path.getsize(path)
+        by_size[size].append(path)
+        stats['files'] += 1
+        stats['bytes_total'] += size
+    logger.debug(f"{stats['files']} files have {len(by_size)} different sizes")
+
+    duplicates = {}
+    for size, same_size in by_size.items():
+        if len(same_size) < 2:
+            continue
+        # small files are read whole by the partial hash anyway, go straight to the full hash
+        if size <= 2 * myfile.PARTIAL_HASH_SIZE:
+            candidates = [same_size]
+        else:
+            by_partial = defaultdict(list)
+            for path in same_size:
+                by_partial[myfile.get_partial_hash(path, size, algorithm)].append(path)
+                stats['partial_hashed'] += 1
+                stats['bytes_read'] += 2 * myfile.PARTIAL_HASH_SIZE
+            candidates = [paths for partial, paths in by_partial.items() if partial and len(paths) > 1]
+
+        for paths in candidates:
+            by_hash = defaultdict(list)
+            for path in paths:
+                by_hash[hash_func(path)].append(path)
+                stats['full_hashed'] += 1
+                stats['bytes_read'] += size
+            for hash, same_hash in by_hash.items():
+                if hash and len(same_hash) > 1:
+                    duplicates[hash] = same_hash
+
+    logger.info(f"found {len(duplicates)} groups of identical files among {stats['files']} files, "
+                f"read {stats['bytes_read']} of {stats['bytes_total']} bytes")
+    return duplicates, stats
+
+########################################################################
+
+testdir = "D:\\tmp\\test\\"
+
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("mydups")
+
+    files = []
+    myfile.all_files_at_path(testdir, files, [])
+    duplicates, stats = find_duplicates(files)
+    for hash, paths in duplicates.items():
+        logger.info(f"{hash}: {paths}")
+    logger.info(f"stats={stats}")
@@ -1,62 +1,222 @@
+import fnmatch
 import tempfile
 import zipfile
 import tarfile
 import logging
 import hashlib
+import heapq
 import os
 import shutil
+import threading
+from collections import namedtuple
+
+# optional, fast non-cryptographic hashing: pip install xxhash
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+import modules.shared.myprof as myprof
 
 logger = logging.getLogger(__name__)
 
+HASH_CHUNK_SIZE = 1024 * 1024
+PARTIAL_HASH_SIZE = 64 * 1024
+# threads listing folders, and folders listed ahead of the walk per thread
+DEFAULT_WALK_THREADS = 8
+WALK_AHEAD_PER_THREAD = 16
+DEFAULT_HASH_ALGORITHM = 'sha256'
+HASH_ALGORITHMS = ['sha256', 'blake2b']
+if xxhash:
+    HASH_ALGORITHMS.append('xxh3_128')
+
 from modules.shared.mylog import setup_logging
+import modules.shared.myfiletype as myfiletype
+
+# what iter_files yields for each file, from the stat cached by scandir where the platform has it
+FileRecord = namedtuple('FileRecord', ['path', 'size', 'mtime_ns', 'inode'])
+
+# Walks the tree at path with a stack of folders instead of recursion, yielding a FileRecord
+# for each file as soon as its folder is listed. Only the folders waiting to be listed are kept in memory.
+# include and exclude are lists of glob patterns for names, e.g. ['*.jpg', '*.png'];
+# a file is yielded when it matches some include (or there are none) and no exclude,
+# a folder matching some exclude is not entered. Symbolic links to folders are not followed, like os.walk.
+# Entries are sorted by name in each folder, so the order does not depend on the file system.
+# With threads > 1, the next folders are listed in a thread pool while the caller processes
+# the files of the current one, which hides the latency of network shares; the order stays the same.
+def iter_files(path, include=None, exclude=None, threads=1):
+    if os.path.isfile(path):
+        st = os.stat(path)
+        yield FileRecord(path, st.st_size, st.st_mtime_ns, st.st_ino)
+        return
+    if threads > 1:
+        yield from _ParallelWalk(path, include, exclude, threads)
+        return
+    folders = [path]
+    while folders:
+        files, subfolders = _list_folder(folders.pop(), include, exclude)
+        yield from files
+        # the stack is last in first out, so push the subfolders reversed to walk them in name order
+        folders.extend(reversed(subfolders))
+
+# Listing a folder queues the listings of its subfolders, keyed by their position in the walk:
+# the key of the i-th subfolder of the folder with key k is k + (i,), so keys sort in walk order.
+# Threads always list the queued folder that comes first in the walk, and stop while
+# WALK_AHEAD_PER_THREAD * threads folders are listed and not walked yet, which bounds the memory.
+# When the walk reaches a folder still waiting in the queue, it takes it from the queue and lists it itself.
+class _ParallelWalk:
+    def __init__(self, path, include, exclude, threads):
+        self.include = include
+        self.exclude = exclude
+        self.limit = WALK_AHEAD_PER_THREAD * threads
+        self.cv = threading.Condition()
+        self.heap = []
+        self.queued = {}
+        self.listed = {}
+        self.outstanding = 0
+        self.closed = False
+        self._queue((), path)
+        self.threads = [threading.Thread(target=self._work, name='walk', daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _queue(self, key, folder):
+        self.queued[key] = folder
+        heapq.heappush(self.heap, key)
+
+    def _take(self):
+        while self.heap:
+            key = heapq.heappop(self.heap)
+            folder = self.queued.pop(key, None)
+            if folder is not None:
+                return key, folder
+        return None, None
 
-def all_files_at_path(path, files_at_path, tempdirs_for_path, hashtable) :
-    logger.debug(f"start collecting all the files at {path} with {len(files_at_path)} files and {len(hashtable)} unique hashes")
-    if os.path.isdir(path):
-        logger.debug(f"{path} is a directory, walk through the entries")
-        dirEntries = os.scandir(path)
-        for entry in dirEntries :
-            all_files_at_path(os.path.join(path, entry.name), files_at_path, tempdirs_for_path, hashtable)
-        dirEntries.close()
-    elif os.path.isfile(path):
-        logger.debug(f"{path} is a file, see whether it is an archive")
-        if isarchive(path):
-            logger.debug(f"{path} is an archive")
-            temp_dir = extract_totemp(path)
+    def _list(self, key, folder):
+        files, subfolders = _list_folder(folder, self.include, self.exclude)
+        with self.cv:
+            for i, subfolder in enumerate(subfolders):
+                self._queue(key + (i,), subfolder)
+            self.cv.notify_all()
+        return files, subfolders
+
+    def _work(self):
+        while True:
+            with self.cv:
+                while not self.closed and (not self.queued or self.outstanding >= self.limit):
+                    self.cv.wait()
+                if self.closed:
+                    return
+                key, folder = self._take()
+                self.outstanding += 1
+            try:
+                listing = self._list(key, folder)
+            except Exception as e:
+                # the walk waits for this listing, it must not be lost with the thread
+                logger.error(f"failed to list {folder}: {e}")
+                listing = ([], [])
+            with self.cv:
+                self.listed[key] = listing
+                self.cv.notify_all()
+
+    def __iter__(self):
+        try:
+            stack = [()]
+            while stack:
+                key = stack.pop()
+                with self.cv:
+                    folder = self.queued.pop(key, None)
+                    while folder is None and key not in self.listed:
+                        self.cv.wait()
+                    listing = self.listed.pop(key, None)
+                    if listing:
+                        self.outstanding -= 1
+                        self.cv.notify_all()
+                files, subfolders = listing or self._list(key, folder)
+                yield from files
+                stack.extend(key + (i,) for i in reversed(range(len(subfolders))))
+        finally:
+            with self.cv:
+                self.closed = True
+                self.cv.notify_all()
+            for thread in self.threads:
+                thread.join()
+
+@myprof.timed('list_folder')
+def _list_folder(folder, include, exclude):
+    files = []
+    subfolders = []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if exclude and any(fnmatch.fnmatch(entry.name, pattern) for pattern in exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif entry.is_file():
+                    if include and not any(fnmatch.fnmatch(entry.name, pattern) for pattern in include):
+                        continue
+                    st = entry.stat()
+                    files.append(FileRecord(entry.path, st.st_size, st.st_mtime_ns, st.st_ino))
+                else:
+                    logger.warning(f"{entry.path} is neither a folder nor a file, skipping")
+    except OSError as e:
+        logger.warning(f"failed to list {folder}: {e}")
+    return files, subfolders
+
+# Yields the paths of all the files at path, extracting archives to temp folders recorded in tempdirs_for_path.
+# With archives, archive files are collected there instead of being extracted.
+def iter_files_at_path(path, tempdirs_for_path, archives=None, include=None, exclude=None, threads=1):
+    for file_path, _ in iter_typed_files_at_path(path, tempdirs_for_path, archives, include, exclude, threads):
+        yield file_path
+
+# same as iter_files_at_path with the myfiletype.FileType of every file, so that it is classified only once
+def iter_typed_files_at_path(path, tempdirs_for_path, archives=None, include=None, exclude=None, threads=1):
+    for record in iter_files(path, include, exclude, threads):
+        filetype = myfiletype.classify(record.path)
+        if not isarchive(record.path, filetype):
+            yield record.path, filetype
+        elif archives is not None:
+            logger.debug("%s is an archive, will be streamed", record.path)
+            archives.append(record.path)
+        else:
+            logger.debug("%s is an archive", record.path)
+            temp_dir = extract_totemp(record.path, filetype)
             tempdirs_for_path.append(temp_dir)
-            all_files_at_path(temp_dir, files_at_path, tempdirs_for_path, hashtable)           
+            yield from iter_typed_files_at_path(temp_dir, tempdirs_for_path, include=include, exclude=exclude, threads=threads)
+
+# hashing every file is slow, pass hashtable only when a hash of each file is needed;
+# mydups.find_duplicates finds identical files while reading only a fraction of them.
+# With archives, archive files are collected there instead of being extracted to temp folders.
+def all_files_at_path(path, files_at_path, tempdirs_for_path, hashtable=None, archives=None) :
+    logger.debug("start collecting all the files at %s with %s files", path, len(files_at_path))
+    for file_path in iter_files_at_path(path, tempdirs_for_path, archives):
+        files_at_path.append(file_path)
+        if hashtable is None:
+            continue
+        hash = get_hash_from_contents(file_path)
+        if hash in hashtable:
+            hashtable[hash].append(file_path)
         else:
-            logger.debug(f"{path} is a simple file, adding")
-            files_at_path.append(path)
-            hash = get_hash_from_contents(path)
-            if hash in hashtable:
-                files = hashtable[hash]
-                files.append(path)
-            else:
-                logger.debug(f"hash is not in the table")
-                files = [path]
-                hashtable[hash] = files
-            
-    else:
-        logger.warning(f"{path} is neither a folder nor a file, skipping")
-
-def count_files_in_folder(folder):
-    files_in_folder = 0
-    for _, _, folder_files in os.walk(folder):
-        files_in_folder += len(folder_files)
-    return files_in_folder
-
-def isarchive(file_path):
-    if file_path.lower().endswith(('.pptx', '.kmz', '.docx')):
-        return False
-    return tarfile.is_tarfile(file_path) or zipfile.is_zipfile(file_path)
-
-def extract_totemp(archive_path):
+            logger.debug("hash is not in the table")
+            hashtable[hash] = [file_path]
+
+def count_files_in_folder(folder, threads=DEFAULT_WALK_THREADS):
+    return sum(1 for _ in iter_files(folder, threads=threads))
+
+def isarchive(file_path, filetype=None):
+    if not filetype:
+        filetype = myfiletype.classify(file_path)
+    return filetype.kind == myfiletype.KIND_ARCHIVE
+
+def extract_totemp(archive_path, filetype=None):
     temp_dir = tempfile.mkdtemp(prefix="pyutils_")
 
-    if tarfile.is_tarfile(archive_path):
+    if not filetype:
+        filetype = myfiletype.classify(archive_path)
+    if filetype.format == 'TAR':
         extract_tar(archive_path, temp_dir)
-    elif zipfile.is_zipfile(archive_path):
+    elif filetype.format == 'ZIP':
         extract_zip(archive_path, temp_dir)
 
     return temp_dir
@@ -86,19 +246,107 @@ def extract_tar(tar_path, temp_dir):
         tar_ref.extractall(temp_dir)
     logger.info(f"Extracted {tar_path} to temp dir: {temp_dir}")
 
+def new_hasher(algorithm):
+    if algorithm == 'xxh3_128':
+        if not xxhash:
+            raise ValueError("xxh3_128 needs the xxhash package")
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+# hashes other than the default are prefixed with the algorithm name,
+# so hashes computed with different algorithms never compare equal
+def hash_algorithm_of(hash):
+    algorithm, sep, _ = hash.partition(':')
+    return algorithm if sep else DEFAULT_HASH_ALGORITHM
+
 # https://towardsdev.com/simplifying-duplicate-image-detection-across-various-sources-a-practical-guide-f530666c0de8
-def get_hash_from_contents(file_path) :
+# reads the file through one reused buffer, so memory does not depend on the file size
+@myprof.timed('hash', path_arg=0)
+def get_hash_from_contents(file_path, algorithm=DEFAULT_HASH_ALGORITHM) :
     try:
-        with open(file_path, "rb") as f:
-            img_data = f.read()
-            img_hash = hashlib.sha256(img_data).hexdigest()
-            return img_hash
+        hasher = new_hasher(algorithm)
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(file_path, "rb", buffering=0) as f:
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                hasher.update(view[:size])
+        return hash_digest(hasher, algorithm)
     except Exception as e:
         logger.error("Failed to read image file %s: %s", file_path, e)
         return None
 
+def hash_digest(hasher, algorithm):
+    digest = hasher.hexdigest()
+    if algorithm != DEFAULT_HASH_ALGORITHM:
+        digest = f"{algorithm}:{digest}"
+    return digest
+
+# hash of head plus the rest of fileobj, and their number of bytes, without writing them anywhere
+def hash_stream(fileobj, head=b'', algorithm=DEFAULT_HASH_ALGORITHM):
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    hasher.update(head)
+    size = len(head)
+    while True:
+        read = fileobj.readinto(buffer)
+        if not read:
+            break
+        hasher.update(view[:read])
+        size += read
+    return hash_digest(hasher, algorithm), size
+
+# copies fileobj after the already read head bytes into dst_path, hashing on the way;
+# returns the hash of head plus the rest and the number of bytes written
+def copy_stream_hashed(fileobj, dst_path, head=b'', algorithm=DEFAULT_HASH_ALGORITHM):
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    size = len(head)
+    with open(dst_path, "wb") as f:
+        hasher.update(head)
+        f.write(head)
+        while True:
+            read = fileobj.readinto(buffer)
+            if not read:
+                break
+            hasher.update(view[:read])
+            f.write(view[:read])
+            size += read
+    return hash_digest(hasher, algorithm), size
+
+# hash of the first and the last PARTIAL_HASH_SIZE bytes, only good for ruling out duplicates
+@myprof.timed('partial_hash', path_arg=0)
+def get_partial_hash(file_path, size, algorithm=DEFAULT_HASH_ALGORITHM):
+    try:
+        hasher = new_hasher(algorithm)
+        with open(file_path, "rb") as f:
+            hasher.update(f.read(PARTIAL_HASH_SIZE))
+            if size > PARTIAL_HASH_SIZE:
+                f.seek(max(PARTIAL_HASH_SIZE, size - PARTIAL_HASH_SIZE))
+                hasher.update(f.read(PARTIAL_HASH_SIZE))
+        return hasher.hexdigest()
+    except Exception as e:
+        logger.error("Failed to read file %s: %s", file_path, e)
+        return None
+
 ########################################################################
 
+def benchmark_hash_algorithms(test_file, rounds=3):
+    size = os.path.getsize(test_file)
+    logger.info(f"Benchmarking hash algorithms on {test_file} with {size} bytes, best of {rounds} rounds")
+    for algorithm in HASH_ALGORITHMS:
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            get_hash_from_contents(test_file, algorithm)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        logger.info(f"{algorithm:<10}: {size / best / 2**30:.2f} GB/s")
+
 def test_if_zip(test_file):
     
     logger.info(f"Testing test_if_zip for {test_file}")
@@ -109,11 +357,19 @@ def test_if_zip(test_file):
 
 import time
 import json
+import sys
+import modules.shared.mydups as mydups
 if __name__ == "__main__":
     shutup_modules= []
     setup_logging(log_level=logging.INFO, shutup_modules=shutup_modules)
     logger = logging.getLogger("myfile")
 
+    # python -m modules.shared.myfile <file>... benchmarks hashing of the given files
+    if len(sys.argv) > 1:
+        for test_file in sys.argv[1:]:
+            benchmark_hash_algorithms(test_file)
+        sys.exit(0)
+
     #test_file = "tmp/TipsForJapan.pptx"
     #test_if_zip(test_file)
     #extract_flat("../tmp/Private.zip", "../tmp/out")
@@ -131,34 +387,33 @@ if __name__ == "__main__":
     for testdir in testdirs:
         files = []
         tempdirs = []
-        hashtable = {} 
         start = time.time()
         logger.info(f"TEST for {testdir}")
-        all_files_at_path(testdir, files, tempdirs, hashtable = hashtable)
+        all_files_at_path(testdir, files, tempdirs)
         num_files = len(files)
-        num_unique_files = len(hashtable)
         num_tempdirs = len(tempdirs)
+        duplicates, stats = mydups.find_duplicates(files)
+        num_unique_files = num_files - sum(len(dups) - 1 for dups in duplicates.values())
         num_dups = 0
-        for hash, files in hashtable.items():
-            num_files = len(files)
-            if num_files > 1:
-                names = []
-                for file in files:
-                    basename = os.path.basename(file)
-                    if basename not in names:
-                        names.append(basename)
-                unique_names = len(names)
-                logger.info(f"file duplicated {num_files} times with {unique_names} different basenames")
-                if unique_names > 1:
-                    num_dups += 1
-                    dups_hash[hash] = files
+        for hash, dups in duplicates.items():
+            names = []
+            for file in dups:
+                basename = os.path.basename(file)
+                if basename not in names:
+                    names.append(basename)
+            unique_names = len(names)
+            logger.info(f"file duplicated {len(dups)} times with {unique_names} different basenames")
+            if unique_names > 1:
+                num_dups += 1
+                dups_hash[hash] = dups
         
         end = time.time()
         logger.info(f"COMPLETED in {(end-start):.2f} seconds: \
                     \n\tTotal files     : {num_files} \
                     \n\tUnique files    : {num_unique_files} \
                     \n\tArchives        : {num_tempdirs} \
-                    \n\tDups diff names : {num_dups}")
+                    \n\tDups diff names : {num_dups} \
+                    \n\tBytes read      : {stats['bytes_read']} of {stats['bytes_total']}")
     
     with open(dups_file, 'w', encoding='utf-8') as f:
         json.dump(dups_hash, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,107 @@
+import logging
+import os
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+import modules.shared.myprof as myprof
+
+# Classifies files by the magic bytes of their first CLASSIFY_SIZE bytes, read once.
+# The extension is only used where the header is ambiguous: RAW formats built on TIFF,
+# compressed tars, and office documents that are zip files inside.
+CLASSIFY_SIZE = 4096
+
+KIND_IMAGE = 'image'
+KIND_VIDEO = 'video'
+KIND_PDF = 'pdf'
+KIND_ARCHIVE = 'archive'
+KIND_OTHER = 'other'
+
+# kind is one of the KIND_ values, format names the format within the kind, e.g. JPEG or ZIP
+FileType = namedtuple('FileType', ['kind', 'format'])
+OTHER = FileType(KIND_OTHER, None)
+
+RAW_EXTENSIONS = ('.cr2', '.nef', '.nrw', '.arw', '.srf', '.sr2', '.dng', '.pef', '.srw', '.3fr', '.erf', '.kdc')
+COMPRESSED_TAR_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ZIP_DOCUMENT_EXTENSIONS = ('.pptx', '.kmz', '.docx', '.xlsx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk')
+
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1', b'avif', b'avis'}
+RAW_BRANDS = {b'crx '}
+VIDEO_BRANDS = {b'isom', b'iso2', b'iso4', b'iso5', b'iso6', b'mp41', b'mp42', b'avc1', b'qt  ', b'M4V ', b'M4VH',
+                b'M4VP', b'3gp4', b'3gp5', b'3gp6', b'3g2a', b'3g2b', b'dash', b'XAVC', b'mmp4', b'MSNV'}
+QUICKTIME_ATOMS = {b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'}
+
+@myprof.timed('classify', path_arg=0)
+def classify(path):
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(CLASSIFY_SIZE)
+    except OSError as e:
+        logger.warning(f"failed to read {path}: {e}")
+        return OTHER
+    return classify_bytes(header, path)
+
+def classify_bytes(header, name=''):
+    name = name.lower()
+
+    if header[:3] == b'\xff\xd8\xff':
+        return FileType(KIND_IMAGE, 'JPEG')
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+        return FileType(KIND_IMAGE, 'PNG')
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return FileType(KIND_IMAGE, 'GIF')
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        if header[8:10] == b'CR' or name.endswith(RAW_EXTENSIONS):
+            return FileType(KIND_IMAGE, 'RAW')
+        return FileType(KIND_IMAGE, 'TIFF')
+    if header[:4] in (b'IIRO', b'IIRS', b'IIU\x00') or header[:15] == b'FUJIFILMCCD-RAW':
+        return FileType(KIND_IMAGE, 'RAW')
+    if header[:2] == b'BM' and len(header) >= 18 and header[14] in (12, 40, 52, 56, 64, 108, 124) and not any(header[15:18]):
+        return FileType(KIND_IMAGE, 'BMP')
+    if header[:4] == b'RIFF':
+        if header[8:12] == b'WEBP':
+            return FileType(KIND_IMAGE, 'WEBP')
+        if header[8:12] == b'AVI ':
+            return FileType(KIND_VIDEO, 'AVI')
+    if header[4:8] == b'ftyp':
+        brand = header[8:12]
+        if brand in HEIF_BRANDS:
+            return FileType(KIND_IMAGE, 'HEIF')
+        if brand in RAW_BRANDS:
+            return FileType(KIND_IMAGE, 'RAW')
+        if brand in VIDEO_BRANDS or brand.startswith((b'mp4', b'3g', b'M4')):
+            return FileType(KIND_VIDEO, 'MOV' if brand == b'qt  ' else 'MP4')
+    if header[4:8] in QUICKTIME_ATOMS:
+        return FileType(KIND_VIDEO, 'MOV')
+    if header[:4] == b'\x1aE\xdf\xa3':
+        return FileType(KIND_VIDEO, 'MKV')
+    if header[:4] in (b'\x00\x00\x01\xba', b'\x00\x00\x01\xb3'):
+        return FileType(KIND_VIDEO, 'MPEG')
+    if len(header) > 376 and header[0] == header[188] == header[376] == 0x47:
+        return FileType(KIND_VIDEO, 'MTS')
+    if header[:5] == b'%PDF-':
+        return FileType(KIND_PDF, 'PDF')
+    if header[:4] in (b'PK\x03\x04', b'PK\x05\x06'):
+        if name.endswith(ZIP_DOCUMENT_EXTENSIONS):
+            return OTHER
+        return FileType(KIND_ARCHIVE, 'ZIP')
+    if header[257:262] == b'ustar':
+        return FileType(KIND_ARCHIVE, 'TAR')
+    if header[:2] == b'\x1f\x8b' or header[:3] == b'BZh' or header[:6] == b'\xfd7zXZ\x00':
+        if name.endswith(COMPRESSED_TAR_EXTENSIONS):
+            return FileType(KIND_ARCHIVE, 'TAR')
+
+    return OTHER
+
+########################################################################
+
+testdir = "D:\\tmp\\test\\"
+
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.INFO)
+    logger = logging.getLogger("myfiletype")
+
+    for test in os.listdir(testdir):
+        test = os.path.join(testdir, test)
+        logger.info(f"{test}: {classify(test)}")
@@ -0,0 +1,174 @@
+import logging
+import os
+import sqlite3
+
+import modules.shared.myfile as myfile
+
+DEFAULT_INDEX_FILE = 'data/metadata_index.db'
+DEFAULT_COMMIT_EVERY = 1000
+# columns added after the first version, added to older indexes when opened
+ADDED_COLUMNS = [('dhash', 'TEXT'), ('phash', 'TEXT'), ('pixels', 'INTEGER')]
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+import modules.shared.myprof as myprof
+
+# an entry is valid only while the file keeps the same size, mtime and inode
+class MetadataIndex:
+    def __init__(self, index_file=DEFAULT_INDEX_FILE, rebuild=False, commit_every=DEFAULT_COMMIT_EVERY,
+                 hash_algorithm=myfile.DEFAULT_HASH_ALGORITHM):
+        self.index_file = index_file
+        self.hash_algorithm = hash_algorithm
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        # lookups of metadata, of content hashes and of perceptual hashes are counted apart
+        self.hits = 0
+        self.misses = 0
+        self.hash_hits = 0
+        self.hash_misses = 0
+        self.image_hash_hits = 0
+        self.image_hash_misses = 0
+        self.conn = self._open_index()
+        if rebuild:
+            self.invalidate()
+        logger.info(f"Metadata index loaded from {self.index_file} with {self.get_size()} entries")
+
+    def _open_index(self):
+        index_dir = os.path.dirname(self.index_file)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        conn = sqlite3.connect(self.index_file)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        inode INTEGER NOT NULL,
+                        year TEXT,
+                        date TEXT,
+                        lat REAL,
+                        lon REAL,
+                        hash TEXT,
+                        dhash TEXT,
+                        phash TEXT,
+                        pixels INTEGER)''')
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+        for column, column_type in ADDED_COLUMNS:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+        conn.commit()
+        return conn
+
+    def get_size(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def invalidate(self):
+        self.conn.execute("DELETE FROM files")
+        self.conn.commit()
+        logger.info(f"Metadata index {self.index_file} invalidated")
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+        logger.info(f"Metadata index closed with {self.hits} hits and {self.misses} misses for metadata, "
+                    f"{self.hash_hits} and {self.hash_misses} for hashes, "
+                    f"{self.image_hash_hits} and {self.image_hash_misses} for image hashes")
+
+    # a file that can not be read is a miss, like with no index at all
+    def _stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError as e:
+            logger.error(f"Failed to look up {path} in the metadata index: {e}")
+            return None
+
+    def _lookup(self, path, columns):
+        st = self._stat(path)
+        if st is None:
+            return None, None
+        row = self.conn.execute(
+            f"SELECT {columns} FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+            (path, st.st_size, st.st_mtime_ns, st.st_ino)).fetchone()
+        return st, row
+
+    def _store(self, path, st, **values):
+        # a stale row is replaced as a whole, so metadata and hash never mix two versions of a file
+        self.conn.execute(
+            '''INSERT INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)
+               ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode,
+                   year = NULL, date = NULL, lat = NULL, lon = NULL, hash = NULL, dhash = NULL, phash = NULL, pixels = NULL
+               WHERE size != excluded.size OR mtime_ns != excluded.mtime_ns OR inode != excluded.inode''',
+            (path, st.st_size, st.st_mtime_ns, st.st_ino))
+        assignments = ', '.join(f"{column} = ?" for column in values)
+        self.conn.execute(f"UPDATE files SET {assignments} WHERE path = ?", (*values.values(), path))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    @myprof.timed('index', path_arg=1)
+    def get_metadata(self, path):
+        _, row = self._lookup(path, "year, date, lat, lon")
+        if row and row[0] is not None:
+            self.hits += 1
+            logger.debug("Metadata found in index for %s: %s", path, row)
+            return row
+        self.misses += 1
+        return None
+
+    def put_metadata(self, path, year_taken, date_taken, lat, lon):
+        st = self._stat(path)
+        if st is None:
+            return
+        self._store(path, st, year=str(year_taken), date=date_taken, lat=lat, lon=lon)
+
+    @myprof.timed('index', path_arg=1)
+    def get_hash(self, path):
+        st, row = self._lookup(path, "hash")
+        if row and row[0] and myfile.hash_algorithm_of(row[0]) == self.hash_algorithm:
+            self.hash_hits += 1
+            return row[0]
+        self.hash_misses += 1
+        if st is None:
+            return None
+        hash = myfile.get_hash_from_contents(path, self.hash_algorithm)
+        if hash:
+            self._store(path, st, hash=hash)
+        return hash
+
+    # perceptual hashes as ints and the number of pixels, (None, None, 0) for a file that could not be decoded,
+    # None when they have not been stored yet
+    @myprof.timed('index', path_arg=1)
+    def get_image_hashes(self, path):
+        _, row = self._lookup(path, "dhash, phash, pixels")
+        if row and row[0] is not None:
+            self.image_hash_hits += 1
+            if not row[0]:
+                return None, None, 0
+            return int(row[0], 16), int(row[1], 16), row[2]
+        self.image_hash_misses += 1
+        return None
+
+    def put_image_hashes(self, path, dhash, phash, pixels):
+        st = self._stat(path)
+        if st is None:
+            return
+        if dhash is None:
+            self._store(path, st, dhash='', phash='', pixels=0)
+        else:
+            self._store(path, st, dhash=f"{dhash:016x}", phash=f"{phash:016x}", pixels=pixels)
+
+########################################################################
+
+testdir = "D:\\tmp\\test\\"
+
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("myindex")
+    mdindex = MetadataIndex(index_file="test_index.db")
+
+    for test in os.listdir(testdir):
+        test = os.path.join(testdir, test)
+        logger.info(f"TEST FILE: {test}, hash={mdindex.get_hash(test)}, hash again={mdindex.get_hash(test)}")
+    mdindex.close()
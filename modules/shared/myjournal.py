@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+DEFAULT_JOURNAL_DIR = 'data'
+DEFAULT_JOURNAL_NAME = 'photos_organizer1_journal'
+DEFAULT_SYNC_EVERY = 100
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+OP_RUN = 'run'
+OP_PLAN = 'plan'
+OP_DONE = 'done'
+OP_SKIP = 'skip'
+
+# every src/dst pair has its own default journal, so that a run for another pair does not overwrite it
+def default_journal_file(src, dst):
+    key = hashlib.sha1(f"{src}\n{dst}".encode('utf-8')).hexdigest()[:12]
+    return os.path.join(DEFAULT_JOURNAL_DIR, f"{DEFAULT_JOURNAL_NAME}_{key}.jsonl")
+
+# returns src: dst of completed copies, src: dst of unfinished copies and the set of skipped srcs;
+# raises ValueError when the journal was written for another src/dst pair
+def read_journal(journal_file, src=None, dst=None):
+    done = {}
+    planned = {}
+    skipped = set()
+    if not os.path.exists(journal_file):
+        logger.warning(f"No journal at {journal_file}, nothing to resume")
+        return done, planned, skipped
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line_num, line in enumerate(f, 1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Ignoring incomplete record at line {line_num} of {journal_file}")
+                continue
+            op = record.get('op')
+            if op == OP_RUN and src and (record.get('src'), record.get('dst')) != (src, dst):
+                raise ValueError(f"Journal {journal_file} was written for {record.get('src')} -> {record.get('dst')}, not {src} -> {dst}")
+            elif op == OP_PLAN:
+                planned[record['src']] = record['dst']
+            elif op == OP_DONE:
+                planned.pop(record['src'], None)
+                done[record['src']] = record['dst']
+            elif op == OP_SKIP:
+                skipped.add(record['src'])
+    logger.info(f"Journal loaded from {journal_file}: {len(done)} copied, {len(skipped)} skipped, {len(planned)} unfinished")
+    return done, planned, skipped
+
+# Append-only journal of a run, one json record per line:
+#   {"op": "run", "src": ..., "dst": ..., "time": ...}  the start of a run, written again on every resume
+#   {"op": "plan", "src": ..., "dst": ...}  a copy to dst is about to start
+#   {"op": "done", "src": ..., "dst": ...}  the copy is complete
+#   {"op": "skip", "src": ...}              the contents of src are already at destination
+# Every record is flushed to the OS when written, and fsynced every sync_every records and on close.
+# A crash may cut the last line, which is ignored when the journal is loaded.
+class Journal:
+    def __init__(self, journal_file=None, src=None, dst=None, resume=False,
+                 sync_every=DEFAULT_SYNC_EVERY):
+        self.journal_file = journal_file or default_journal_file(src, dst)
+        self.sync_every = sync_every
+        self.unsynced = 0
+        # src: dst of completed copies, and of planned copies not known to be complete
+        self.done = {}
+        self.planned = {}
+        self.skipped = set()
+        if resume:
+            self.done, self.planned, self.skipped = read_journal(self.journal_file, src, dst)
+        journal_dir = os.path.dirname(self.journal_file)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        self.file = open(self.journal_file, 'a' if resume else 'w', encoding='utf-8')
+        self._write({'op': OP_RUN, 'src': src, 'dst': dst, 'time': time.time()})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def plan(self, src, dst):
+        self.planned[src] = dst
+        self._write({'op': OP_PLAN, 'src': src, 'dst': dst})
+
+    def complete(self, src, dst):
+        self.planned.pop(src, None)
+        self.done[src] = dst
+        self._write({'op': OP_DONE, 'src': src, 'dst': dst})
+
+    def skip(self, src):
+        self.skipped.add(src)
+        self._write({'op': OP_SKIP, 'src': src})
+
+    def finished(self, src):
+        return src in self.done or src in self.skipped
+
+    # src: dst of copies planned and never completed, the destination may be missing or partly written
+    def unfinished(self):
+        return dict(self.planned)
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+########################################################################
+
+# python -m modules.shared.myjournal journal|src dst prints what a resumed run would skip and verify
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("myjournal")
+
+    if len(sys.argv) > 2:
+        journal_file = default_journal_file(os.path.abspath(sys.argv[1]), os.path.abspath(sys.argv[2]))
+    else:
+        journal_file = sys.argv[1]
+    done, planned, skipped = read_journal(journal_file)
+    for src, dst in planned.items():
+        logger.info(f"unfinished: {src} -> {dst}")
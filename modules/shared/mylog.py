@@ -1,14 +1,25 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import zlib
 
 DEFAULT_LOG_DIR = 'logs'
 DEFAULT_LOG_FILE = 'default.log'
 DEFAULT_LOG_LEVEL = logging.DEBUG
-DEFAULT_SHUTUP_MODULES = ['exif._image']
+DEFAULT_SHUTUP_MODULES = [('exif._image', logging.ERROR)]
 
-def setup_logging(log_file_name=DEFAULT_LOG_FILE, 
-                  log_level = DEFAULT_LOG_LEVEL, 
-                  shutup_modules = DEFAULT_SHUTUP_MODULES):
+# writes the records put in the queue by QueueHandler, started by setup_logging(queued=True)
+listener = None
+
+# With queued, loggers only put records in a queue and a background thread formats and writes them,
+# so a slow console or disk does not hold up the loops logging every file.
+def setup_logging(log_file_name=DEFAULT_LOG_FILE,
+                  log_level = DEFAULT_LOG_LEVEL,
+                  shutup_modules = DEFAULT_SHUTUP_MODULES,
+                  queued = False):
+    global listener
     log_format='%(asctime)s - %(levelname)s - %(name)s - %(message)s'
     log_handlers=[]
     log_handlers.append(logging.StreamHandler())
@@ -16,14 +27,54 @@ def setup_logging(log_file_name=DEFAULT_LOG_FILE,
         log_file = f"{DEFAULT_LOG_DIR}{os.sep}{log_file_name}"
         file_handler = logging.FileHandler(log_file, encoding='utf-8')
         log_handlers.append(file_handler)
-        
+
+    if queued and listener is None:
+        formatter = logging.Formatter(log_format)
+        for handler in log_handlers:
+            handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+        listener.start()
+        # registered after logging's own shutdown, so it runs first and the queue is written out
+        atexit.register(stop_logging)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        # only the message is merged with its arguments when queued, the listener's handlers format the line
+        queue_handler.setFormatter(logging.Formatter())
+        log_handlers = [queue_handler]
+
     logging.basicConfig(level=log_level,
                         format=log_format,
                         handlers=log_handlers)
 
     logger = logging.getLogger(__name__)
 
-    logger.info(f"Logging setup with level={log_level}")
+    logger.info(f"Logging setup with level={log_level}, queued={queued}")
     for module in shutup_modules:
         logger.info(f"Setting logging for {module[0]} to {module[1]}")
-        logging.getLogger(module[0]).setLevel(module[1])
\ No newline at end of file
+        logging.getLogger(module[0]).setLevel(module[1])
+
+# writes out the records still in the queue and stops the background thread
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+# in a forked worker process nothing writes out the queue inherited from the parent,
+# the records go to the parent's handlers directly instead
+def unqueue_logging():
+    global listener
+    if listener is None:
+        return
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+    listener = None
+
+# True for about one key in every, always for the same keys, so that either all or none
+# of the lines about a file are logged; every of 1 or less samples all the keys
+def sampled(key, every):
+    return every <= 1 or zlib.crc32(key.encode('utf-8', 'surrogateescape')) % every == 0
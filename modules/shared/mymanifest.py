@@ -0,0 +1,117 @@
+import logging
+import os
+import sqlite3
+import sys
+
+import modules.shared.myfile as myfile
+
+DEFAULT_MANIFEST_NAME = '.photos_organizer1_manifest.db'
+DEFAULT_COMMIT_EVERY = 1000
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+# Files at a destination folder, kept next to them so that a run starts from the manifest instead of walking
+# and stating the whole destination. Paths are stored relative to the destination and returned absolute.
+# The manifest is updated as files are copied; sync() compares it with a walk of the destination
+# for files added, removed or changed by other means. Without it, photos_organizer1 checks the files
+# named like a new one when the name comes up, and drops the ones that are gone.
+class DestinationManifest:
+    def __init__(self, root, manifest_file=None, commit_every=DEFAULT_COMMIT_EVERY):
+        self.root = root
+        self.manifest_file = manifest_file or os.path.join(root, DEFAULT_MANIFEST_NAME)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.is_new = not os.path.exists(self.manifest_file)
+        manifest_dir = os.path.dirname(self.manifest_file)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        self.conn = sqlite3.connect(self.manifest_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                             path TEXT PRIMARY KEY,
+                             size INTEGER NOT NULL,
+                             mtime_ns INTEGER NOT NULL,
+                             hash TEXT)''')
+        self.conn.commit()
+        logger.info(f"Destination manifest loaded from {self.manifest_file} with {self.get_size()} files")
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.root)
+
+    def _commit_later(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def get_size(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    # yields the absolute path and the hash, or None, of every file
+    def items(self):
+        for path, hash in self.conn.execute("SELECT path, hash FROM files"):
+            yield os.path.join(self.root, path), hash
+
+    # st is a myfile.FileRecord, the file is stated when there is none
+    def add(self, path, hash=None, st=None):
+        if st is None:
+            st = os.stat(path)
+            st = myfile.FileRecord(path, st.st_size, st.st_mtime_ns, st.st_ino)
+        self.conn.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                          (self._relpath(path), st.size, st.mtime_ns, hash))
+        self._commit_later()
+
+    def remove(self, path):
+        self.conn.execute("DELETE FROM files WHERE path = ?", (self._relpath(path),))
+        self._commit_later()
+
+    def get_hash(self, path):
+        row = self.conn.execute("SELECT hash FROM files WHERE path = ?", (self._relpath(path),)).fetchone()
+        return row[0] if row else None
+
+    def set_hash(self, path, hash):
+        self.conn.execute("UPDATE files SET hash = ? WHERE path = ?", (hash, self._relpath(path)))
+        self._commit_later()
+
+    # walked files, myfile.FileRecord, are the truth: new ones are added, missing ones removed,
+    # and the ones with another size or mtime lose their hash
+    def sync(self, records):
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self.conn.execute("SELECT path, size, mtime_ns FROM files")}
+        added = changed = 0
+        manifest_name = os.path.basename(self.manifest_file)
+        for record in records:
+            if os.path.basename(record.path).startswith(manifest_name):
+                continue
+            stats = known.pop(self._relpath(record.path), None)
+            if stats is None:
+                added += 1
+                self.add(record.path, st=record)
+            elif stats != (record.size, record.mtime_ns):
+                changed += 1
+                self.add(record.path, st=record)
+        for relpath in known:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (relpath,))
+        self.conn.commit()
+        self.uncommitted = 0
+        logger.info(f"Destination manifest synced with {self.root}: {added} added, {len(known)} removed, {changed} changed")
+        return added, len(known), changed
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+########################################################################
+
+testdir = "D:\\tmp\\test\\"
+
+# python -m modules.shared.mymanifest [folder] syncs the manifest of the folder with its contents
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("mymanifest")
+
+    root = sys.argv[1] if len(sys.argv) > 1 else testdir
+    manifest = DestinationManifest(root)
+    manifest.sync(myfile.iter_files(root))
+    manifest.close()
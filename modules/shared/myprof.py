@@ -0,0 +1,345 @@
+import cProfile
+import heapq
+import io
+import json
+import logging
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import wraps
+
+DEFAULT_TOP_FILES = 20
+# files whose timers are still added up, the least recently timed one is then ranked among the slowest
+DEFAULT_PENDING_FILES = 4096
+# durations are counted in buckets 2**(1/8) apart, percentiles are within about 5% of the measured ones
+BUCKETS_PER_DOUBLING = 8
+DEFAULT_TOP_FUNCTIONS = 30
+DEFAULT_TOP_ALLOCATIONS = 20
+PERCENTILES = (50, 90, 99)
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+# Timers for stages and functions, off unless start() is called:
+#   with myprof.timer('geocode'): ...               times a block
+#   @myprof.timed('exif', path_arg=0)               times every call, args[0] is the file it works on
+# Timers nest per thread. Each one records its duration under its name, the time spent in itself
+# but not in inner timers under the stack of timer names for flame graphs, and the duration for the
+# file it works on, given or inherited from an outer timer, for the list of the slowest files.
+# Memory does not grow with the run: timers keep a count, a total and a histogram of their durations,
+# and files leave the recently timed ones for the top_files slowest ones.
+# cProfile and tracemalloc can be limited to the calls of one timer, cProfile in the main thread only.
+
+# the running Profiler, None when not profiling: timers then cost one check
+profiler = None
+
+_no_timer = nullcontext()
+
+# count, total, min, max and histogram of the durations of one timer
+class _Durations:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        # bucket: number of durations, the bucket of zero is -inf
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        bucket = math.floor(math.log2(seconds) * BUCKETS_PER_DOUBLING) if seconds > 0 else -math.inf
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    # the middle of the bucket holding the percentile, within min and max
+    def percentile(self, percent):
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(2 ** ((bucket + 0.5) / BUCKETS_PER_DOUBLING), self.min), self.max)
+        return self.max
+
+class Profiler:
+    def __init__(self, capture_stage=None, cprofile=False, memory=False, top_files=DEFAULT_TOP_FILES,
+                 pending_files=DEFAULT_PENDING_FILES):
+        self.capture_stage = capture_stage
+        self.top_files = top_files
+        self.pending_limit = pending_files
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # name: _Durations of the timed calls
+        self.timings = {}
+        # path: [seconds in timers of the file not inside another timer of it, {timer name: seconds}]
+        # of the recently timed files, least recent first
+        self.pending_files = OrderedDict()
+        # heap of (seconds, path, {timer name: seconds}) of the slowest files no longer pending;
+        # a file timed again after leaving pending_files is added up again and merged in the report
+        self.slowest_files = []
+        # 'thread;outer;inner': seconds in the innermost timer itself
+        self.stacks = {}
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.memory = memory
+        # name: largest growth of traced memory over one call, and the allocations of that call
+        self.memory_peaks = {}
+        self.memory_top = []
+        if memory and not capture_stage:
+            tracemalloc.start()
+        self.start_time = time.perf_counter()
+
+    def _enter(self, timer):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        parent = stack[-1] if stack else None
+        if timer.path is None and parent:
+            timer.path = parent.path
+        timer.outer = parent.path != timer.path if parent else True
+        stack.append(timer)
+        if timer.name == self.capture_stage and not any(t.name == timer.name for t in stack[:-1]):
+            self._start_capture(timer)
+        timer.start = time.perf_counter()
+
+    def _exit(self, timer):
+        elapsed = time.perf_counter() - timer.start
+        if timer.capturing:
+            self._stop_capture(timer)
+        stack = self.local.stack
+        key = ';'.join([threading.current_thread().name.rstrip('_0123456789') or 'thread'] + [t.name for t in stack])
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        self._record(timer.name, elapsed, elapsed - timer.children, key, timer.path, timer.outer)
+
+    def _record(self, name, elapsed, self_time, key, path=None, outer=True):
+        with self.lock:
+            durations = self.timings.get(name)
+            if durations is None:
+                durations = self.timings[name] = _Durations()
+            durations.add(elapsed)
+            self.stacks[key] = self.stacks.get(key, 0.0) + self_time
+            if path:
+                entry = self.pending_files.get(path)
+                if entry is None:
+                    entry = self.pending_files[path] = [0.0, {}]
+                else:
+                    self.pending_files.move_to_end(path)
+                if outer:
+                    entry[0] += elapsed
+                entry[1][name] = entry[1].get(name, 0.0) + elapsed
+                if len(self.pending_files) > self.pending_limit:
+                    path, (seconds, timers) = self.pending_files.popitem(last=False)
+                    self._rank_file(path, seconds, timers)
+
+    def _rank_file(self, path, seconds, timers):
+        if len(self.slowest_files) < self.top_files:
+            heapq.heappush(self.slowest_files, (seconds, path, timers))
+        elif seconds > self.slowest_files[0][0]:
+            heapq.heapreplace(self.slowest_files, (seconds, path, timers))
+
+    def _start_capture(self, timer):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        timer.capturing = True
+        if self.cprofile:
+            self.cprofile.enable()
+        if self.memory:
+            tracemalloc.start()
+            timer.memory_start = tracemalloc.get_traced_memory()[0]
+
+    def _stop_capture(self, timer):
+        if self.cprofile:
+            self.cprofile.disable()
+        # tracing slows down everything, it is stopped outside the stage
+        if self.memory:
+            growth = tracemalloc.get_traced_memory()[1] - timer.memory_start
+            if growth > self.memory_peaks.get(timer.name, -1):
+                self.memory_peaks[timer.name] = growth
+                self.memory_top = _top_allocations(tracemalloc.take_snapshot())
+            tracemalloc.stop()
+
+    # a duration measured elsewhere, e.g. in a worker process
+    def add(self, name, seconds, path=None):
+        self._record(name, seconds, seconds, f"workers;{name}", path)
+
+    def report(self):
+        wall_time = time.perf_counter() - self.start_time
+        with self.lock:
+            timers = {name: _summary(durations, wall_time) for name, durations in self.timings.items()}
+            candidates = {}
+            ranked = [(path, seconds, file_timers) for seconds, path, file_timers in self.slowest_files]
+            pending = [(path, seconds, file_timers) for path, (seconds, file_timers) in self.pending_files.items()]
+            for path, seconds, file_timers in ranked + pending:
+                total, merged = candidates.get(path, (0.0, {}))
+                for name, timer_seconds in file_timers.items():
+                    merged[name] = merged.get(name, 0.0) + timer_seconds
+                candidates[path] = (total + seconds, merged)
+            slowest = heapq.nlargest(self.top_files, candidates.items(), key=lambda item: item[1][0])
+            files = [{'path': path, 'seconds': seconds, 'reason': _reason(file_timers),
+                      'timers': file_timers} for path, (seconds, file_timers) in slowest]
+        report = {
+            'wall_time': wall_time,
+            'timers': dict(sorted(timers.items(), key=lambda item: -item[1]['total'])),
+            'slowest_files': files,
+        }
+        if self.cprofile:
+            report['cprofile'] = {'stage': self.capture_stage, 'functions': _top_functions(self.cprofile)}
+        if self.memory and self.capture_stage:
+            report['tracemalloc'] = {
+                'stage': self.capture_stage,
+                'peak': self.memory_peaks.get(self.capture_stage, 0),
+                'top_allocations': self.memory_top,
+            }
+        elif self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            report['tracemalloc'] = {
+                'current': current,
+                'peak': peak,
+                'top_allocations': _top_allocations(tracemalloc.take_snapshot()),
+            }
+        return report
+
+    # collapsed stacks for flamegraph.pl, speedscope and the like: 'thread;outer;inner microseconds'
+    def write_stacks(self, stacks_file):
+        with self.lock, open(stacks_file, 'w', encoding='utf-8') as f:
+            for key, seconds in sorted(self.stacks.items()):
+                microseconds = int(seconds * 1e6)
+                if microseconds > 0:
+                    f.write(f"{key} {microseconds}\n")
+
+class _Timer:
+    __slots__ = ('profiler', 'name', 'path', 'outer', 'start', 'children', 'capturing', 'memory_start')
+
+    def __init__(self, profiler, name, path=None):
+        self.profiler = profiler
+        self.name = name
+        self.path = path
+        self.children = 0.0
+        self.capturing = False
+
+    def __enter__(self):
+        self.profiler._enter(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit(self)
+        return False
+
+def _summary(durations, wall_time):
+    summary = {
+        'count': durations.count,
+        'total': durations.total,
+        'mean': durations.total / durations.count,
+        'min': durations.min,
+        'max': durations.max,
+    }
+    for percent in PERCENTILES:
+        summary[f"p{percent}"] = durations.percentile(percent)
+    summary['share_of_wall'] = durations.total / wall_time if wall_time else 0
+    return summary
+
+# the timers the file spent most time in, e.g. 'metadata 0.92s, exif 0.80s'
+def _reason(timers):
+    slowest = sorted(timers.items(), key=lambda item: -item[1])[:4]
+    return ', '.join(f"{name} {seconds:.2f}s" for name, seconds in slowest)
+
+def _top_functions(profile, top=DEFAULT_TOP_FUNCTIONS):
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    functions = []
+    for (file, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+        functions.append({'function': f"{file}:{line}({function})", 'calls': calls,
+                          'total': total, 'cumulative': cumulative})
+    return heapq.nlargest(top, functions, key=lambda entry: entry['cumulative'])
+
+def _top_allocations(snapshot, top=DEFAULT_TOP_ALLOCATIONS):
+    return [{'where': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:top]]
+
+def start(capture_stage=None, cprofile=False, memory=False, top_files=DEFAULT_TOP_FILES):
+    global profiler
+    profiler = Profiler(capture_stage, cprofile, memory, top_files)
+    return profiler
+
+# writes the json report to report_file, the collapsed stacks next to it with .folded
+# and the cProfile data, if any, with .prof; returns the report
+def stop(report_file):
+    global profiler
+    if profiler is None:
+        return None
+    current, profiler = profiler, None
+    report = current.report()
+    report_dir = os.path.dirname(report_file)
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+    base, _ = os.path.splitext(report_file)
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    current.write_stacks(f"{base}.folded")
+    if current.cprofile:
+        current.cprofile.dump_stats(f"{base}.prof")
+    if current.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    logger.info(f"Profile written to {report_file} and {base}.folded")
+    return report
+
+def timer(name, path=None):
+    if profiler is None:
+        return _no_timer
+    return _Timer(profiler, name, path)
+
+def timed(name, path_arg=None):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if profiler is None:
+                return func(*args, **kwargs)
+            path = args[path_arg] if path_arg is not None and path_arg < len(args) else None
+            with _Timer(profiler, name, path):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add(name, seconds, path=None):
+    if profiler is not None:
+        profiler.add(name, seconds, path)
+
+# the timers taking most of the run, for the log
+def report_summary(report, top=10):
+    lines = []
+    for name, summary in list(report['timers'].items())[:top]:
+        lines.append(f"\n\t{name:<16}: {summary['count']} calls, {summary['total']:.2f} s total, "
+                     f"p50 {summary['p50'] * 1000:.1f} ms, p99 {summary['p99'] * 1000:.1f} ms")
+    for entry in report['slowest_files'][:3]:
+        lines.append(f"\n\tslow file {entry['path']}: {entry['seconds']:.2f} s ({entry['reason']})")
+    return ''.join(lines)
+
+########################################################################
+
+# python -m modules.shared.myprof [folder] profiles reading the EXIF of every image in the folder
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.INFO)
+    logger = logging.getLogger("myprof")
+
+    import modules.img.img as img
+    import modules.shared.myfile as myfile
+    import modules.shared.myfiletype as myfiletype
+
+    folder = sys.argv[1] if len(sys.argv) > 1 else "D:\\tmp\\test\\"
+    start(capture_stage='metadata', cprofile=True)
+    for record in myfile.iter_files(folder):
+        with timer('metadata', record.path):
+            if myfiletype.classify(record.path).kind == myfiletype.KIND_IMAGE:
+                img.get_image_raw_metadata(record.path)
+    report = stop(os.path.join('logs', 'myprof.json'))
+    logger.info(f"Profile:{report_summary(report)}")
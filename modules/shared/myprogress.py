@@ -0,0 +1,250 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import modules.shared.mylog as mylog
+
+DEFAULT_STATUS_INTERVAL = 1.0
+DEFAULT_METRICS_INTERVAL = 15.0
+# files/s and MB/s are measured over this many seconds
+RATE_WINDOW = 10.0
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+
+# Progress of a long run: a status line rewritten on the terminal and a file in the Prometheus
+# text format, rewritten for a node exporter's textfile collector, e.g.
+#   [photos_organizer] 1520/8000 files 19% | ETA 00:00:15 | 410.2 files/s 52.1 MB/s | copied 1400 duplicates 120 ...
+# the ETA is known once the source has been walked, the line is cut to the width of the terminal.
+# The counting threads only add to integers, a background thread reads them to draw and write,
+# so the cost per file stays a few attribute updates. Warnings and errors logged while running are counted.
+class Progress:
+    def __init__(self, name, status=True, metrics_file=None, status_interval=DEFAULT_STATUS_INTERVAL,
+                 metrics_interval=DEFAULT_METRICS_INTERVAL, stream=None):
+        self.name = name
+        self.stream = stream or sys.stderr
+        # the status line is drawn on terminals only, redirected output would collect every redraw
+        self.status = status and self.stream.isatty()
+        self.metrics_file = metrics_file
+        self.status_interval = status_interval
+        self.metrics_interval = metrics_interval
+        self.files = 0
+        self.bytes = 0
+        # callable returning the number of files known so far, and whether that number is final
+        self.total = None
+        self.total_final = False
+        # name: [value, help], in the order they are shown
+        self.counters = {}
+        # name: (callable returning a number or None, help, label on the status line, format)
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.drawn = False
+        self.start_time = time.time()
+        self.samples = deque()
+        self.log_counter = _LogCounter(self)
+
+    def counter(self, name, help):
+        self.counters[name] = [0, help]
+
+    def count(self, name, n=1):
+        self.counters[name][0] += n
+
+    def gauge(self, name, func, help, label=None, fmt='{:.0%}'):
+        self.gauges[name] = (func, help, label, fmt)
+
+    def file_done(self, size=0):
+        self.files += 1
+        self.bytes += size
+
+    def add_bytes(self, size):
+        self.bytes += size
+
+    def set_total(self, total, final=False):
+        self.total = total
+        self.total_final = final
+
+    def start(self):
+        self.counter('warnings', "Warnings logged")
+        self.counter('errors', "Errors logged")
+        logging.getLogger().addHandler(self.log_counter)
+        for handler in _stream_handlers():
+            handler.addFilter(self._clear_status)
+        self.thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        logging.getLogger().removeHandler(self.log_counter)
+        for handler in _stream_handlers():
+            handler.removeFilter(self._clear_status)
+        self._write_metrics()
+        with self.lock:
+            if self.drawn:
+                self.stream.write('\r\x1b[K')
+                self.stream.flush()
+                self.drawn = False
+
+    def _run(self):
+        next_metrics = time.monotonic()
+        while not self.stop_event.wait(self.status_interval):
+            self._sample()
+            if self.status:
+                self._draw()
+            if self.metrics_file and time.monotonic() >= next_metrics:
+                self._write_metrics()
+                next_metrics = time.monotonic() + self.metrics_interval
+
+    def _sample(self):
+        now = time.monotonic()
+        self.samples.append((now, self.files, self.bytes))
+        while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+
+    # files/s and bytes/s over the last RATE_WINDOW seconds
+    def rates(self):
+        if len(self.samples) < 2:
+            elapsed = time.time() - self.start_time
+            return (self.files / elapsed, self.bytes / elapsed) if elapsed > 0 else (0.0, 0.0)
+        (start, files, size), (end, last_files, last_size) = self.samples[0], self.samples[-1]
+        return (last_files - files) / (end - start), (last_size - size) / (end - start)
+
+    def eta(self, files_per_sec):
+        total = self.total() if self.total else None
+        if not self.total_final or not total or not files_per_sec:
+            return None
+        return max(total - self.files, 0) / files_per_sec
+
+    def status_line(self):
+        files_per_sec, bytes_per_sec = self.rates()
+        total = self.total() if self.total else None
+        parts = []
+        if total:
+            parts.append(f"{self.files}/{total}{'' if self.total_final else '+'} files {self.files / total:.0%}")
+        else:
+            parts.append(f"{self.files} files")
+        eta = self.eta(files_per_sec)
+        if eta is not None:
+            parts.append(f"ETA {time.strftime('%H:%M:%S', time.gmtime(eta)) if eta < 86400 else f'{eta / 86400:.1f} days'}")
+        parts.append(f"{files_per_sec:.1f} files/s {bytes_per_sec / 2**20:.1f} MB/s")
+        parts.append(' '.join(f"{name} {value}" for name, (value, _) in self.counters.items()))
+        gauges = []
+        for func, _, label, fmt in self.gauges.values():
+            value = func() if label else None
+            if value is not None:
+                gauges.append(f"{label} {fmt.format(value)}")
+        if gauges:
+            parts.append(' '.join(gauges))
+        return f"[{self.name}] " + ' | '.join(parts)
+
+    def _draw(self):
+        width = shutil.get_terminal_size().columns
+        line = self.status_line()[:max(width - 1, 1)]
+        with self.lock:
+            self.stream.write(f"\r{line}\x1b[K")
+            self.stream.flush()
+            self.drawn = True
+
+    # a filter of the terminal log handlers: the status line is erased before a log line is written over it
+    def _clear_status(self, record):
+        if self.drawn:
+            with self.lock:
+                self.stream.write('\r\x1b[K')
+                self.drawn = False
+        return True
+
+    def metrics_text(self):
+        files_per_sec, bytes_per_sec = self.rates()
+        prefix = self.name
+        lines = []
+        def add(name, kind, help, value):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.append(f"{prefix}_{name} {value}")
+        add('start_time_seconds', 'gauge', "Start of the run, seconds since the epoch", f"{self.start_time:.3f}")
+        add('files_processed_total', 'counter', "Source files processed", self.files)
+        add('bytes_copied_total', 'counter', "Bytes copied to destination", self.bytes)
+        total = self.total() if self.total else None
+        if total is not None:
+            add('files_found', 'gauge', "Source files found so far", total)
+            add('files_found_final', 'gauge', "1 when the source has been walked completely", int(self.total_final))
+        add('files_per_second', 'gauge', f"Files processed per second over the last {RATE_WINDOW:.0f} seconds", f"{files_per_sec:.3f}")
+        add('bytes_per_second', 'gauge', f"Bytes copied per second over the last {RATE_WINDOW:.0f} seconds", f"{bytes_per_sec:.1f}")
+        eta = self.eta(files_per_sec)
+        if eta is not None:
+            add('eta_seconds', 'gauge', "Estimated seconds until all the files are processed", f"{eta:.0f}")
+        for name, (value, help) in self.counters.items():
+            add(f"{name}_total", 'counter', help, value)
+        for name, (func, help, _, _) in self.gauges.items():
+            value = func()
+            if value is not None:
+                add(name, 'gauge', help, value)
+        return '\n'.join(lines) + '\n'
+
+    # written to a temporary file and renamed, so the exporter never reads half a file
+    def _write_metrics(self):
+        if not self.metrics_file:
+            return
+        try:
+            metrics_dir = os.path.dirname(os.path.abspath(self.metrics_file))
+            os.makedirs(metrics_dir, exist_ok=True)
+            fd, temp_file = tempfile.mkstemp(prefix='.metrics_', suffix='.tmp', dir=metrics_dir)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(self.metrics_text())
+            os.chmod(temp_file, 0o644)
+            os.replace(temp_file, self.metrics_file)
+        except OSError as e:
+            logger.warning(f"Failed to write metrics to {self.metrics_file}: {e}")
+
+class _LogCounter(logging.Handler):
+    def __init__(self, progress):
+        super().__init__(logging.WARNING)
+        self.progress = progress
+
+    def emit(self, record):
+        self.progress.count('errors' if record.levelno >= logging.ERROR else 'warnings')
+
+# the handlers writing to the terminal, directly or behind mylog's queue
+def _stream_handlers():
+    handlers = list(logging.getLogger().handlers)
+    if mylog.listener is not None:
+        handlers += mylog.listener.handlers
+    return [handler for handler in handlers if type(handler) is logging.StreamHandler]
+
+# hits / (hits + misses) of an object counting them, None before the first lookup
+def hit_ratio(obj, hits=('hits',), misses=('misses',)):
+    if obj is None:
+        return None
+    found = sum(getattr(obj, name) for name in hits)
+    lookups = found + sum(getattr(obj, name) for name in misses)
+    return found / lookups if lookups else None
+
+########################################################################
+
+# python -m modules.shared.myprogress shows a status line for a simulated run and writes metrics to logs/
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.INFO)
+    logger = logging.getLogger("myprogress")
+
+    num_files = 20000
+    progress = Progress('demo', metrics_file=os.path.join('logs', 'demo.prom'))
+    progress.counter('copied', "Files copied")
+    progress.set_total(lambda: num_files, final=True)
+    progress.start()
+    for num in range(num_files):
+        progress.file_done(1024 * 1024)
+        progress.count('copied')
+        if num % 5000 == 0:
+            logger.info(f"processed {num} files")
+        time.sleep(0.0002)
+    progress.close()
+    logger.info(f"Metrics:\n{progress.metrics_text()}")
@@ -0,0 +1,175 @@
+import logging
+import os
+import sys
+from itertools import combinations
+
+import modules.img.img_phash as img_phash
+from modules.img.img_phash import ImageHashes, hamming
+
+DEFAULT_MAX_DISTANCE = 10
+DEFAULT_BATCH_SIZE = 256
+# the 64 bits of a hash are filed in this many chunks
+DEFAULT_CHUNKS = 4
+logger = logging.getLogger(__name__)
+
+from modules.shared.mylog import setup_logging
+import modules.shared.myprof as myprof
+
+# Finds images that look the same but are not the same file: resized re-sends, re-encoded exports, light edits.
+# Two images are similar when both their pHashes and their dHashes differ in at most max_distance bits;
+# resizing and re-encoding change a few bits, different photos differ in about half of them.
+# Hashes are kept in the metadata index, so every image is decoded once.
+
+# Multi-index hashing of 64-bit hashes: each hash is filed under each of its chunks of 16 bits. Two hashes
+# within max_distance bits have at least one chunk within max_distance // chunks bits, so a search looks up
+# the chunks of the hash with those few bits flipped, a few hundred lookups, and compares only the hashes found there.
+# A BK-tree does not do as well here: at distances around 10 of 64 bits it visits most of its nodes.
+class HammingIndex:
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, chunks=DEFAULT_CHUNKS):
+        self.max_distance = max_distance
+        self.chunk_bits = img_phash.HASH_BITS // chunks
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        # chunk value: [(hash, item)], one table per chunk
+        self.tables = [{} for _ in range(chunks)]
+        # xor masks flipping up to max_distance // chunks bits of a chunk
+        self.flips = [sum(1 << bit for bit in bits)
+                      for flipped in range(max_distance // chunks + 1)
+                      for bits in combinations(range(self.chunk_bits), flipped)]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash, item):
+        entry = (hash, item)
+        for num, table in enumerate(self.tables):
+            table.setdefault((hash >> (num * self.chunk_bits)) & self.chunk_mask, []).append(entry)
+        self.size += 1
+
+    # [(distance, item)] of the items within max_distance of hash
+    def find(self, hash):
+        found = []
+        seen = set()
+        for num, table in enumerate(self.tables):
+            chunk = (hash >> (num * self.chunk_bits)) & self.chunk_mask
+            for flip in self.flips:
+                for entry in table.get(chunk ^ flip, ()):
+                    if entry[1] in seen:
+                        continue
+                    seen.add(entry[1])
+                    distance = hamming(hash, entry[0])
+                    if distance <= self.max_distance:
+                        found.append((distance, entry[1]))
+        return found
+
+class SimilarImages:
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, mdindex=None, threads=img_phash.DEFAULT_HASH_THREADS):
+        self.max_distance = max_distance
+        self.mdindex = mdindex
+        self.threads = threads
+        # pHashes of the added images, and path: ImageHashes
+        self.index = HammingIndex(max_distance)
+        self.hashes = {}
+        self.decoded = 0
+        self.from_index = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    # {path: ImageHashes} of the paths that are images; the ones not in the index are decoded in batches
+    def hash_paths(self, paths):
+        hashes = {}
+        misses = []
+        for path in paths:
+            stored = self.mdindex.get_image_hashes(path) if self.mdindex else None
+            if stored is None:
+                misses.append(path)
+            else:
+                self.from_index += 1
+                hashes[path] = ImageHashes(*stored)
+        for start in range(0, len(misses), DEFAULT_BATCH_SIZE):
+            batch = misses[start:start + DEFAULT_BATCH_SIZE]
+            for path, entry in zip(batch, img_phash.hash_images(batch, self.threads)):
+                self.decoded += 1
+                hashes[path] = entry
+                if self.mdindex:
+                    self.mdindex.put_image_hashes(path, *entry)
+        return {path: entry for path, entry in hashes.items() if entry.dhash is not None}
+
+    def add(self, path, hashes):
+        self.index.add(hashes.phash, path)
+        self.hashes[path] = hashes
+
+    def add_paths(self, paths):
+        for path, hashes in self.hash_paths(paths).items():
+            self.add(path, hashes)
+
+    # [(distance, path)] of the added images similar to hashes, the closest first;
+    # the distance is the larger of the pHash and the dHash distances
+    @myprof.timed('similar_find')
+    def find(self, hashes):
+        found = []
+        for phash_distance, path in self.index.find(hashes.phash):
+            dhash_distance = hamming(hashes.dhash, self.hashes[path].dhash)
+            if dhash_distance <= self.max_distance:
+                found.append((max(phash_distance, dhash_distance), path))
+        return sorted(found)
+
+# Groups of similar images among files, each group with its largest image first, as
+# [[{'path', 'pixels', 'size', 'distance'}, ...]] where distance is to the first image, and counters of the work done.
+# Similarity is not transitive: an image joins the group of the first earlier image it is similar to.
+def find_similar(files, max_distance=DEFAULT_MAX_DISTANCE, mdindex=None, threads=img_phash.DEFAULT_HASH_THREADS):
+    similar = SimilarImages(max_distance, mdindex, threads)
+    paths = [path for path in files if img_phash.hashable(path)]
+    hashes = similar.hash_paths(paths)
+    groups = {}
+    group_of = {}
+    for path, entry in hashes.items():
+        found = similar.find(entry)
+        if found:
+            group = group_of[found[0][1]]
+            groups[group].append(path)
+            group_of[path] = group
+        else:
+            groups[path] = [path]
+            group_of[path] = path
+        similar.add(path, entry)
+
+    report = []
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        group.sort(key=lambda path: (-hashes[path].pixels, path))
+        first = hashes[group[0]]
+        report.append([{
+            'path': path,
+            'pixels': hashes[path].pixels,
+            'size': os.path.getsize(path),
+            'distance': max(hamming(first.phash, hashes[path].phash), hamming(first.dhash, hashes[path].dhash)),
+        } for path in group])
+    stats = {
+        'files': len(paths),
+        'images': len(hashes),
+        'decoded': similar.decoded,
+        'from_index': similar.from_index,
+        'groups': len(report),
+        'similar_images': sum(len(group) - 1 for group in report),
+    }
+    logger.info(f"found {stats['groups']} groups of similar images among {stats['images']} images, "
+                f"decoded {stats['decoded']} and found {stats['from_index']} in the index")
+    return report, stats
+
+########################################################################
+
+testdir = "D:\\tmp\\test\\"
+
+if __name__ == "__main__":
+    setup_logging(None, log_level=logging.DEBUG)
+    logger = logging.getLogger("mysimilar")
+
+    import modules.shared.myfile as myfile
+    folder = sys.argv[1] if len(sys.argv) > 1 else testdir
+    groups, stats = find_similar(record.path for record in myfile.iter_files(folder))
+    for group in groups:
+        logger.info(f"{[(entry['path'], entry['distance']) for entry in group]}")
+    logger.info(f"stats={stats}")